@@ -1,65 +1,300 @@
 import Network as nt
-import socket
-import threading
+import asyncio
+import collections
+import json
 import re
-from commons import dprint, BaseSenderReceiver
+import socket
+import time
+from Metrics import Histogram
+from commons import dprint, BaseSenderReceiver, MSG_SIZE
 
 # admin initialization
 HOST = '127.0.0.1'
 PORT = 23000
+ACCEPT_BACKLOG = 4096
+STATS_INTERVAL = 10  # seconds between registration stats reports, 0 to disable
+SCRAPE_TIMEOUT = 1.0  # seconds to wait for peers to answer a stats scrape
+SCRAPE_TOP_PEERS = 10  # busiest peers listed in aggregated stats
+MAX_PORT = 65535
+
+
+class ScrapeProtocol(asyncio.DatagramProtocol):
+	''' Collects the STATS replies of peers. ports is {stats port: peer id} '''
+
+	def __init__(self, ports, replies, done):
+		self.ports = ports
+		self.replies = replies
+		self.done = done
+
+	def datagram_received(self, data, addr):
+		peer_id = self.ports.get(addr[1])
+		if peer_id is None:
+			return
+		try:
+			self.replies[peer_id] = json.loads(data)
+		except ValueError:
+			return
+		if len(self.replies) == len(self.ports) and not self.done.done():
+			self.done.set_result(None)
+
+	def error_received(self, exc):
+		dprint(f"Error", exc)
 
 
 class Admin(BaseSenderReceiver):
-	def __init__(self) -> None:
+	'''
+	Admin runs on a single asyncio event loop. Every registration is handled to the end
+	by the loop before the next one starts, so `peers` and `network` need no locks.
+	'''
+	def __init__(self, max_port=MAX_PORT) -> None:
+		BaseSenderReceiver.__init__(self)
+		self.max_port = max_port  # the simulator has more peers than a host has ports
 		self.network = nt.Network()
-		self.peers = {}
+		self.peers = {}  # dict of {peer_id: peer listening port}
+
+		self.registrations = 0
+		self.first_registration_time = None
+		self.last_registration_time = None
+		# seconds admin spent handling a registration. It does not include the network or the time the
+		# request waited in the socket and the event loop, so it is not the latency a peer sees
+		self.registration_handling_times = collections.deque(maxlen=100000)
+
+	def handle_message(self, msg):
+		''' Handle a message from a peer and return the response '''
+		if re.fullmatch('(\w+) REQUESTS FOR CONNECTING TO NETWORK ON PORT (\d+)', msg, flags=re.IGNORECASE):
+			msg_arr = msg.split()
+			return self.register(msg_arr[0], msg_arr[-1])
+
+		elif re.fullmatch('WHERE IS (\w+)', msg, flags=re.IGNORECASE):
+			return self.lookup(msg.split()[-1])
+
+		elif re.fullmatch('PORT OF (\w+)', msg, flags=re.IGNORECASE):
+			return self.lookup_port(msg.split()[-1])
+
+		elif re.fullmatch('SHORTCUTS OF (\w+)', msg, flags=re.IGNORECASE):
+			return self.shortcuts(msg.split()[-1])
+
+		elif re.fullmatch('(\w+) REPORTS (\w+) DOWN', msg, flags=re.IGNORECASE):
+			msg_arr = msg.split()
+			return self.remove(msg_arr[0], msg_arr[2])
+
+		return None
+
+	def register(self, id_, port):
+		if self.get_peer_from_id(id_):
+			return f"ID {id_} already exist"
+		port = int(port)
+		if not 0 < port <= self.max_port:
+			return f"PORT {port} is not valid"
+
+		self.peers[id_] = port
+		parent = self.network.insert_new_node(id_, port)
+		number = self.network.numbers[id_]
+		if parent is None:
+			return f"CONNECT TO -1 WITH PORT -1 AS NUMBER {number}"
+		return f"CONNECT TO {parent.id} WITH PORT {parent.port} AS NUMBER {number}"
 
-	def client_handler(self, peer):
+	def lookup(self, id_):
+		''' id -> heap number directory for peers that route by number '''
+		if id_ not in self.network.numbers:
+			return f"{id_} NOT FOUND"
+		return f"{id_} IS NUMBER {self.network.numbers[id_]}"
+
+	def lookup_port(self, id_):
+		''' id -> listening port directory for peers that send straight to a destination '''
+		if id_ not in self.peers:
+			return f"{id_} NOT FOUND"
+		return f"{id_} IS ON PORT {self.peers[id_]}"
+
+	def shortcuts(self, id_):
+		'''
+		peers at heap numbers number +- 2 ** i, the shortcut links of a peer that joins or moves. It
+		tells them about itself. A joining peer is the last one, so it only gets number - 2 ** i and
+		later peers link to it the same way. format: SHORTCUTS id:number:port ...
+		'''
+		if id_ not in self.network.numbers:
+			return f"{id_} NOT FOUND"
+		number = self.network.numbers[id_]
+		links = ['SHORTCUTS']
+		step = 1
+		while number - step >= 1 or number + step in self.network:
+			for other in (number - step, number + step):
+				if other in self.network:
+					links.append(f"{self.network.ids[other]}:{other}:{self.network.ports[other]}")
+			step <<= 1
+		return ' '.join(links)
+
+	def remove(self, reporter, id_):
+		'''
+		Take a peer that its neighbor `reporter` found dead out of the network. The last peer moves
+		into its place and adopts its children, so the orphaned subtree is reachable again. The
+		answer tells the reporter what to pass on to the moved peer:
+		REHOME moved_id moved_port number parent_id:parent_port child_id:child_port ...
+		'''
+		if id_ not in self.network.numbers:
+			return f"{id_} REMOVED"
+		number = self.network.numbers[id_]
+		# only a tree neighbor watches id_'s heartbeats, anyone else could take healthy peers out
+		if not self.network.are_neighbors(self.network.numbers.get(reporter, 0), number):
+			dprint(f"{reporter} reported {id_} down but is not its neighbor, ignored")
+			return f"{reporter} IS NOT A NEIGHBOR OF {id_}"
+		del self.peers[id_]
+		moved = self.network.remove_node(number)
+		dprint(f"{reporter} reported {id_} down, removed it from the network")
+		if moved is None:
+			return f"{id_} REMOVED"
+
+		node = self.network.node(number)
+		parent = node.parent
+		parts = ['REHOME', node.id, str(node.port), str(number), f"{parent.id}:{parent.port}" if parent else "-1:-1"]
+		parts.extend(f"{self.network.ids[child]}:{self.network.ports[child]}" for child in self.network.children(number))
+		return ' '.join(parts)
+
+	async def scrape_stats(self, peer_ids=None, host=HOST, timeout=SCRAPE_TIMEOUT):
+		'''
+		Ask peers (all of them if peer_ids is None) for their stats. A peer answers on its sending
+		port, listening port + 1. return {peer_id: stats}, peers that did not answer in time are left out
+		'''
+		if peer_ids is None:
+			peer_ids = self.peers.keys()
+		ports = {int(self.peers[id_]) + 1: id_ for id_ in peer_ids if id_ in self.peers}
+		replies = {}
+		if not ports:
+			return replies
+
+		loop = asyncio.get_running_loop()
+		done = loop.create_future()
+		transport, _ = await loop.create_datagram_endpoint(lambda: ScrapeProtocol(ports, replies, done),
+														   local_addr=(host, 0))
+		try:
+			# all peers answer at once
+			transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+			for port in ports:
+				transport.sendto(b'STATS', (host, port))
+			try:
+				await asyncio.wait_for(done, timeout)
+			except asyncio.TimeoutError:
+				pass
+		finally:
+			transport.close()
+		return replies
+
+	@staticmethod
+	def aggregate_stats(replies):
+		''' sum counters and merge latency histograms of peer stats, and find the busiest peers '''
+		counters = {}
+		latency = Histogram()
+		received = []
+		for peer_id, stats in replies.items():
+			peer_received = 0
+			for name, count in stats['counters'].items():
+				counters[name] = counters.get(name, 0) + count
+				if name.startswith('received.'):
+					peer_received += count
+			latency.merge(stats['latency_ns']['buckets'], stats['latency_ns']['max'])
+			received.append((peer_received, peer_id))
+
+		return {
+			'peers': len(replies),
+			'counters': dict(sorted(counters.items())),
+			'latency_ns': latency.snapshot(),
+			'busiest': [{'id': peer_id, 'received': count} for count, peer_id in sorted(received, reverse=True)[:SCRAPE_TOP_PEERS]],
+		}
+
+	async def show_stats(self, peer_id=None):
+		''' json stats of one peer, or of the whole network with the ids of peers that did not answer '''
+		if peer_id is not None:
+			replies = await self.scrape_stats([peer_id])
+			return json.dumps(replies.get(peer_id, {}))
+
+		replies = await self.scrape_stats()
+		stats = self.aggregate_stats(replies)
+		stats['missing'] = [id_ for id_ in self.peers if id_ not in replies]
+		return json.dumps(stats)
+
+	async def client_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		address = writer.get_extra_info('peername')
+		dprint(f"Peer {address} is connected to server")
 		try:
 			while True:
-				msg = self.receive(peer)
-				if msg == '':
-					dprint(f"Connection to peer {peer.getpeername()} closed.")
-					peer.close()
+				data = await reader.read(MSG_SIZE)
+				msg = data.decode("ascii").strip()
+				if not data:
+					dprint(f"Connection to peer {address} closed.")
 					break
+				dprint(f"Got message from peer {address}: {msg}")
+
+				start = time.perf_counter()
+				if re.fullmatch('SHOW STATS( \w+)?', msg, flags=re.IGNORECASE):
+					admin_msg = await self.show_stats(*msg.split()[2:])
+				else:
+					admin_msg = self.handle_message(msg)
+				if admin_msg is None:
+					continue
 
-				if re.fullmatch('(\w+) REQUESTS FOR CONNECTING TO NETWORK ON PORT (\d+)', msg, flags=re.IGNORECASE):
-					msg_arr = msg.split()
-					id_, port = msg_arr[0], msg_arr[-1]
+				dprint(f"Send message to peer {address} msg: {admin_msg}", level=2)
+				writer.write(admin_msg.encode("ascii"))
+				if admin_msg.startswith("CONNECT TO"):
+					self.record_registration(start)
+				await writer.drain()
 
-					if self.get_peer_from_id(id_):
-						admin_msg = f"ID {id_} already exist"
-					else:
-						self.peers[id_] = peer
-						parent = self.network.insert_new_node(id_, port)
-						if parent is None:
-							admin_msg = f"CONNECT TO -1 WITH PORT -1"
-						else:
-							admin_msg = f"CONNECT TO {parent.id} WITH PORT {parent.port}"
+		except (OSError, UnicodeDecodeError) as e:
+			dprint(f"Error. Peer {address} shutdown.", e)
+		finally:
+			writer.close()
 
-					self.send(peer, admin_msg)
+	def record_registration(self, start):
+		now = time.perf_counter()
+		self.registrations += 1
+		if self.first_registration_time is None:
+			self.first_registration_time = start
+		self.last_registration_time = now
+		self.registration_handling_times.append(now - start)
 
-		except socket.error as e:
-			peer.close()
-			dprint(f"Error. Peer {peer.getpeername()} shutdown.", e)
+	def registration_stats(self):
+		''' return registration count, throughput (per second) and p50/p99 handling time (seconds) '''
+		times = sorted(self.registration_handling_times)
+		if not times:
+			return {'registrations': 0, 'throughput': 0.0, 'handling_p50': 0.0, 'handling_p99': 0.0}
+
+		elapsed = self.last_registration_time - self.first_registration_time
+		return {
+			'registrations': self.registrations,
+			'throughput': self.registrations / elapsed if elapsed > 0 else 0.0,  # no rate from a single instant
+			'handling_p50': times[len(times) // 2],
+			'handling_p99': times[min(len(times) - 1, len(times) * 99 // 100)],
+		}
+
+	async def report_stats(self, interval):
+		reported = 0
+		while True:
+			await asyncio.sleep(interval)
+			if self.registrations != reported:
+				reported = self.registrations
+				stats = self.registration_stats()
+				dprint(f"{stats['registrations']} registrations, {stats['throughput']:.0f}/s, "
+					   f"handled in p50 {stats['handling_p50'] * 1e3:.3f} ms, p99 {stats['handling_p99'] * 1e3:.3f} ms", level=1)
 
 	def get_peer_from_id(self, id_):
 		if id_ in self.peers:
 			return self.peers[id_]
 		return None
 
-	def listen(self, host, port):
-		with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:  # (IPv4 , TCP)
-			server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-			server.bind((host, port))
-			server.listen()
-			dprint(f"Server is listening on {host}:{port}")
+	async def start(self, host, port, backlog=ACCEPT_BACKLOG):
+		''' start accepting peers on the running loop and return the server '''
+		server = await asyncio.start_server(self.client_handler, host, port, backlog=backlog, reuse_address=True)
+		dprint(f"Server is listening on {host}:{port}")
+		return server
 
-			while True:
-				peer, address = server.accept()
-				dprint(f"Peer {address} is connected to server")
-				thread = threading.Thread(target=self.client_handler, args=[peer])
-				thread.start()
+	async def serve(self, host, port, backlog=ACCEPT_BACKLOG, stats_interval=STATS_INTERVAL):
+		server = await self.start(host, port, backlog)
+		if stats_interval:
+			asyncio.get_running_loop().create_task(self.report_stats(stats_interval))
+		async with server:
+			await server.serve_forever()
+
+	def listen(self, host, port, backlog=ACCEPT_BACKLOG):
+		asyncio.run(self.serve(host, port, backlog))
 
 
 if __name__ == "__main__":
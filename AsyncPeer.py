@@ -0,0 +1,208 @@
+import asyncio
+import socket
+import sys
+
+from Peer import Peer, ADMIN_HOST, ADMIN_PORT, PEER_HOST
+from commons import dprint, MSG_SIZE, RECEIVE_BUFFER
+
+ADMIN_TIMEOUT = 5.0  # seconds to wait for admin to answer a request
+
+
+class PeerProtocol(asyncio.DatagramProtocol):
+	''' Hands datagrams that arrive on the listening endpoint to the peer '''
+
+	def __init__(self, peer):
+		self.peer = peer
+
+	def datagram_received(self, data, addr):
+		self.peer.receive_datagram(data, addr[1])
+		if self.peer.inbox is not None:
+			self.peer.schedule_inbox()
+
+	def error_received(self, exc):
+		dprint(f"Error", exc)
+
+
+class StatsProtocol(asyncio.DatagramProtocol):
+	''' Answers STATS requests that arrive on the sending endpoint '''
+
+	def __init__(self, peer):
+		self.peer = peer
+		self.transport = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def datagram_received(self, data, addr):
+		response = self.peer.stats_response(data)
+		if response:
+			self.transport.sendto(response, addr)
+
+
+class AsyncPeer(Peer):
+	'''
+	Peer that runs on a single asyncio event loop instead of a receiving thread and a
+	blocking input(). Datagrams and commands are handled one at a time by the loop, so
+	peer state is only ever touched from one place and in arrival order.
+
+	Commands come from any async iterable of lines (stdin by default) or from `submit`.
+	'''
+
+	def __init__(self, admin_host, admin_port, peer_host):
+		Peer.__init__(self, admin_host, admin_port, peer_host)
+		self.listening_transport = None
+		self.listening_socket = None  # the transport's socket, the inbox reads what waits in it
+		self.inbox_scheduled = False
+		self.loop = None
+		self.commands = None
+		self.closed = None
+
+	async def connect(self):
+		''' bind endpoints, ask admin for our parent and join the network. id and port must be set '''
+		loop = self.loop = asyncio.get_running_loop()
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+			server.bind((self.host, self.listening_port))
+		except OSError:
+			server.close()
+			self.output(f"ERROR: could not bind listening socket to {self.host} {self.listening_port}")
+			return False
+		self.listening_socket = server
+		self.listening_transport, _ = await loop.create_datagram_endpoint(lambda: PeerProtocol(self), sock=server)
+
+		# connect to admin to get parent in network
+		try:
+			response = await self.register()
+		except (OSError, asyncio.TimeoutError) as e:
+			self.output(f"ERROR: could not register with admin: {e!r}")
+			self.listening_transport.close()
+			return False
+		if not self.handle_admin_response(response):
+			self.listening_transport.close()
+			return False
+
+		# init sending endpoint, the sending "socket" is the transport since it has sendto.
+		# it is also our stats endpoint
+		sending_port = self.get_sending_port_from_listening_port(self.listening_port)
+		try:
+			self.sending_socket, _ = await loop.create_datagram_endpoint(
+				lambda: StatsProtocol(self), local_addr=(self.host, sending_port))
+		except OSError:
+			self.output(f"ERROR: could not bind sending socket to {sending_port}")
+			self.listening_transport.close()
+			return False
+
+		self.join_network()
+		return True
+
+	async def register(self):
+		''' ask admin for our parent and return its response '''
+		return await self.admin_request(self.connection_message())
+
+	async def admin_request(self, msg):
+		''' send one request to admin over a connection of our own and return its response '''
+		reader, writer = await asyncio.wait_for(
+			asyncio.open_connection(self.admin_host, self.admin_port), ADMIN_TIMEOUT)
+		dprint(f"Peer is connected to admin {self.admin_host}:{self.admin_port}")
+		try:
+			writer.write(msg.encode("ascii"))
+			return (await asyncio.wait_for(reader.read(MSG_SIZE), ADMIN_TIMEOUT)).decode("ascii").strip()
+		finally:
+			writer.close()
+
+	def ask_admin_then(self, msg, callback):
+		''' ask admin in a task of its own, the loop goes on handling packets until the answer comes '''
+		self.loop.create_task(self.admin_answer(msg, callback))
+
+	async def admin_answer(self, msg, callback):
+		try:
+			response = await self.admin_request(msg)
+		except (OSError, asyncio.TimeoutError) as e:
+			dprint(f"could not ask admin: {msg}, err: {e}")
+			response = None
+		callback(response)
+
+	def call_later(self, delay, callback, *args):
+		self.loop.call_later(delay, callback, *args)
+
+	def clock(self):
+		return self.loop.time()
+
+	def schedule_inbox(self):
+		''' handle the inbox on the next turn of the loop '''
+		if not self.inbox_scheduled:
+			self.inbox_scheduled = True
+			self.loop.call_soon(self.serve_inbox)
+
+	def serve_inbox(self):
+		''' read what waits in the listening socket, handle a few packets and come back for the rest '''
+		self.inbox_scheduled = False
+		if self.listening_transport is None or self.listening_transport.is_closing():
+			return
+		self.receive_waiting(self.listening_socket)
+		self.handle_inbox()
+		if self.inbox:
+			self.schedule_inbox()
+
+	async def execute(self, msg):
+		''' handle one command. before joining only CONNECT is accepted '''
+		if self.sending_socket is not None:
+			self.handle_command(msg)
+		elif self.set_identity(msg):
+			await self.connect()
+		else:
+			self.output("INVALID COMMAND")
+
+	def submit(self, msg):
+		''' queue a command for `run` when it reads from the command queue '''
+		self.commands.put_nowait(msg)
+
+	async def queued_commands(self):
+		while True:
+			msg = await self.commands.get()
+			if msg is None:
+				return
+			yield msg
+
+	async def run(self, commands=None):
+		'''
+		Run commands from `commands` (stdin if None, the `submit` queue if 'queue') and keep
+		serving packets until `close` is called.
+		'''
+		self.closed = asyncio.Event()
+		if self.commands is None:
+			self.commands = asyncio.Queue()
+		if commands is None:
+			commands = stdin_commands()
+		elif commands == 'queue':
+			commands = self.queued_commands()
+
+		async for msg in commands:
+			await self.execute(msg)
+		await self.closed.wait()
+
+	def close(self):
+		self.heartbeating = False
+		for transport in (self.listening_transport, self.sending_socket):
+			if transport is not None:
+				transport.close()
+		if self.closed is not None:
+			self.closed.set()
+
+
+async def stdin_commands():
+	''' lines typed on stdin, without blocking the event loop '''
+	loop = asyncio.get_running_loop()
+	reader = asyncio.StreamReader()
+	await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+	while True:
+		line = await reader.readline()
+		if not line:
+			return
+		yield line.decode().rstrip('\n')
+
+
+if __name__ == "__main__":
+	client = AsyncPeer(ADMIN_HOST, ADMIN_PORT, PEER_HOST)
+	asyncio.run(client.run())
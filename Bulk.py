@@ -0,0 +1,139 @@
+import os
+import random
+import re
+import struct
+
+# transfer id, fragment index, fragment count, total size, fragment size, name length. name and data follow
+FRAGMENT_HEADER = struct.Struct('!IIIQHH')
+FRAGMENT_SIZE = 1400  # data bytes per fragment, so a fragment fits an ethernet MTU
+PIPELINE = 256  # fragments a sender keeps queued in its reliable channel
+MAX_INCOMING = 16  # transfers a peer reassembles at once
+MAX_SIZE = 1 << 30  # bytes of the biggest file we take
+MAX_FRAGMENTS = 1 << 20  # fragments of the biggest transfer we take, one byte of memory each
+TIMEOUT = 60.0  # seconds without a fragment after which an incoming transfer is dropped
+RECEIVE_DIR = 'received'  # where received files are written
+
+
+class OutgoingTransfer:
+	''' A file or other byte source that is sent one fragment at a time, read only when the fragment is sent '''
+
+	def __init__(self, destination, name, source, size, fragment_size=FRAGMENT_SIZE):
+		self.id = random.getrandbits(32)
+		self.destination = destination
+		self.name = os.path.basename(name).encode('utf-8')
+		self.source = source
+		self.size = size
+		self.fragment_size = fragment_size
+		self.count = max(1, -(-size // fragment_size))
+		self.next_index = 0
+
+	@classmethod
+	def from_path(cls, destination, path, fragment_size=FRAGMENT_SIZE):
+		source = open(path, 'rb')
+		return cls(destination, path, source, os.fstat(source.fileno()).st_size, fragment_size)
+
+	def next_fragment(self):
+		''' payload of the next fragment packet, None when all were sent '''
+		if self.next_index == self.count:
+			return None
+		data = self.source.read(self.fragment_size)
+		header = FRAGMENT_HEADER.pack(self.id, self.next_index, self.count, self.size, self.fragment_size,
+									  len(self.name))
+		self.next_index += 1
+		return b''.join((header, self.name, data))
+
+	def close(self):
+		self.source.close()
+
+
+class IncomingTransfer:
+	'''
+	Reassembly of one transfer. Fragments are written straight to their offset in the file, so
+	memory use is one byte per fragment no matter how big the file is or in which order fragments come.
+	'''
+
+	def __init__(self, path, transfer_id, count, size, fragment_size, now):
+		self.path = path
+		# one part file per transfer, two transfers of the same name from a peer must not share one
+		self.part_path = f'{path}.{transfer_id:08x}.part'
+		self.file = open(self.part_path, 'wb')
+		self.file.truncate(size)
+		self.size = size
+		self.count = count
+		self.fragment_size = fragment_size
+		self.received = bytearray(count)  # received[i] is 1 once fragment i was written
+		self.missing = count
+		self.last_seen = now
+
+	def add(self, index, offset, data, now):
+		''' write a fragment. return True when the transfer is complete '''
+		self.last_seen = now
+		if index >= len(self.received) or self.received[index]:
+			return False  # duplicate
+		self.file.seek(offset)
+		self.file.write(data)
+		self.received[index] = 1
+		self.missing -= 1
+		if self.missing:
+			return False
+		self.file.close()
+		os.replace(self.part_path, self.path)
+		return True
+
+	def abort(self):
+		self.file.close()
+		os.remove(self.part_path)
+
+
+class Reassembler:
+	''' Incoming transfers of one peer, bounded to MAX_INCOMING at a time '''
+
+	def __init__(self, directory=RECEIVE_DIR, max_incoming=MAX_INCOMING, timeout=TIMEOUT):
+		self.directory = directory
+		self.max_incoming = max_incoming
+		self.timeout = timeout
+		self.transfers = {}  # dict of {(source id, transfer id): IncomingTransfer}
+
+	def add(self, source, payload, now):
+		'''
+		Take the payload of a fragment from `source`. return (name, path, size) when it completed a
+		transfer, otherwise None. Raises ValueError for a malformed fragment.
+		'''
+		if not re.fullmatch('\w+', source):
+			raise ValueError("invalid source id")
+		try:
+			transfer_id, index, count, size, fragment_size, name_len = FRAGMENT_HEADER.unpack_from(payload)
+		except struct.error:
+			raise ValueError("truncated fragment")
+		if size > MAX_SIZE or not fragment_size or count != max(1, -(-size // fragment_size)) or count > MAX_FRAGMENTS:
+			raise ValueError("invalid or too big transfer")
+		if index >= count:
+			raise ValueError("fragment index out of range")
+		offset = FRAGMENT_HEADER.size + name_len
+		name = os.path.basename(str(payload[FRAGMENT_HEADER.size:offset], 'utf-8', 'replace')) or 'file'
+		data = payload[offset:]
+		if index * fragment_size + len(data) > size:
+			raise ValueError("fragment ends after the file")
+
+		key = (source, transfer_id)
+		transfer = self.transfers.get(key)
+		if transfer is None:
+			self.expire(now)
+			if len(self.transfers) >= self.max_incoming:
+				raise ValueError("too many incoming transfers")
+			os.makedirs(self.directory, exist_ok=True)
+			path = os.path.join(self.directory, f'{source}-{name}')
+			transfer = self.transfers[key] = IncomingTransfer(path, transfer_id, count, size, fragment_size, now)
+		elif (count, size, fragment_size) != (transfer.count, transfer.size, transfer.fragment_size):
+			raise ValueError("fragment does not match its transfer")
+
+		if not transfer.add(index, index * fragment_size, data, now):
+			return None
+		del self.transfers[key]
+		return name, transfer.path, size
+
+	def expire(self, now):
+		for key, transfer in list(self.transfers.items()):
+			if now - transfer.last_seen > self.timeout:
+				transfer.abort()
+				del self.transfers[key]
@@ -0,0 +1,184 @@
+'''
+Packet capture to a ring file, and a tool to look at captures and replay them.
+
+	python Capture.py show capture.bin                       # one line per datagram, oldest first
+	python Capture.py replay capture.bin --port 10000        # send what the captured peer received to a peer on 10000
+	python Capture.py replay capture.bin --port 10000 --speed 10
+
+Replay sends each datagram from the port it originally came from, when that port is free, so the peer
+sees the same neighbors. --speed 0 sends as fast as it can.
+'''
+import argparse
+import mmap
+import socket
+import struct
+import threading
+import time
+
+from Packet import Packet
+
+MAGIC = b'P2PC'
+VERSION = 1
+# magic, version, slot size, slots, datagrams written so far
+FILE_HEADER = struct.Struct('!4sHII Q')
+# time, direction, port, length of the datagram, bytes of it that were kept
+SLOT_HEADER = struct.Struct('!dBxHII')
+COUNT = struct.Struct('!Q')  # the last field of the file header
+COUNT_OFFSET = FILE_HEADER.size - COUNT.size
+SNAPLEN = 2048  # bytes of a datagram that are kept, the rest is cut off like in tcpdump
+SLOTS = 16384  # datagrams the ring holds, older ones are overwritten
+RECEIVED = 0
+SENT = 1
+DIRECTIONS = {RECEIVED: 'in', SENT: 'out'}
+
+
+class CaptureRing:
+	'''
+	Memory-mapped ring file of fixed size slots, one per datagram. Recording is a copy into the map
+	and a counter update, so it can stay on under load. Slot i % slots holds datagram i, so the
+	oldest datagram is always max(0, count - slots) and nothing has to be scanned to find it.
+	'''
+	def __init__(self, path, slots=SLOTS, snaplen=SNAPLEN):
+		if slots < 1 or snaplen < 1:
+			raise ValueError("a capture needs at least one slot of at least one byte")
+		self.path = path
+		self.snaplen = snaplen
+		self.slot_size = SLOT_HEADER.size + snaplen
+		self.slots = slots
+		self.count = 0
+		self.file = open(path, 'w+b')
+		self.file.truncate(FILE_HEADER.size + slots * self.slot_size)
+		self.map = mmap.mmap(self.file.fileno(), FILE_HEADER.size + slots * self.slot_size)
+		FILE_HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.slot_size, slots, 0)
+		self.lock = threading.Lock()  # the threaded peer sends from several threads
+
+	def record(self, direction, port, datagram):
+		kept = length = len(datagram)
+		if length > self.snaplen:
+			kept = self.snaplen
+			datagram = datagram[:kept]
+		with self.lock:
+			if self.map.closed:
+				return  # stopped while another thread was sending or receiving
+			count = self.count
+			offset = FILE_HEADER.size + (count % self.slots) * self.slot_size
+			SLOT_HEADER.pack_into(self.map, offset, time.time(), direction, port, length, kept)
+			offset += SLOT_HEADER.size
+			self.map[offset:offset + kept] = datagram
+			self.count = count + 1
+			COUNT.pack_into(self.map, COUNT_OFFSET, count + 1)
+
+	def close(self):
+		with self.lock:
+			if self.map.closed:
+				return
+			self.map.flush()
+			self.map.close()
+			self.file.close()
+
+
+def read_capture(path):
+	''' (time, direction, port, length, datagram) of the datagrams in a capture file, oldest first '''
+	with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as ring:
+		magic, version, slot_size, slots, count = FILE_HEADER.unpack_from(ring)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError(f"{path} is not a capture file")
+		for i in range(max(0, count - slots), count):
+			offset = FILE_HEADER.size + (i % slots) * slot_size
+			when, direction, port, length, kept = SLOT_HEADER.unpack_from(ring, offset)
+			offset += SLOT_HEADER.size
+			yield when, direction, port, length, ring[offset:offset + kept]
+
+
+def describe(datagram):
+	packet = Packet.parse(datagram)
+	if packet is None:
+		return f'{len(datagram)} bytes, not a plain packet (batch or reliable frame)'
+	return f'{packet.type.code} {packet.source} -> {packet.destination}'
+
+
+def show(path):
+	start = None
+	for when, direction, port, length, datagram in read_capture(path):
+		start = when if start is None else start
+		what = describe(datagram) if length == len(datagram) else f'first {len(datagram)} bytes kept'
+		print(f'{when - start:12.6f} {DIRECTIONS[direction]:<3} port {port:<5} {length:5} bytes  {what}')
+
+
+class Replayer:
+	''' sends datagrams to a peer from the ports they were captured from, or from one other port if those are taken '''
+
+	def __init__(self, host, port):
+		self.address = (host, port)
+		self.host = host
+		self.sockets = {}  # dict of {source port: socket}
+		self.fallback = None
+
+	def socket_for(self, port):
+		sock = self.sockets.get(port)
+		if sock is None:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			try:
+				sock.bind((self.host, port))
+			except OSError:
+				sock.close()
+				if self.fallback is None:
+					self.fallback = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+				sock = self.fallback
+			self.sockets[port] = sock
+		return sock
+
+	def replay(self, datagrams, speed=1.0, direction=RECEIVED):
+		''' send the datagrams of one direction, `speed` times faster than they were captured. return (sent, seconds) '''
+		sent = 0
+		first = None
+		start = time.perf_counter()
+		for when, captured_direction, port, length, datagram in datagrams:
+			if captured_direction != direction:
+				continue
+			if length != len(datagram):
+				continue  # cut off by the snaplen, the peer would drop it anyway
+			if first is None:
+				first = when
+			if speed:
+				delay = start + (when - first) / speed - time.perf_counter()
+				if delay > 0:
+					time.sleep(delay)
+			try:
+				self.socket_for(port).sendto(datagram, self.address)
+				sent += 1
+			except OSError:
+				pass
+		return sent, time.perf_counter() - start
+
+	def close(self):
+		for sock in set(self.sockets.values()):
+			sock.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Look at and replay packet captures')
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	show_parser = subparsers.add_parser('show', help='print the datagrams of a capture')
+	show_parser.add_argument('path')
+	replay_parser = subparsers.add_parser('replay', help='send captured datagrams to a peer')
+	replay_parser.add_argument('path')
+	replay_parser.add_argument('--host', default='127.0.0.1')
+	replay_parser.add_argument('--port', type=int, required=True, help='listening port of the peer to send to')
+	replay_parser.add_argument('--speed', type=float, default=1.0, help='1 is real time, 0 as fast as possible')
+	replay_parser.add_argument('--sent', action='store_true', help='replay what the peer sent instead of what it received')
+	args = parser.parse_args()
+
+	if args.command == 'show':
+		show(args.path)
+	else:
+		replayer = Replayer(args.host, args.port)
+		try:
+			sent, elapsed = replayer.replay(read_capture(args.path), args.speed, SENT if args.sent else RECEIVED)
+		finally:
+			replayer.close()
+		print(f"replayed {sent} datagrams in {elapsed:.3f} s ({sent / elapsed if elapsed else 0:.0f}/s)")
+
+
+if __name__ == "__main__":
+	main()
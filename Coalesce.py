@@ -0,0 +1,96 @@
+import struct
+import threading
+
+BATCH_MAGIC = 0xCB  # first byte of a datagram that carries several packets or reliable frames
+# a batch is BATCH_MAGIC, then a length and the bytes of each packet
+BATCH_ITEM = struct.Struct('!H')
+
+BATCH_SIZE = 1400  # a buffer is sent once it reaches this many bytes, so a batch fits an ethernet MTU
+BATCH_DELAY = 0.002  # seconds the first packet of a buffer waits for more packets to the same neighbor
+
+
+def unpack_batch(datagram):
+	'''
+	list of the packets a batch datagram carries. raises ValueError if it is malformed or holds
+	another batch: we never nest them, and handling items recursively must stay one level deep
+	'''
+	items = []
+	offset = 1
+	while offset < len(datagram):
+		try:
+			length, = BATCH_ITEM.unpack_from(datagram, offset)
+		except struct.error:
+			raise ValueError("truncated batch")
+		offset += BATCH_ITEM.size
+		if offset + length > len(datagram):
+			raise ValueError("truncated batch")
+		if length and datagram[offset] == BATCH_MAGIC:
+			raise ValueError("nested batch")
+		items.append(datagram[offset:offset + length])
+		offset += length
+	return items
+
+
+class Coalescer:
+	'''
+	Packs small packets to the same neighbor into one datagram, to save a datagram and a syscall
+	per packet on every hop.
+
+	Packets to a neighbor wait in a buffer until it reaches `size` bytes or `delay` seconds after the
+	first of them, whichever comes first. A buffer with one packet is sent as that packet alone,
+	packets bigger than `size` go out right away after what is buffered for the neighbor, so the
+	order of packets to a neighbor is kept.
+	'''
+	def __init__(self, send_datagram, call_later, size=BATCH_SIZE, delay=BATCH_DELAY, metrics=None):
+		self.send_datagram = send_datagram  # send_datagram(bytes, port)
+		self.call_later = call_later  # call_later(delay seconds, callback, *args)
+		self.size = size
+		self.delay = delay
+		self.metrics = metrics
+		self.buffers = {}  # dict of {neighbor listening port: [list of packet bytes, size of the batch]}
+		self.lock = threading.Lock()  # the threaded peer sends from its input and receiving threads
+
+	def add(self, port, data):
+		''' send the encoded packet data to the neighbor listening on port, maybe together with others '''
+		cost = BATCH_ITEM.size + len(data)
+		with self.lock:
+			buffer = self.buffers.get(port)
+			if buffer is not None and buffer[1] + cost > self.size:
+				self.send(port, self.buffers.pop(port)[0])
+				buffer = None
+			if 1 + cost > self.size:
+				self.send(port, [data])
+				return
+			if buffer is None:
+				buffer = self.buffers[port] = [[], 1]
+				self.call_later(self.delay, self.flush, port)
+			buffer[0].append(data)
+			buffer[1] += cost
+			if buffer[1] + BATCH_ITEM.size >= self.size:  # no room for another packet
+				self.send(port, self.buffers.pop(port)[0])
+
+	def flush(self, port):
+		''' send what is buffered for the neighbor on port '''
+		with self.lock:
+			buffer = self.buffers.pop(port, None)
+			if buffer is not None:
+				self.send(port, buffer[0])
+
+	def flush_all(self):
+		with self.lock:
+			buffers, self.buffers = self.buffers, {}
+			for port, buffer in buffers.items():
+				self.send(port, buffer[0])
+
+	def send(self, port, items):
+		if len(items) == 1:
+			self.send_datagram(items[0], port)
+			return
+		parts = [bytes((BATCH_MAGIC,))]
+		for data in items:
+			parts.append(BATCH_ITEM.pack(len(data)))
+			parts.append(data)
+		if self.metrics is not None:
+			self.metrics.count('batches')
+			self.metrics.count('coalesced', None, len(items))
+		self.send_datagram(b''.join(parts), port)
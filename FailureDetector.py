@@ -0,0 +1,81 @@
+import collections
+import math
+
+HEARTBEAT_INTERVAL = 0.1  # seconds between heartbeats to each tree neighbor
+TIMEOUT = 0.5  # seconds without a heartbeat after which the fixed timeout detector suspects a neighbor
+PHI_THRESHOLD = 8.0  # suspect when the chance that the heartbeat is only late drops below 10 ** -8
+PHI_WINDOW = 100  # heartbeat intervals the phi detector remembers per neighbor
+PHI_MIN_STD = 0.05  # seconds, so a very regular link is not suspected on the first bit of jitter
+
+
+class TimeoutDetector:
+	''' Suspects a neighbor once nothing was heard from it for `timeout` seconds '''
+
+	def __init__(self, timeout=TIMEOUT):
+		self.timeout = timeout
+		self.last = {}  # dict of {neighbor: time of its last heartbeat}
+
+	def heartbeat(self, key, now):
+		self.last[key] = now
+
+	def suspect(self, key, now):
+		# a neighbor we never heard from gets a timeout from when we started to watch it
+		return now - self.last.setdefault(key, now) > self.timeout
+
+	def remove(self, key):
+		self.last.pop(key, None)
+
+
+class PhiAccrualDetector:
+	'''
+	Phi accrual failure detector (Hayashibara et al.). It keeps the last `window` intervals
+	between heartbeats of each neighbor and, taking them as normally distributed, computes
+	phi = -log10(chance that the next heartbeat comes even later than now). A neighbor is suspected
+	when phi passes `threshold`, so the timeout follows the jitter of each link instead of being fixed.
+	'''
+	def __init__(self, threshold=PHI_THRESHOLD, window=PHI_WINDOW, min_std=PHI_MIN_STD,
+				 first_interval=HEARTBEAT_INTERVAL):
+		self.threshold = threshold
+		self.window = window
+		self.min_std = min_std
+		self.first_interval = first_interval  # assumed interval until we measured one
+		self.history = {}  # dict of {neighbor: [last heartbeat time, deque of intervals, sum, sum of squares]}
+
+	def heartbeat(self, key, now):
+		history = self.history.get(key)
+		if history is None:
+			self.history[key] = [now, collections.deque(), 0.0, 0.0]
+			return
+		interval = now - history[0]
+		history[0] = now
+		intervals = history[1]
+		intervals.append(interval)
+		history[2] += interval
+		history[3] += interval * interval
+		if len(intervals) > self.window:
+			old = intervals.popleft()
+			history[2] -= old
+			history[3] -= old * old
+
+	def phi(self, key, now):
+		history = self.history.get(key)
+		if history is None:
+			self.history[key] = [now, collections.deque(), 0.0, 0.0]
+			return 0.0
+		count = len(history[1])
+		if count:
+			mean = history[2] / count
+			std = max(math.sqrt(max(history[3] / count - mean * mean, 0.0)), self.min_std)
+		else:
+			mean, std = self.first_interval, self.min_std
+		later = 0.5 * math.erfc((now - history[0] - mean) / (std * math.sqrt(2)))
+		return -math.log10(max(later, 1e-300))
+
+	def suspect(self, key, now):
+		return self.phi(key, now) > self.threshold
+
+	def remove(self, key):
+		self.history.pop(key, None)
+
+
+DETECTORS = {'fixed': TimeoutDetector, 'phi': PhiAccrualDetector}
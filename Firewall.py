@@ -0,0 +1,138 @@
+from Packet import PacketType
+from commons import log
+
+CACHE_SIZE = 4096
+
+
+class Firewall:
+	'''
+	Indexed firewall rule table. Rules are kept in insertion order and the newest
+	rule has the highest priority (same as inserting at the head of a list and
+	taking the first match). Instead of scanning every rule for every packet we
+	keep, for each (direction, packet type), only the newest rule for every
+	src/dst bucket. `*` is just another bucket key. A lookup therefore checks a
+	constant number of buckets no matter how many rules are installed.
+
+	Decisions are also memoized in a bounded cache keyed by
+	(flag, type, src, dst, local id). The cache is dropped whenever a rule is added.
+
+	`hits[i]` counts the packets that `rules[i]` decided.
+	'''
+
+	def __init__(self, cache_size=CACHE_SIZE):
+		self.rules = []  # list of (direction, id_src, id_dst, packet_type, action), oldest first
+		self.hits = []  # hits[i] is the number of packets rules[i] accepted or dropped
+		self.cache_size = cache_size
+
+		# {packet_type: {rule_source: (priority, rule)}}
+		self._input_by_src = {}
+		# {packet_type: {rule_destination: (priority, rule)}}
+		self._output_by_dst = {}
+		# {packet_type: (priority, rule)}, newest OUTPUT rule of each type
+		self._output_any = {}
+		# {packet_type: {(rule_source, rule_destination): (priority, rule)}}
+		self._forward_by_pair = {}
+		# {packet_type: {rule_source: (priority, rule)}}
+		self._forward_by_src = {}
+
+		self._cache = {}
+
+	def __len__(self):
+		return len(self.rules)
+
+	def rule_hits(self):
+		''' list of (rule, hits) in match order '''
+		return list(zip(reversed(self.rules), reversed(self.hits)))
+
+	def __iter__(self):
+		''' iterate rules in match order (newest first) '''
+		return reversed(self.rules)
+
+	def add_rule(self, direction, id_src, id_dst, typ: PacketType, action):
+		direction, action = direction.upper(), action.upper()
+		rule = (direction, id_src, id_dst, typ, action)
+		entry = (len(self.rules), rule)
+		self.rules.append(rule)
+		self.hits.append(0)
+
+		# New rule is always the newest, so it simply shadows older rules of the same bucket
+		if direction == 'INPUT':
+			self._input_by_src.setdefault(typ, {})[id_src] = entry
+		elif direction == 'OUTPUT':
+			self._output_by_dst.setdefault(typ, {})[id_dst] = entry
+			self._output_any[typ] = entry
+		elif direction == 'FORWARD':
+			self._forward_by_pair.setdefault(typ, {})[(id_src, id_dst)] = entry
+			self._forward_by_src.setdefault(typ, {})[id_src] = entry
+
+		self._cache.clear()
+		return rule
+
+	def match(self, typ, id_src, id_dst, local_id, flag):
+		''' return the first matching rule for the packet fields or None '''
+		entry = self._match(typ, id_src, id_dst, local_id, flag)
+		return entry[1] if entry else None
+
+	def _match(self, typ, id_src, id_dst, local_id, flag):
+		''' return (priority, rule) of the first matching rule or None '''
+		key = (flag, typ, id_src, id_dst, local_id)
+		try:
+			return self._cache[key]
+		except KeyError:
+			pass
+
+		best = None
+		candidates = []
+
+		if id_dst == local_id or id_dst == '-1':
+			buckets = self._input_by_src.get(typ)
+			if buckets:
+				candidates.append(buckets.get(id_src))
+				candidates.append(buckets.get('*'))
+
+		if id_src == local_id:
+			if id_dst == '-1':
+				candidates.append(self._output_any.get(typ))
+			else:
+				buckets = self._output_by_dst.get(typ)
+				if buckets:
+					candidates.append(buckets.get(id_dst))
+					candidates.append(buckets.get('*'))
+
+		if flag:
+			if id_dst == '-1':
+				buckets = self._forward_by_src.get(typ)
+				if buckets:
+					candidates.append(buckets.get(id_src))
+					candidates.append(buckets.get('*'))
+			else:
+				buckets = self._forward_by_pair.get(typ)
+				if buckets:
+					candidates.append(buckets.get((id_src, id_dst)))
+					candidates.append(buckets.get((id_src, '*')))
+					candidates.append(buckets.get(('*', id_dst)))
+					candidates.append(buckets.get(('*', '*')))
+
+		for entry in candidates:
+			if entry is not None and (best is None or entry[0] > best[0]):
+				best = entry
+
+		if self.cache_size:
+			if len(self._cache) >= self.cache_size:
+				self._cache.pop(next(iter(self._cache)))
+			self._cache[key] = best
+		return best
+
+	def check(self, packet, local_id, flag):
+		''' return True if packet is allowed. flag_send = True, flag_receive = False '''
+		entry = self._match(packet.type, packet.source, packet.destination, local_id, flag)
+		if entry is None:
+			return True
+
+		priority, rule = entry
+		self.hits[priority] += 1
+		accepted = rule[4] == 'ACCEPT'
+		if log.level >= 2:
+			log.write(2, "Your %s packet is %s in match with %s rule.", rule[0].lower(),
+					  'accepted' if accepted else 'dropped', rule)
+		return accepted
@@ -0,0 +1,210 @@
+import array
+import mmap
+import os
+import re
+import struct
+import threading
+
+# seq, name length, text length. name and text follow. seq 0 marks the end of a segment's records
+RECORD_HEADER = struct.Struct('!QHI')
+SEGMENT_SIZE = 1 << 24  # bytes of a segment file, a new one is started when a record does not fit
+INDEX_EVERY = 256  # the index keeps the position of every INDEX_EVERY-th record
+BATCH_BYTES = 1 << 16  # pending appends are written to the map once they reach this size
+FLUSH_INTERVAL = 0.05  # seconds after an append by which it is written to the map
+HISTORY_DIR = 'history'  # where peers keep their chat logs
+HISTORY_NAME = 'history-{chat_id}.log'  # name of a history transfer
+
+
+def records(buffer, start=0, end=None):
+	''' (seq, name, text) of the records in buffer from byte start, reading them one at a time '''
+	end = len(buffer) if end is None else end
+	position = start
+	while position + RECORD_HEADER.size <= end:
+		seq, name_len, text_len = RECORD_HEADER.unpack_from(buffer, position)
+		if not seq:
+			return
+		position += RECORD_HEADER.size
+		name = str(buffer[position:position + name_len], 'utf-8', 'replace')
+		position += name_len
+		text = str(buffer[position:position + text_len], 'utf-8', 'replace')
+		position += text_len
+		yield seq, name, text
+
+
+def history_chat_id(name):
+	''' chat id of a received history transfer name, None if it is not one '''
+	match = re.fullmatch('history-(\d+)\.log', name)
+	return int(match.group(1)) if match else None
+
+
+class ChatLog:
+	'''
+	Append-only log of the messages of one chatroom, in segment files of SEGMENT_SIZE bytes that are
+	memory-mapped. Records get sequence numbers from 1 and never span segments.
+
+	Appends are queued and written to the map in batches, when BATCH_BYTES are pending or when `flush`
+	is called (the peer does FLUSH_INTERVAL after the first pending append). Reads flush first.
+
+	A position is segment << 32 | offset. The index keeps the position of records 1, 1 + INDEX_EVERY,
+	1 + 2 * INDEX_EVERY, ... so finding a record scans at most INDEX_EVERY records, and the index is
+	rebuilt by scanning the segments when a log is opened again.
+	'''
+	def __init__(self, path_prefix, segment_size=SEGMENT_SIZE):
+		self.path_prefix = path_prefix
+		self.segment_size = segment_size
+		self.files = []
+		self.maps = []
+		self.ends = []  # ends[i] is where the records of segment i end
+		self.index = array.array('Q')
+		self.next_seq = 1
+		self.pending = []  # list of encoded records not written yet
+		self.pending_bytes = 0
+		self.lock = threading.Lock()  # the threaded peer appends from its receiving and input threads
+
+		segment = 0
+		while os.path.exists(self.segment_path(segment)):
+			self.open_segment(segment)
+			self.scan(segment)
+			segment += 1
+
+	def __len__(self):
+		return self.next_seq - 1
+
+	def segment_path(self, segment):
+		return f'{self.path_prefix}.{segment:06d}.log'
+
+	def open_segment(self, segment):
+		file = open(self.segment_path(segment), 'a+b')
+		if os.fstat(file.fileno()).st_size < self.segment_size:
+			file.truncate(self.segment_size)
+		self.files.append(file)
+		self.maps.append(mmap.mmap(file.fileno(), self.segment_size))
+		self.ends.append(0)
+
+	def scan(self, segment):
+		''' index the records a segment already has '''
+		position = 0
+		segment_map = self.maps[segment]
+		for seq, name, text in records(segment_map):
+			if (seq - 1) % INDEX_EVERY == 0:
+				self.index.append(segment << 32 | position)
+			position += RECORD_HEADER.size + len(name.encode('utf-8')) + len(text.encode('utf-8'))
+			self.next_seq = seq + 1
+		self.ends[segment] = position
+
+	def append(self, name, text):
+		''' queue a message. return its sequence number '''
+		name, text = name.encode('utf-8'), text.encode('utf-8')
+		with self.lock:
+			seq = self.next_seq
+			self.next_seq += 1
+			self.pending.append(RECORD_HEADER.pack(seq, len(name), len(text)) + name + text)
+			self.pending_bytes += RECORD_HEADER.size + len(name) + len(text)
+			if self.pending_bytes >= BATCH_BYTES:
+				self.write_pending()
+		return seq
+
+	def flush(self):
+		with self.lock:
+			self.write_pending()
+
+	def write_pending(self):
+		''' copy pending records to the map, a segment's worth at a time. lock must be held '''
+		if not self.pending:
+			return
+		seq = RECORD_HEADER.unpack_from(self.pending[0])[0]
+		if not self.maps:
+			self.open_segment(0)
+		batch, batch_bytes = [], 0
+		for record in self.pending:
+			segment = len(self.maps) - 1
+			if self.ends[segment] + batch_bytes + len(record) > self.segment_size:
+				self.write_batch(batch, batch_bytes)
+				batch, batch_bytes = [], 0
+				self.open_segment(segment + 1)
+				segment += 1
+			if (seq - 1) % INDEX_EVERY == 0:
+				self.index.append(segment << 32 | (self.ends[segment] + batch_bytes))
+			batch.append(record)
+			batch_bytes += len(record)
+			seq += 1
+		self.write_batch(batch, batch_bytes)
+		self.pending, self.pending_bytes = [], 0
+
+	def write_batch(self, batch, batch_bytes):
+		segment = len(self.maps) - 1
+		end = self.ends[segment]
+		self.maps[segment][end:end + batch_bytes] = b''.join(batch)
+		self.ends[segment] = end + batch_bytes
+
+	def position(self, seq):
+		''' position of record seq, which must be written '''
+		position = self.index[(seq - 1) // INDEX_EVERY]
+		segment, offset = position >> 32, position & 0xffffffff
+		for _ in range((seq - 1) % INDEX_EVERY):
+			_, name_len, text_len = RECORD_HEADER.unpack_from(self.maps[segment], offset)
+			offset += RECORD_HEADER.size + name_len + text_len
+			if offset >= self.ends[segment]:
+				segment, offset = segment + 1, 0
+		return segment, offset
+
+	def start_seq(self, since=None, last=None):
+		''' first sequence number of a replay of the records after since, or of the last `last` records '''
+		if since is not None:
+			return max(since + 1, 1)
+		if last is not None:
+			return max(self.next_seq - last, 1)
+		return 1
+
+	def reader(self, since=None, last=None):
+		''' file-like reader of the encoded records from start_seq(since, last) to now '''
+		with self.lock:
+			self.write_pending()
+			start = self.start_seq(since, last)
+			if start >= self.next_seq:
+				return LogReader([])
+			segment, offset = self.position(start)
+			ranges = [(self.maps[segment], offset, self.ends[segment])]
+			ranges.extend((self.maps[i], 0, self.ends[i]) for i in range(segment + 1, len(self.maps)))
+			return LogReader(ranges)
+
+	def replay(self, since=None, last=None):
+		''' (seq, name, text) of the records from start_seq(since, last) to now '''
+		for segment_map, start, end in self.reader(since, last).ranges:
+			yield from records(segment_map, start, end)
+
+	def close(self):
+		with self.lock:
+			self.write_pending()
+			for segment_map, file in zip(self.maps, self.files):
+				segment_map.flush()
+				segment_map.close()
+				file.close()
+			self.maps, self.files = [], []
+
+
+class LogReader:
+	''' Reads byte ranges of segment maps one after another, as an OutgoingTransfer source '''
+
+	def __init__(self, ranges):
+		self.ranges = ranges  # list of (map, start, end)
+		self.size = sum(end - start for _, start, end in ranges)
+		self.current = 0
+		self.offset = ranges[0][1] if ranges else 0
+
+	def read(self, n):
+		chunks = []
+		while n and self.current < len(self.ranges):
+			segment_map, _, end = self.ranges[self.current]
+			chunk = segment_map[self.offset:min(self.offset + n, end)]
+			chunks.append(chunk)
+			n -= len(chunk)
+			self.offset += len(chunk)
+			if self.offset >= end:
+				self.current += 1
+				if self.current < len(self.ranges):
+					self.offset = self.ranges[self.current][1]
+		return b''.join(chunks)
+
+	def close(self):
+		pass
@@ -0,0 +1,202 @@
+'''
+Host many peers in one process, on one event loop, instead of a process per peer.
+
+	python Host.py -n 500                           # p0 .. p499 on ports 10000, 10002, ...
+	python Host.py -n 500 --script storm.txt        # then run a script, then read stdin
+
+Every line of a script or of stdin is `[id] [command]` and goes to the command queue of that peer,
+`* [command]` goes to all of them. A line for an id the host does not run yet starts a peer for it,
+so `p7 CONNECT AS p7 ON PORT 10014` adds one. `SLEEP [seconds]` pauses the script.
+
+Peers register over one TCP connection to admin that they share. Each peer still has its listening
+and sending sockets, other peers tell it apart by their ports.
+'''
+import argparse
+import asyncio
+import os
+import re
+import resource
+import time
+
+import commons
+from AsyncPeer import AsyncPeer, ADMIN_TIMEOUT, stdin_commands
+from Peer import ADMIN_HOST, ADMIN_PORT, PEER_HOST
+from commons import MSG_SIZE
+
+BASE_PORT = 10000  # peer i listens on BASE_PORT + 2 * i
+
+
+def resident_memory():
+	''' resident set size of this process in bytes '''
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError):
+		# peak, not current, but all we have off Linux
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class AdminLink:
+	'''
+	One TCP connection to admin shared by the peers of a host. Admin answers a request before it
+	reads the next one, so requests are sent one at a time and each read is one answer.
+	'''
+	def __init__(self, host, port):
+		self.host = host
+		self.port = port
+		self.reader = None
+		self.writer = None
+		self.lock = asyncio.Lock()
+
+	async def ask(self, msg):
+		'''
+		send one request to admin and return its response. A connection that broke while idle is
+		opened again once. On a timeout the link is closed too, a late answer must not be read as
+		the answer to the next request.
+		'''
+		async with self.lock:
+			reused = self.writer is not None
+			try:
+				return await self.exchange(msg)
+			except ConnectionError:
+				if not reused:
+					raise
+			return await self.exchange(msg)
+
+	async def exchange(self, msg):
+		try:
+			if self.writer is None:
+				self.reader, self.writer = await asyncio.wait_for(
+					asyncio.open_connection(self.host, self.port), ADMIN_TIMEOUT)
+			self.writer.write(msg.encode("ascii"))
+			data = await asyncio.wait_for(self.reader.read(MSG_SIZE), ADMIN_TIMEOUT)
+			if not data:
+				raise ConnectionError("admin closed the connection")
+		except (OSError, asyncio.TimeoutError):
+			self.close()
+			raise
+		return data.decode("ascii").strip()
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+			self.reader = self.writer = None
+
+
+class HostedPeer(AsyncPeer):
+	''' peer that registers through its host's admin link and shows its output with its id '''
+
+	def __init__(self, link, peer_host, quiet=False):
+		AsyncPeer.__init__(self, link.host, link.port, peer_host)
+		self.link = link
+		self.quiet = quiet
+
+	async def admin_request(self, msg):
+		return await self.link.ask(msg)
+
+	def output(self, *args):
+		if not self.quiet:
+			print(f"{self.id}:", *args)
+
+
+class Host:
+	''' Runs peers on the running event loop, each with a command queue of its own '''
+
+	def __init__(self, admin_host=ADMIN_HOST, admin_port=ADMIN_PORT, peer_host=PEER_HOST, quiet=False):
+		self.link = AdminLink(admin_host, admin_port)
+		self.peer_host = peer_host
+		self.quiet = quiet
+		self.peers = {}  # dict of {peer_id: HostedPeer}
+		self.tasks = []
+
+	def add_peer(self, peer_id):
+		''' start a peer that reads its commands from its queue. it joins once it gets a CONNECT '''
+		peer = HostedPeer(self.link, self.peer_host, self.quiet)
+		peer.id = peer_id
+		peer.commands = asyncio.Queue()  # so commands can be submitted before run starts
+		self.peers[peer_id] = peer
+		self.tasks.append(asyncio.get_running_loop().create_task(peer.run('queue')))
+		return peer
+
+	async def connect(self, peer_id, port):
+		''' start a peer and wait until it joined the network. return False if it could not join '''
+		peer = self.peers.get(peer_id) or self.add_peer(peer_id)
+		await peer.execute(f"CONNECT AS {peer_id} ON PORT {port}")
+		return peer.sending_socket is not None
+
+	async def start(self, n, prefix='p', base_port=BASE_PORT):
+		''' start n peers one after another, so parents are up before their children join. return how many joined '''
+		joined = 0
+		for i in range(n):
+			joined += await self.connect(f'{prefix}{i}', base_port + 2 * i)
+		return joined
+
+	async def dispatch(self, line):
+		''' run one host line: [id] [command], * [command] or SLEEP [seconds] '''
+		line = line.strip()
+		if not line:
+			return
+		if re.fullmatch('SLEEP (\d+(?:\.\d+)?)', line, flags=re.IGNORECASE):
+			await asyncio.sleep(float(line.split()[-1]))
+			return
+		peer_id, _, command = line.partition(' ')
+		if peer_id == '*':
+			for peer in self.peers.values():
+				peer.submit(command)
+			return
+		if peer_id not in self.peers:
+			self.add_peer(peer_id)
+		self.peers[peer_id].submit(command)
+
+	async def run(self, lines):
+		async for line in lines:
+			await self.dispatch(line)
+
+	def close(self):
+		for peer in self.peers.values():
+			peer.submit(None)
+			peer.close()
+		self.link.close()
+
+
+async def script_commands(path):
+	with open(path) as script:
+		for line in script:
+			yield line.rstrip('\n')
+
+
+async def main(args):
+	commons.log.level = args.log_level
+	host = Host(args.admin_host, args.admin_port, args.host, args.quiet)
+	before = resident_memory()
+	start = time.perf_counter()
+	joined = await host.start(args.n, args.prefix, args.base_port)
+	elapsed = time.perf_counter() - start
+	after = resident_memory()
+	if args.n:
+		print(f"started {joined}/{args.n} peers in {elapsed:.2f} s ({elapsed / args.n * 1e3:.2f} ms per peer), "
+			  f"{(after - before) / args.n / 1024:.0f} KiB resident per peer, "
+			  f"{before / 2 ** 20:.1f} MiB for the interpreter a process per peer would repeat")
+	try:
+		if args.script:
+			await host.run(script_commands(args.script))
+		if not args.no_stdin:
+			await host.run(stdin_commands())
+		await asyncio.gather(*host.tasks)
+	finally:
+		host.close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Run many peers in one process')
+	parser.add_argument('-n', type=int, default=0, help='peers to start before the script')
+	parser.add_argument('--prefix', default='p', help='ids of started peers are prefix + index')
+	parser.add_argument('--base-port', type=int, default=BASE_PORT)
+	parser.add_argument('--script', help='file of [id] [command] lines to run after starting')
+	parser.add_argument('--no-stdin', action='store_true', help='do not read commands from stdin')
+	parser.add_argument('--quiet', action='store_true', help='do not show what peers output')
+	parser.add_argument('--admin-host', default=ADMIN_HOST)
+	parser.add_argument('--admin-port', type=int, default=ADMIN_PORT)
+	parser.add_argument('--host', default=PEER_HOST, help='address peers bind to')
+	parser.add_argument('--log-level', type=int, default=0)
+	asyncio.run(main(parser.parse_args()))
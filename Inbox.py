@@ -0,0 +1,43 @@
+import collections
+
+from Packet import PacketType
+
+# packets that carry data. everything else builds, repairs or probes the tree and goes first
+BULK_TYPES = frozenset((PacketType.MESSAGE, PacketType.MULTICAST, PacketType.FRAGMENT))
+
+INBOX_SIZE = 4096  # packets of each class that wait to be handled, newer bulk packets are dropped
+RECEIVE_BATCH = 256  # datagrams read from the socket without waiting before handling some
+HANDLE_BATCH = 16  # packets handled before the socket is read again
+
+
+class PriorityInbox:
+	'''
+	Received packets wait here to be handled, and so forwarded, control packets first.
+
+	The peer reads whatever is waiting in its socket, which is cheap next to handling a packet, puts
+	it in the inbox and handles a few packets before reading again. A control packet that arrives
+	behind a flood of data packets so waits for at most one read and HANDLE_BATCH packets instead of
+	the whole flood. When the bulk queue is full new bulk packets are dropped, while control packets
+	still get in.
+	'''
+	def __init__(self, size=INBOX_SIZE):
+		self.size = size
+		self.control = collections.deque()
+		self.bulk = collections.deque()
+
+	def __len__(self):
+		return len(self.control) + len(self.bulk)
+
+	def put(self, typ, item):
+		''' queue item for a packet of type typ. return False if its queue is full '''
+		queue = self.bulk if typ in BULK_TYPES else self.control
+		if len(queue) >= self.size:
+			return False
+		queue.append(item)
+		return True
+
+	def get(self):
+		''' next item to handle, the oldest control packet if there is one '''
+		if self.control:
+			return self.control.popleft()
+		return self.bulk.popleft()
@@ -0,0 +1,91 @@
+class Histogram:
+	'''
+	Log-linear histogram in the style of HdrHistogram. Every power of two range of values is split
+	into 2 ** precision_bits buckets, so a value is kept with a relative error below
+	2 ** -precision_bits, memory grows with the log of the largest value and recording is a few
+	integer operations and one dict update.
+	'''
+	def __init__(self, precision_bits=4):
+		self.precision_bits = precision_bits
+		self.buckets = {}  # dict of {bucket lower bound: count}
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def record(self, value):
+		if value > self.max:
+			self.max = value
+		self.count += 1
+		self.total += value
+		shift = value.bit_length() - self.precision_bits - 1
+		if shift > 0:
+			value = value >> shift << shift
+		self.buckets[value] = self.buckets.get(value, 0) + 1
+
+	def merge(self, buckets, max_=0):
+		''' add counts of another histogram's buckets, e.g. from a `snapshot` of it '''
+		for value, count in buckets.items():
+			value = int(value)
+			self.buckets[value] = self.buckets.get(value, 0) + count
+			self.count += count
+			self.total += value * count
+		self.max = max(self.max, max_)
+
+	def percentile(self, q, buckets=None):
+		''' lower bound of the bucket that has the q-th percentile (0 < q <= 100) '''
+		buckets = self.buckets if buckets is None else buckets
+		count = sum(buckets.values())
+		if not count:
+			return 0
+		rank = count * q / 100
+		seen = 0
+		for value in sorted(buckets):
+			seen += buckets[value]
+			if seen >= rank:
+				return value
+		return self.max
+
+	def snapshot(self):
+		# copied in one step, another thread may record while we read it
+		buckets = dict(self.buckets)
+		count, total = self.count, self.total
+		return {
+			'count': count,
+			'mean': total / count if count else 0,
+			'max': self.max,
+			'p50': self.percentile(50, buckets),
+			'p90': self.percentile(90, buckets),
+			'p99': self.percentile(99, buckets),
+			'p999': self.percentile(99.9, buckets),
+			'buckets': {str(value): count for value, count in sorted(buckets.items())},
+		}
+
+
+class Metrics:
+	'''
+	Counters of packet events, per packet type, and a histogram of the time a peer spends on each
+	datagram it receives. Counting is one dict update, so it stays on in production.
+
+	Events:
+		received        datagrams that passed the INPUT/FORWARD firewall
+		invalid         datagrams that could not be parsed
+		input_dropped   packets dropped by the firewall on receive
+		forwarded       packets routed on for other peers
+		sent            datagrams sent
+		output_dropped  packets dropped by the firewall on send
+		send_failed     datagrams the socket refused
+	'''
+	def __init__(self):
+		self.counters = {}  # dict of {(event, packet type or None): count}
+		self.latency = Histogram()  # ns from a datagram arriving to the peer being done with it
+
+	def count(self, event, typ=None, n=1):
+		key = (event, typ)
+		self.counters[key] = self.counters.get(key, 0) + n
+
+	def snapshot(self):
+		counters = {}
+		# copied in one step, the receive thread may count while another thread takes a snapshot
+		for (event, typ), count in dict(self.counters).items():
+			counters[event if typ is None else f'{event}.{typ.name.lower()}'] = count
+		return {'counters': dict(sorted(counters.items())), 'latency_ns': self.latency.snapshot()}
@@ -1,4 +1,5 @@
-from commons import dprint
+from array import array
+from commons import log
 
 class Network:
     ''' Each node has an `number` that starts from 1. Network structure will look like this:
@@ -9,61 +10,169 @@ class Network:
             4   5               6   7
           / |   | \           / |   |  \
         8   9   10  11      12  13  14 ...
-        
+
         So we can find ones parent simply by dividing it's number by 2. And node i children will be i*2 and i*2+1.
+
+        Because of that we don't keep pointers between nodes. Ids and ports are kept in arrays indexed by
+        node number, and every question about the tree (parent, children, depth, subtree, path) is arithmetic
+        on numbers. `Node` objects are only created as light views when someone asks for one.
     '''
     def __init__(self):
-        self.root = None
-        self.nodes_number = 1
-        self.nodes = {}
+        self.nodes_number = 1  # number of the next node to insert
+        self.ids = [None]  # ids[number], index 0 is unused
+        self.ports = array('I', [0])  # ports[number]. 32 bit, simulated networks have more than 65535 ports
+        self.numbers = {}  # dict of {id: number}
+
+    def __len__(self):
+        return self.nodes_number - 1
+
+    def __contains__(self, number):
+        return 1 <= number < self.nodes_number
+
+    @property
+    def root(self):
+        return self.node(1)
 
     def insert_new_node(self, id_, port):
+        port = int(port)  # before anything changes, a bad port must not leave ids and ports misaligned
         node_number = self.nodes_number
+        self.ids.append(id_)
+        self.ports.append(port)
         self.nodes_number += 1
+        self.numbers[id_] = node_number
 
-        if self.root == None:
-            parent_node = None
-        else:
-            parent_number = node_number // 2
-            parent_node = self.nodes[parent_number]
-
-        new_node = Node(node_number, id_, port, parent=parent_node)
-        self.nodes[node_number] = new_node
-        
-        if self.root == None:
-            self.root = new_node
-        else:
-            parent_node.add_child(new_node)
+        parent_node = self.node(self.parent(node_number))
 
-        dprint(f"New node inserted into network with number: {node_number} id: {id_} port: {port} parent: {None if not parent_node else parent_node.id}", level=2)
+        if log.level >= 2:
+            log.write(2, "New node inserted into network with number: %s id: %s port: %s parent: %s",
+                      node_number, id_, port, None if not parent_node else parent_node.id)
         return parent_node
 
-    def _str_network(self, node, level=0):
-        if node is None:
-            return ''
+    def remove_node(self, number):
+        ''' remove node `number`. The last node takes its place, so numbers stay dense and every other
+            node keeps its number. return the old number of the node that moved, None if none did '''
+        last = self.nodes_number - 1
+        del self.numbers[self.ids[number]]
+        moved = None
+        if number != last:
+            moved_id = self.ids[last]
+            self.ids[number] = moved_id
+            self.ports[number] = self.ports[last]
+            self.numbers[moved_id] = number
+            moved = last
+        self.ids.pop()
+        self.ports.pop()
+        self.nodes_number -= 1
+
+        if log.level >= 2:
+            log.write(2, "Node removed from network with number: %s, moved node from number: %s", number, moved)
+        return moved
+
+    def node(self, number):
+        if number not in self:
+            return None
+        return Node(self, number)
+
+    def get_node_from_id(self, id_):
+        if id_ not in self.numbers:
+            return None
+        return Node(self, self.numbers[id_])
+
+    @staticmethod
+    def parent(number):
+        ''' parent number, 0 for root '''
+        return number // 2
+
+    def children(self, number):
+        return [child for child in (number * 2, number * 2 + 1) if child in self]
+
+    def are_neighbors(self, a, b):
+        ''' True if nodes a and b are in the network and one is the parent of the other '''
+        return a in self and b in self and (self.parent(a) == b or self.parent(b) == a)
+
+    @staticmethod
+    def depth(number):
+        return number.bit_length() - 1
+
+    @staticmethod
+    def in_subtree(root_number, number):
+        ''' True if node `number` is in subtree of `root_number` '''
+        diff = Network.depth(number) - Network.depth(root_number)
+        return diff >= 0 and number >> diff == root_number
+
+    @staticmethod
+    def common_ancestor(a, b):
+        diff = Network.depth(a) - Network.depth(b)
+        if diff > 0:
+            a >>= diff
+        else:
+            b >>= -diff
+        while a != b:
+            a >>= 1
+            b >>= 1
+        return a
+
+    @staticmethod
+    def path(a, b):
+        ''' list of node numbers on the tree path from a to b (both included) '''
+        ancestor = Network.common_ancestor(a, b)
+        up = []
+        while a != ancestor:
+            up.append(a)
+            a >>= 1
+        down = []
+        while b != ancestor:
+            down.append(b)
+            b >>= 1
+        return up + [ancestor] + down[::-1]
+
+    def _str_network(self, number, level=0):
+        result = []
+        stack = [(number, level, False)]
+        while stack:
+            number, level, visited = stack.pop()
+            if number not in self:
+                continue
+            if visited:
+                result.append(f"{' ' * 5 * level} -> {self.ids[number]}\n")
+                continue
+            # in-order: left subtree, node, right subtree
+            stack.append((number * 2 + 1, level + 1, False))
+            stack.append((number, level, True))
+            stack.append((number * 2, level + 1, False))
+        return ''.join(result)
 
-        return self._str_network(node.left, level + 1) + \
-            f"{' ' * 5 * level} -> {node.id}\n" + \
-            self._str_network(node.right, level + 1)
- 
     def __str__(self):
-        return self._str_network(self.root)
+        return self._str_network(1)
 
 
 class Node:
-    def __init__(self, number, id_, port, parent=None):
+    ''' View of one node of a `Network` '''
+    __slots__ = ('network', 'number')
+
+    def __init__(self, network, number):
+        self.network = network
         self.number = number
-        self.port = port
-        self.id = id_
-        self.parent = parent
-        self.left = None
-        self.right = None
-
-    def add_child(self, new_node):
-        if new_node.number == self.number * 2:
-            self.left = new_node
-        else:
-            self.right = new_node
+
+    @property
+    def id(self):
+        return self.network.ids[self.number]
+
+    @property
+    def port(self):
+        return self.network.ports[self.number]
+
+    @property
+    def parent(self):
+        return self.network.node(self.network.parent(self.number))
+
+    @property
+    def left(self):
+        return self.network.node(self.number * 2)
+
+    @property
+    def right(self):
+        return self.network.node(self.number * 2 + 1)
 
     def __str__(self):
         if self.left is None:
@@ -83,5 +192,5 @@ class Node:
 
 # n = Network()
 # for i in range(20):
-#     n.insert_new_node(i)
+#     n.insert_new_node(i, 9000 + i)
 # print(n)
@@ -1,5 +1,6 @@
 from enum import Enum
 import re
+import struct
 
 class PacketType(Enum):
 	'''
@@ -28,21 +29,135 @@ class PacketType(Enum):
 	''' Packet types ''' 
 	
 	MESSAGE =   			0
+	MULTICAST =   			1
 	ROUTING_REQUEST =     	10
 	ROUTING_RESPONSE =     	11
 	PARENT_ADVERTISE =  	20
 	ADVERTISE =  			21
+	WITHDRAW =				22
+	ADVERTISE_DELTA =		23
 	DESTINATION_NOT_FOUND =	31
 	CONNECTION_REQUEST =    41
+	SHORTCUT =				42
+	HEARTBEAT =				43
+	REHOME =				44
+	ADOPT =					45
+	LEAVE =					46
+	FRAGMENT =				50
+
+
+PACKET_TYPES = {typ.value: typ for typ in PacketType}
+
+WIRE_MAGIC = 0xCE  # can not be the first byte of a text packet, those start with an ascii digit
+WIRE_VERSION = 2  # 2: id lengths are 16 bits so a multicast destination list fits
+# magic, version, type, flags, source id length, destination id length, payload length
+WIRE_HEADER = struct.Struct('!BBBBHHI')
+# header flags
+FLAG_NUMBERED = 0x01  # source and destination heap numbers follow the header
+WIRE_NUMBERS = struct.Struct('!II')
 
 
 class Packet:
-	def __init__(self, typ: PacketType, src_id: str, dst_id: str, data: str) -> None:
+	'''
+	A packet can be serialized in two formats:
+	 - text: `type|src|dst|data`, what every peer spoke before the binary format.
+	 - binary: WIRE_HEADER, WIRE_NUMBERS if FLAG_NUMBERED is set, then source id,
+	   destination id and payload. Heap numbers (see Network.py) are 0 when unknown.
+	   Payload is never decoded unless someone reads `data`, and a parsed packet keeps
+	   the bytes it came from in `raw` so a forwarding peer can relay them untouched.
+	   Binary payloads (pass `payload` instead of `data`) can only be sent in this format.
+	'''
+	def __init__(self, typ: PacketType, src_id: str, dst_id: str, data: str, flags=0, payload=None) -> None:
 		self.type: PacketType = typ
 		self.destination: str = dst_id
 		self.source: str = src_id
-		self.data: str = data
+		self.flags = flags
+		self.src_number = 0
+		self.dst_number = 0
+		self.raw: bytes = None
+		self._data = data
+		self._payload = payload
+
+	@property
+	def data(self) -> str:
+		if self._data is None:
+			self._data = str(self._payload, 'utf-8', 'replace')
+		return self._data
+
+	@data.setter
+	def data(self, value):
+		self._data = value
+		self._payload = None
+		self.raw = None
+
+	@property
+	def payload(self):
+		''' data as bytes (or a memoryview of the bytes the packet was parsed from) '''
+		if self._payload is None:
+			self._payload = str(self._data).encode('utf-8')
+		return self._payload
+
+	def to_bytes(self) -> bytes:
+		src, dst, payload = self.source.encode('utf-8'), self.destination.encode('utf-8'), self.payload
+		if self.src_number or self.dst_number:
+			flags = self.flags | FLAG_NUMBERED
+			numbers = WIRE_NUMBERS.pack(self.src_number, self.dst_number)
+		else:
+			flags = self.flags & ~FLAG_NUMBERED
+			numbers = b''
+		header = WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, self.type.value, flags, len(src), len(dst), len(payload))
+		return b''.join((header, numbers, src, dst, payload))
+
+	@classmethod
+	def from_bytes(cls, buf):
+		''' parse a binary packet. `buf` may be a memoryview into a reusable receive buffer '''
+		magic, version, typ, flags, src_len, dst_len, payload_len = WIRE_HEADER.unpack_from(buf)
+		if magic != WIRE_MAGIC or version != WIRE_VERSION:
+			raise ValueError(f"unsupported packet version {version}")
+		packet_type = PACKET_TYPES.get(typ)
+		if packet_type is None:
+			raise ValueError(f"unknown packet type {typ}")
+
+		# one copy out of the receive buffer; the payload stays a view of it
+		offset = WIRE_HEADER.size
+		if flags & FLAG_NUMBERED:
+			offset += WIRE_NUMBERS.size
+		end = offset + src_len + dst_len + payload_len
+		raw = bytes(buf[:end])
+		if len(raw) != end:
+			raise ValueError("truncated packet")
+		src = raw[offset:offset + src_len].decode('utf-8')
+		offset += src_len
+		dst = raw[offset:offset + dst_len].decode('utf-8')
+		offset += dst_len
+
+		packet = cls(packet_type, src, dst, None, flags)
+		packet._payload = memoryview(raw)[offset:]
+		packet.raw = raw
+		if flags & FLAG_NUMBERED:
+			packet.src_number, packet.dst_number = WIRE_NUMBERS.unpack_from(raw, WIRE_HEADER.size)
+		return packet
+
+	@classmethod
+	def from_text(cls, msg: str):
+		splited = msg.split('|', 3)
+		packet_type = PacketType.get_packet_type_from_code(splited[0])
+		if packet_type is None:
+			raise ValueError(f"unknown packet type {splited[0]}")
+		return cls(packet_type, splited[1], splited[2], splited[3])
+
+	@classmethod
+	def parse(cls, buf):
+		''' parse a datagram in either format. return None if it is not a valid packet '''
+		try:
+			if buf and buf[0] == WIRE_MAGIC:
+				return cls.from_bytes(buf)
+			msg = str(buf, 'ascii').strip()
+			if not msg:
+				return None
+			return cls.from_text(msg)
+		except (ValueError, IndexError, struct.error):
+			return None
 
 	def __str__(self) -> str:
 		return f"{self.type.code}|{self.source}|{self.destination}|{self.data}"
-
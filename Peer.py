@@ -1,11 +1,29 @@
 from Packet import Packet, PacketType
 import Chatroom
+import Bulk
+import FailureDetector
+from Firewall import Firewall
+from Network import Network
+from Metrics import Metrics
+from Reliable import ReliableChannel, LINK_MAGIC
+from Coalesce import Coalescer, BATCH_MAGIC, unpack_batch
+from RouteCache import RouteCache
+from RateLimit import RateLimiter
+from Inbox import PriorityInbox, RECEIVE_BATCH, HANDLE_BATCH
+import History
+from Capture import CaptureRing, RECEIVED, SENT
+import collections
+import os
+import json
+import mmap
 import re
+import select
 import socket
 import threading
 import random
+import time
 
-from commons import dprint, BaseSenderReceiver
+from commons import dprint, log, BaseSenderReceiver, MSG_SIZE, RECEIVE_BUFFER
 
 
 ADMIN_HOST = '127.0.0.1'
@@ -13,8 +31,64 @@ ADMIN_PORT = 23000
 
 PEER_HOST = '127.0.0.1'
 
+# Route by heap numbers that admin hands out (see Network.py) instead of advertised subtrees.
+# Peers don't advertise new children to their parent and find unknown destinations through admin.
+# All peers of a network should use the same setting, and it needs the binary wire format.
+HEAP_ROUTING = False
+
+# Send to neighbors over a reliable channel with acks and retransmissions (see Reliable.py).
+# Peers accept reliable frames either way, so this can be turned on peer by peer.
+RELIABLE = False
+
+# Pack small packets to the same neighbor into one datagram, sent when it is full or after a few
+# milliseconds (see Coalesce.py). Peers unpack batches either way, so this can be turned on peer by peer.
+COALESCE = False
+
+# Send packets we originate straight to the destination's port once we know it, from a ROUTE answer,
+# from admin (PORT OF) for destinations we keep sending to, or from the destination sending straight
+# to us (see RouteCache.py). Only the first and last peer's firewall see such packets.
+DIRECT_ROUTES = False
+DIRECT_TYPES = (PacketType.MESSAGE, PacketType.FRAGMENT)  # other packets discover or maintain the tree
+
+# Link to the peers at heap numbers number +- 2 ** i that admin assigns (like Chord fingers) and pass
+# packets to the link or tree neighbor whose number is closest to the destination's, so they skip
+# levels of the tree and do not all cross the root. Needs HEAP_ROUTING, all peers should use the same setting.
+SHORTCUTS = False
+
+# Send heartbeats to tree neighbors and report the ones that go quiet to admin, which moves its last
+# peer into the dead peer's place, so the orphaned subtree is reachable again (see FailureDetector.py)
+HEARTBEATS = False
+FAILURE_DETECTOR = 'fixed'  # 'fixed' timeout or 'phi' accrual
+
+# Collect the peers we learn of for a short window and advertise them to our parent together, in
+# ADVERTISE_DELTA packets of space separated ids, instead of one PARENT_ADVERTISE per peer per hop, so
+# a join burst costs the root a handful of packets. Peers apply deltas either way, so this can be turned
+# on peer by peer. HEAP_ROUTING does not advertise at all.
+AGGREGATE_ADVERTS = False
+ADVERTISE_WINDOW = 0.01  # seconds a new peer waits for others to be advertised with it
+ADVERTISE_BATCH_BYTES = 1200  # ids in one delta packet, so it fits a datagram on a 1500 byte MTU
+
+# Read what is waiting in the listening socket into a queue and handle control packets before data
+# packets, so tree maintenance does not wait behind a flood of messages (see Inbox.py)
+PRIORITY_INBOX = False
+
+# Keep the messages of our chatrooms in append-only logs under History.HISTORY_DIR, so members who
+# joined late can ask us for them (see History.py)
+CHAT_HISTORY = False
+
+# Share the listening port with SO_REUSEPORT worker processes that forward messages with a copy of
+# our routing state, so forwarding uses more than one core (see Workers.py). Threaded peer only.
+# FORWARD_SPREAD 'flow' gives each neighbor's traffic to one process, 'random' spreads every datagram
+FORWARD_WORKERS = 0
+FORWARD_SPREAD = 'flow'
+
+STATS_TOP_RULES = 100  # firewall rules with most hits that we report to admin, all of them are in SHOW STATS
+
 class Peer(BaseSenderReceiver):
-	def __init__(self, admin_host, admin_port, peer_host):
+	def __init__(self, admin_host, admin_port, peer_host, heap_routing=HEAP_ROUTING, reliable=RELIABLE,
+				 coalesce=COALESCE, direct_routes=DIRECT_ROUTES, shortcuts=SHORTCUTS,
+				 heartbeats=HEARTBEATS, priority=PRIORITY_INBOX, workers=FORWARD_WORKERS,
+				 history=CHAT_HISTORY, aggregate=AGGREGATE_ADVERTS):
 		BaseSenderReceiver.__init__(self)
 		self.admin_host = admin_host
 		self.admin_port = admin_port
@@ -23,14 +97,35 @@ class Peer(BaseSenderReceiver):
 		self.listening_port = 0
 
 		self.id = None
+		self.number = None  # our heap number in admin's network
+		self.heap_routing = heap_routing
+		self.reliable = reliable
+		self.coalesce = coalesce
+		self.direct_routes = direct_routes
+		self.shortcuts = shortcuts and heap_routing
+		self.heartbeats = heartbeats
+		self.aggregate = aggregate
+		self.workers = workers
+		self.pool = None  # Workers.WorkerPool once workers are running
 
 		self.parent_id = None
 		self.parent_port = None
 
 		self.known_peers = {}  # dict of {peer_id: peer_port}. peer_port is None for all except children
-		self.children_subtree = {}  # dict of {child_id: list of peer_id}
+		self.children_subtree = {}  # dict of {child_id: set of peer_id}
+		self.routing_table = {}  # dict of {peer_id: port of the child whose subtree has the peer}
+		self.child_ports = {}  # dict of {child heap number: child port}
+		self.directory = {}  # dict of {peer_id: heap number}, filled from packets and admin lookups
+		self.pending_adverts = {}  # dict of {peer_id: None}, peers to advertise to our parent, in the order we learned them
+		self.advert_flush_scheduled = False
+		self.advert_lock = threading.Lock()
+		self.route_cache = RouteCache()  # ports of peers we send to directly
+		self.fingers = {}  # dict of {heap number: port} of our shortcut links
 
 		self.sending_socket = None
+		# the receive thread owns routing state: timers that fire and commands typed in are queued for it
+		self.due = collections.deque()  # (callback, args) to run on the receive thread
+		self.wakeup = None  # (reader, writer) socket pair that wakes the receive thread up for them
 		
 		self.current_chatroom: Chatroom.Chatroom = None  # So that when in a chatroom, we ignore other chatroom join requests, etc
 		self.chat_disabled = False
@@ -39,59 +134,117 @@ class Peer(BaseSenderReceiver):
 		self.wait_for_chat_name = 0
 		self.pending_chat_requests = []  # list of chat requests
 
-		self.firewall = []
+		self.firewall = Firewall()
+		self.limiter = RateLimiter()
+		self.inbox = PriorityInbox() if priority else None
+		self.metrics = Metrics()
+		self.channel = ReliableChannel(self.send_frame, self.call_later, self.clock, metrics=self.metrics,
+									   on_acked=self.pump_transfers)
+		self.coalescer = Coalescer(self.send_datagram, self.call_later, metrics=self.metrics)
+		self.detector = FailureDetector.DETECTORS[FAILURE_DETECTOR]()  # keyed by neighbor listening port
+		self.heartbeating = False
+
+		self.outgoing_transfers = []  # list of Bulk.OutgoingTransfer, sent one after another
+		self.transfer_lock = threading.Lock()
+		self.reassembler = Bulk.Reassembler()
+
+		self.history = history
+		self.chat_logs = {}  # dict of {chat id: History.ChatLog}
+		self.history_flush_scheduled = False
 
+		self.capture = None  # Capture.CaptureRing while CAPTURE ON
+
+
+	def output(self, *args):
+		''' Show something to the user '''
+		print(*args)
 
 	def firewall_check(self, packet: Packet, flag):  # flag_send = True, flag_receive = False
-		typ, id_src, id_dst = packet.type, packet.source, packet.destination
-		for rule in self.firewall:
-			dprint(f"checking rule {rule} ...", level=3)
-
-			rule_direction = rule[0]
-			rule_source = rule[1]
-			rule_destination = rule[2]
-			rule_packet_type = rule[3]
-			rule_action = rule[4]
-
-			if rule_packet_type == typ and rule_action == "ACCEPT":
-				if rule_direction == 'INPUT' and (rule_source == id_src or rule_source == '*') and (id_dst == self.id or id_dst == '-1'):
-					dprint(f"Your input packet is accepted in match with {rule} rule.", level=2)
-					return True
-				elif rule_direction == 'OUTPUT' and id_src == self.id and (rule_destination == id_dst or id_dst == '-1' or rule_destination == '*'):
-					dprint(f"Your output packet is accepted in match with {rule} rule.", level=2)
-					return True
-				elif rule_direction == 'FORWARD' and (rule_source == id_src or rule_source == '*') and (rule_destination == id_dst or id_dst == '-1' or rule_destination == '*'):
-					if flag:
-						dprint(f"Your forward packet is accepted in match with {rule} rule.", level=2)
-						return True
-			elif rule_packet_type == typ and rule_action == "DROP":
-				if rule_direction == 'INPUT' and (rule_source == id_src or rule_source == '*') and (id_dst == self.id or id_dst == '-1'):
-					dprint(f"Your input packet is dropped in match with {rule} rule.", level=2)
-					return False
-				elif rule_direction == 'OUTPUT' and id_src == self.id and (rule_destination == id_dst or id_dst == '-1' or rule_destination == '*'):
-					dprint(f"Your output packet is dropped in match with {rule} rule.", level=2)
-					return False
-				elif rule_direction == 'FORWARD' and (rule_source == id_src or rule_source == '*') and (rule_destination == id_dst or id_dst == '-1' or rule_destination == '*'):
-					if flag:
-						dprint(f"Your forward packet is dropped in match with {rule} rule.", level=2)
-						return False
-		return True
+		return self.firewall.check(packet, self.id, flag)
 
 
 	def add_to_known_peers(self, id_, port=None):
 		if id_ not in self.known_peers or self.known_peers[id_] == None:
-			dprint(f'add peer with id {id_} and port {port} to known peers', level=2)
+			if log.level >= 2:
+				log.write(2, 'add peer with id %s and port %s to known peers', id_, port)
 			self.known_peers[id_] = port
 
 	def send_packet_to_peer(self, peer_port, packet):
 		try:
 			if self.firewall_check(packet, flag=True):
-				self.send_packet(self.sending_socket, packet, (self.host, peer_port))
+				# a lost fragment would lose the whole transfer, so fragments always go reliably
+				if self.reliable or packet.type == PacketType.FRAGMENT:
+					if log.level >= 2:
+						log.write(2, "Send message reliably to peer port %s msg: %s", peer_port, packet)
+					self.channel.send(peer_port, self.encode_packet(packet))
+				elif self.coalesce:
+					if log.level >= 2:
+						log.write(2, "Queue message to peer port %s msg: %s", peer_port, packet)
+					self.coalescer.add(peer_port, self.encode_packet(packet))
+				else:
+					self.send_packet(self.sending_socket, packet, (self.host, peer_port))
+				self.metrics.count('sent', packet.type)
+			else:
+				self.metrics.count('output_dropped', packet.type)
 		except OSError as e:
+			self.metrics.count('send_failed', packet.type)
 			dprint(f"could not send packet: {packet} to port {peer_port}, err: {e}")
 			return False
 		return True
 	
+	def send_frame(self, frame, peer_port):
+		''' send a reliable channel frame to the peer listening on peer_port '''
+		if self.coalesce:
+			self.coalescer.add(peer_port, frame)
+		else:
+			self.send_datagram(frame, peer_port)
+
+	def send_datagram(self, datagram, peer_port):
+		''' send bytes as one datagram to the peer listening on peer_port '''
+		try:
+			self.send_bytes(self.sending_socket, datagram, (self.host, peer_port))
+		except OSError as e:
+			self.metrics.count('send_failed')
+			dprint(f"could not send datagram to port {peer_port}, err: {e}")
+
+	def send_bytes(self, socket, msg, addr=None):
+		capture = self.capture  # CAPTURE OFF may clear it on the input thread
+		if addr and capture is not None:
+			capture.record(SENT, addr[1], msg)
+		BaseSenderReceiver.send_bytes(self, socket, msg, addr)
+
+	def send_bytes_batch(self, sock, msg, addrs):
+		capture = self.capture
+		if capture is not None:
+			for addr in addrs:
+				capture.record(SENT, addr[1], msg)
+		BaseSenderReceiver.send_bytes_batch(self, sock, msg, addrs)
+
+	def call_later(self, delay, callback, *args):
+		''' run callback(*args) on the receive thread after delay seconds '''
+		timer = threading.Timer(delay, self.run_on_receiver, (callback, *args))
+		timer.daemon = True
+		timer.start()
+
+	def run_on_receiver(self, callback, *args):
+		''' have the receive thread run callback(*args) next, so no other thread changes routing state '''
+		self.due.append((callback, args))
+		wakeup = self.wakeup
+		if wakeup is not None:
+			try:
+				wakeup[1].send(b'\0')
+			except BlockingIOError:
+				pass  # the receive thread has wakeups to read already
+
+	def run_due(self):
+		for _ in range(len(self.due)):
+			callback, args = self.due.popleft()
+			callback(*args)
+
+	def clock(self):
+		''' seconds on a clock that only moves forward, for timeouts '''
+		return time.monotonic()
+
 	def receive_packet_from_server(self, server):
 		while True:
 			pkt = self.receive_packet_udp(server)
@@ -103,24 +256,266 @@ class Peer(BaseSenderReceiver):
 			else:
 				continue
 
+	def receive_datagram(self, datagram, peer_port):
+		''' Parse, filter and handle a datagram that was received from peer_port '''
+		capture = self.capture
+		if capture is not None:
+			capture.record(RECEIVED, peer_port, datagram)
+		self.handle_datagram(datagram, peer_port)
+
+	def handle_datagram(self, datagram, peer_port):
+		''' handle a received datagram or an item of a received batch '''
+		if datagram and datagram[0] == BATCH_MAGIC:
+			try:
+				items = unpack_batch(datagram)
+			except ValueError:
+				self.metrics.count('invalid')
+				dprint(f"Got invalid batch from peer port {peer_port}")
+				return
+			for item in items:
+				self.handle_datagram(item, peer_port)
+			return
+
+		start = time.perf_counter_ns()
+		if datagram and datagram[0] == LINK_MAGIC:
+			# reliable channel frame: an ack, a duplicate or a packet to unwrap
+			datagram = self.channel.receive(datagram, self.get_listen_port_from_sending_port(peer_port))
+			if datagram is None:
+				return
+		packet = Packet.parse(datagram)
+		if packet is None:
+			self.metrics.count('invalid')
+			dprint(f"Got invalid packet from peer port {peer_port}")
+			return
+		self.accept_packet(packet, peer_port, start)
+
+	def accept_packet(self, packet, peer_port, start):
+		''' filter and handle a parsed packet. start is when its datagram arrived, in perf_counter_ns '''
+		if log.level >= 1:
+			log.write(1, "Got message from peer port %s: %s", peer_port, packet)
+		if not self.firewall_check(packet, flag=False):
+			self.metrics.count('input_dropped', packet.type)
+		elif self.limiter and not self.limiter.allow(packet.type, packet.source, self.clock()):
+			self.metrics.count('rate_limited', packet.type)
+		else:
+			self.metrics.count('received', packet.type)
+			if self.inbox is not None:
+				if not self.inbox.put(packet.type, (packet, peer_port, start)):
+					self.metrics.count('inbox_overflow', packet.type)
+				return
+			self.handle_packet(packet, peer_port)
+		self.metrics.latency.record(time.perf_counter_ns() - start)
+
+	def receive_waiting(self, server):
+		''' put the datagrams that are waiting in the server socket in the inbox, without waiting for more '''
+		for _ in range(RECEIVE_BATCH):
+			try:
+				datagram, address = self.receive_datagram_udp(server, socket.MSG_DONTWAIT)
+			except BlockingIOError:
+				return
+			if datagram:
+				self.receive_datagram(datagram, address[1])
+
+	def handle_inbox(self, limit=HANDLE_BATCH):
+		''' handle up to limit packets from the inbox, control packets first '''
+		for _ in range(min(limit, len(self.inbox))):
+			packet, peer_port, start = self.inbox.get()
+			self.handle_packet(packet, peer_port)
+			# includes the time the packet waited in the inbox
+			self.metrics.latency.record(time.perf_counter_ns() - start)
+
 	def advertise_to_parent(self, peer_id):
 		if not self.parent_port:
 			return
+		if self.aggregate:
+			self.queue_advertisements([peer_id])
+			return
 		packet = Packet(PacketType.PARENT_ADVERTISE, self.id, self.parent_id, peer_id)
 		self.send_packet_to_peer(self.parent_port, packet)
 
+	def queue_advertisements(self, peer_ids):
+		''' advertise peer_ids to our parent in one delta with the others we learn of in the next ADVERTISE_WINDOW '''
+		with self.advert_lock:
+			self.pending_adverts.update(dict.fromkeys(peer_ids))
+			if self.advert_flush_scheduled:
+				return
+			self.advert_flush_scheduled = True
+		self.call_later(ADVERTISE_WINDOW, self.flush_advertisements)
+
+	def flush_advertisements(self):
+		with self.advert_lock:
+			peer_ids, self.pending_adverts = self.pending_adverts, {}
+			self.advert_flush_scheduled = False
+		self.send_advertisements(list(peer_ids))
+
+	def send_advertisements(self, peer_ids):
+		''' send peer_ids to our parent in ADVERTISE_DELTA packets of up to ADVERTISE_BATCH_BYTES of ids '''
+		if not self.parent_port:
+			return
+		chunk, size = [], 0
+		for peer_id in peer_ids:
+			if chunk and size + len(peer_id) > ADVERTISE_BATCH_BYTES:
+				packet = Packet(PacketType.ADVERTISE_DELTA, self.id, self.parent_id, ' '.join(chunk))
+				self.send_packet_to_peer(self.parent_port, packet)
+				chunk, size = [], 0
+			chunk.append(peer_id)
+			size += len(peer_id) + 1
+		if chunk:
+			packet = Packet(PacketType.ADVERTISE_DELTA, self.id, self.parent_id, ' '.join(chunk))
+			self.send_packet_to_peer(self.parent_port, packet)
+
 	def add_new_child(self, id_):
-		dprint(f'add new child with id {id_}', level=2)
-		self.children_subtree[id_] = []
+		if log.level >= 2:
+			log.write(2, 'add new child with id %s', id_)
+		self.children_subtree[id_] = set()
 		self.add_to_child_subtree(id_, id_)
 
 	def add_to_child_subtree(self, new_peer_id, child_id):
-		dprint(f'add new peer with id {new_peer_id} to child subtree with id {child_id}', level=2)
+		if log.level >= 2:
+			log.write(2, 'add new peer with id %s to child subtree with id %s', new_peer_id, child_id)
 		if child_id not in self.children_subtree:
-			dprint(f'child {child_id} is not in child_subtree dict', level=2)
+			if log.level >= 2:
+				log.write(2, 'child %s is not in child_subtree dict', child_id)
 			return
 
-		self.children_subtree[child_id].append(new_peer_id)
+		self.children_subtree[child_id].add(new_peer_id)
+		self.routing_table[new_peer_id] = self.known_peers[child_id]
+
+	def add_subtree(self, peer_ids, child_id):
+		''' add_to_child_subtree for all of peer_ids at once '''
+		subtree = self.children_subtree.get(child_id)
+		if subtree is None:
+			if log.level >= 2:
+				log.write(2, 'child %s is not in child_subtree dict', child_id)
+			return
+		for peer_id in peer_ids:
+			self.add_to_known_peers(peer_id)
+		subtree.update(peer_ids)
+		self.routing_table.update(dict.fromkeys(peer_ids, self.known_peers[child_id]))
+
+	def withdraw_from_parent(self, peer_id):
+		''' tell our parent that peer_id is no longer reachable through us '''
+		if not self.parent_port:
+			return
+		if self.pending_adverts:
+			# so the parent does not get an advertisement after the withdraw
+			self.flush_advertisements()
+		packet = Packet(PacketType.WITHDRAW, self.id, self.parent_id, peer_id)
+		self.send_packet_to_peer(self.parent_port, packet)
+
+	def set_parent(self, peer_id, port, number=None):
+		if self.parent_port:
+			self.detector.remove(self.parent_port)
+		self.parent_id, self.parent_port = peer_id, port
+		if peer_id is not None:
+			self.known_peers[peer_id] = port
+			if number:
+				self.directory[peer_id] = number
+
+	def remove_neighbor(self, peer_id, dead=False):
+		''' forget our parent or a child. routes through a child are withdrawn up the tree '''
+		if peer_id == self.parent_id:
+			self.set_parent(None, None)
+		else:
+			port = self.known_peers.get(peer_id)
+			self.detector.remove(port)
+			self.children_subtree.pop(peer_id, None)
+			for number, child_port in list(self.child_ports.items()):
+				if child_port == port:
+					del self.child_ports[number]
+			if self.routing_table.get(peer_id) == port:
+				del self.routing_table[peer_id]
+				if not self.heap_routing:
+					self.withdraw_from_parent(peer_id)
+		if dead:
+			self.known_peers.pop(peer_id, None)
+			self.directory.pop(peer_id, None)
+			self.route_cache.evict(peer_id)
+		elif peer_id in self.known_peers:
+			self.known_peers[peer_id] = None
+
+	def tree_neighbors(self):
+		''' list of (peer_id, listening port) of our parent and children '''
+		neighbors = [(child, self.known_peers.get(child)) for child in self.children_subtree]
+		if self.parent_port:
+			neighbors.append((self.parent_id, self.parent_port))
+		return neighbors
+
+	def start_heartbeats(self):
+		if not self.heartbeating:
+			self.heartbeating = True
+			self.call_later(FailureDetector.HEARTBEAT_INTERVAL, self.heartbeat_tick)
+
+	def heartbeat_tick(self):
+		''' send a heartbeat to every tree neighbor, report the ones that went quiet and schedule the next tick '''
+		if not self.heartbeating:
+			return
+		try:
+			now = self.clock()
+			for peer_id, port in self.tree_neighbors():
+				if port is None:
+					continue
+				if self.detector.suspect(port, now):
+					self.neighbor_down(peer_id, port)
+				else:
+					self.send_packet_to_peer(port, Packet(PacketType.HEARTBEAT, self.id, peer_id, ''))
+		finally:
+			# an error in one tick must not stop the heartbeats
+			self.call_later(FailureDetector.HEARTBEAT_INTERVAL, self.heartbeat_tick)
+
+	def neighbor_down(self, peer_id, port):
+		''' a tree neighbor stopped sending heartbeats: drop it and have admin repair the tree '''
+		self.metrics.count('neighbors_down')
+		dprint(f"neighbor {peer_id} on port {port} is down")
+		self.remove_neighbor(peer_id, dead=True)
+		self.ask_admin_then(f"{self.id} REPORTS {peer_id} DOWN", self.repair)
+
+	def repair(self, msg):
+		''' admin's answer to a report of a dead neighbor '''
+		# REHOME moved_id moved_port number parent children: pass it on to the peer that moves
+		if msg is not None and re.match('REHOME ', msg, flags=re.IGNORECASE):
+			_, moved_id, moved_port = msg.split()[:3]
+			if moved_id == self.id:
+				self.rehome(msg)
+			else:
+				self.send_packet_to_peer(int(moved_port), Packet(PacketType.REHOME, self.id, moved_id, msg))
+
+	def confirm_rehome(self, order, msg):
+		''' admin's answer to WHERE IS us, after a peer told us to move. move if admin has us at the new number '''
+		if msg is not None and re.fullmatch('(\w+) IS NUMBER (\d+)', msg, flags=re.IGNORECASE) \
+				and msg.split()[-1] == order.split()[3]:
+			self.rehome(order)
+		else:
+			dprint(f"admin did not confirm rehome: {order}, answer: {msg}")
+
+	def rehome(self, msg):
+		''' take the place of a dead peer as admin decided: leave our parent, join the new one and adopt the children '''
+		parts = msg.split()
+		number = int(parts[3])
+		if number == self.number:
+			return  # already moved
+		if self.parent_port:
+			self.send_packet_to_peer(self.parent_port, Packet(PacketType.LEAVE, self.id, self.parent_id, str(self.number)))
+		parent_id, parent_port = parts[4].split(':')
+		if parent_id == '-1':
+			self.set_parent(None, None)
+		else:
+			self.set_parent(parent_id, int(parent_port))
+		self.number = number
+		self.fingers = {}
+		self.join_network()
+
+		# our new children are number * 2 and number * 2 + 1, in this order
+		for i, child in enumerate(parts[5:]):
+			child_id, child_port = child.split(':')
+			self.known_peers[child_id] = int(child_port)
+			self.child_ports[number * 2 + i] = int(child_port)
+			self.directory[child_id] = number * 2 + i
+			if not self.heap_routing:
+				self.advertise_to_parent(child_id)
+			self.add_new_child(child_id)
+			packet = Packet(PacketType.ADOPT, self.id, child_id, f"{self.listening_port} {number}")
+			self.send_packet_to_peer(int(child_port), packet)
 
 	def get_sending_port_from_listening_port(self, listening_port):
 		return listening_port + 1
@@ -131,45 +526,204 @@ class Peer(BaseSenderReceiver):
 	def are_ports_for_same_peer(self, listen_port, sending_port):
 		return self.get_listen_port_from_sending_port(sending_port) == listen_port
 
+	def send_packet_to_peers(self, peer_ports, packet):
+		''' check firewall and serialize packet once, then send it to all ports in one batch '''
+		if not peer_ports:
+			return True
+		try:
+			if self.firewall_check(packet, flag=True):
+				if self.reliable:
+					# sequence numbers are per link, so each neighbor gets its own frame
+					data = self.encode_packet(packet)
+					for port in peer_ports:
+						self.channel.send(port, data)
+				elif self.coalesce:
+					data = self.encode_packet(packet)
+					for port in peer_ports:
+						self.coalescer.add(port, data)
+				else:
+					self.send_packet_batch(self.sending_socket, packet, [(self.host, port) for port in peer_ports])
+				self.metrics.count('sent', packet.type, len(peer_ports))
+			else:
+				self.metrics.count('output_dropped', packet.type)
+		except OSError as e:
+			self.metrics.count('send_failed', packet.type, len(peer_ports))
+			dprint(f"could not send packet: {packet} to ports {peer_ports}, err: {e}")
+			return False
+		return True
+
 	def send_packet_to_all(self, packet: Packet, sender_port=None):
+		ports = []
 		for child in self.children_subtree.keys():
 			if not self.are_ports_for_same_peer(self.known_peers[child], sender_port):
-				dprint(
-					f'route packet with source {packet.source} and destination {packet.destination} to CHILD {child} with port {self.known_peers[child]}',
-					level=3)
-				self.send_packet_to_peer(self.known_peers[child], packet)
+				if log.level >= 3:
+					log.write(3, 'route packet with source %s and destination %s to CHILD %s with port %s',
+							  packet.source, packet.destination, child, self.known_peers[child])
+				ports.append(self.known_peers[child])
 
 		if self.parent_port:
 			if not self.are_ports_for_same_peer(self.parent_port, sender_port):
-				dprint(
-					f'route packet with source {packet.source} and destination {packet.destination} to PARENT {self.parent_id} with port {self.parent_port}',
-					level=3)
-				self.send_packet_to_peer(self.parent_port, packet)
+				if log.level >= 3:
+					log.write(3, 'route packet with source %s and destination %s to PARENT %s with port %s',
+							  packet.source, packet.destination, self.parent_id, self.parent_port)
+				ports.append(self.parent_port)
+
+		self.send_packet_to_peers(ports, packet)
+
+	def in_subtree(self, number):
+		''' True if heap number is known to be in our subtree '''
+		return bool(number and self.number and Network.in_subtree(self.number, number))
+
+	def get_child_port(self, destination, dst_number=0):
+		''' port of the child whose subtree has destination, None if there is not one '''
+		if dst_number and self.number:
+			if dst_number == self.number or not self.in_subtree(dst_number):
+				return None
+			# child of ours on the path is destination number without its lower bits
+			child = dst_number >> (Network.depth(dst_number) - Network.depth(self.number) - 1)
+			return self.child_ports.get(child)
+
+		return self.routing_table.get(destination)
+
+	def shortcut_port(self, dst_number):
+		'''
+		port of the shortcut link or tree neighbor whose heap number is closest to dst_number, None if
+		none is closer than we are. every hop gets closer, so packets can not loop
+		'''
+		best, best_port = abs(self.number - dst_number), None
+		for links in (self.fingers, self.child_ports):
+			for number, port in links.items():
+				distance = abs(number - dst_number)
+				if distance < best:
+					best, best_port = distance, port
+		if self.parent_port and abs(Network.parent(self.number) - dst_number) < best:
+			best_port = self.parent_port
+		return best_port
+
+	def add_shortcuts(self):
+		''' ask admin for our shortcut links and tell them about us '''
+		self.ask_admin_then(f"SHORTCUTS OF {self.id}", self.link_shortcuts)
+
+	def link_shortcuts(self, msg):
+		if msg is None or not re.fullmatch('SHORTCUTS( \w+:\d+:\d+)*', msg, flags=re.IGNORECASE):
+			return
+		for link in msg.split()[1:]:
+			peer_id, number, port = link.split(':')
+			self.fingers[int(number)] = int(port)
+			self.directory[peer_id] = int(number)
+			packet = Packet(PacketType.SHORTCUT, self.id, peer_id, f"{self.listening_port} {self.number}")
+			self.send_packet_to_peer(int(port), packet)
+
+	def ask_admin(self, msg):
+		''' send one request to admin and return its response '''
+		with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as admin:  # TCP
+			admin.connect((self.admin_host, self.admin_port))
+			self.send(admin, msg)
+			return self.receive(admin)
+
+	def ask_admin_then(self, msg, callback):
+		'''
+		send one request to admin and call callback with its response, or with None if admin could
+		not be reached. We wait for the answer, AsyncPeer asks without blocking its loop.
+		'''
+		try:
+			response = self.ask_admin(msg)
+		except OSError as e:
+			dprint(f"could not ask admin: {msg}, err: {e}")
+			response = None
+		callback(response)
+
+	def resolve(self, peer_id, then):
+		''' ask admin for heap number of an unknown peer, then call then(True if found) '''
+		if not self.heap_routing or not self.number:
+			then(False)
+			return
+		self.ask_admin_then(f"WHERE IS {peer_id}", lambda msg: then(self.learn_number(peer_id, msg)))
+
+	def learn_number(self, peer_id, msg):
+		''' take admin's answer to WHERE IS peer_id. return True if it had the number '''
+		if msg is None or not re.fullmatch('(\w+) IS NUMBER (\d+)', msg, flags=re.IGNORECASE):
+			return False
+		self.directory[peer_id] = int(msg.split()[-1])
+		self.add_to_known_peers(peer_id)
+		return True
+
+	def resolve_all(self, peer_ids, then):
+		''' resolve each of peer_ids, then call then(set of the ones admin did not know) '''
+		waiting, not_found = set(peer_ids), set()
+		if not waiting:
+			then(not_found)
+			return
+
+		def answered(peer_id, found):
+			waiting.discard(peer_id)
+			if not found:
+				not_found.add(peer_id)
+			if not waiting:
+				then(not_found)
+
+		for peer_id in list(waiting):
+			self.resolve(peer_id, lambda found, peer_id=peer_id: answered(peer_id, found))
+
+	def needs_lookup(self, peer_id, originated):
+		''' True if we have to ask admin about peer_id before we send it something '''
+		if originated and peer_id not in self.known_peers:
+			return True
+		# in heap mode packets we send carry the destination's number
+		return self.heap_routing and peer_id not in self.directory
 
 	def route_packet(self, packet: Packet, sender_port=None):
+		''' route a packet, once admin told us where its destination is if we did not know '''
+		if packet.destination != '-1' and packet.source == self.id \
+				and self.needs_lookup(packet.destination, not sender_port):
+			self.resolve(packet.destination, lambda found: self.route_resolved(packet, sender_port, found))
+			return True
+		return self.route_known(packet, sender_port)
+
+	def route_resolved(self, packet: Packet, sender_port, found):
+		if not found and not sender_port and packet.destination not in self.known_peers:
+			self.output(f'Unknown destination {packet.destination}')
+			return False
+		return self.route_known(packet, sender_port)
+
+	def route_known(self, packet: Packet, sender_port=None):
 		if not sender_port:
 			sender_port = self.get_sending_port_from_listening_port(self.listening_port)
 
-			if packet.destination != '-1' and packet.destination not in self.known_peers:
-				print(f'Unknown destination {packet.destination}')
-				return False
+		if self.heap_routing and packet.source == self.id and not packet.src_number:
+			packet.src_number = self.number
+			if packet.destination in self.directory:
+				packet.dst_number = self.directory[packet.destination]
 
 		if packet.destination == '-1':
 			self.send_packet_to_all(packet, sender_port)
 			return True
 
-		for child in self.children_subtree.keys():
-			if packet.destination in self.children_subtree[child]:
-				dprint(
-					f'route packet with source {packet.source} and destination {packet.destination} to CHILD {child} with port {self.known_peers[child]}',
-					level=3)
-				self.send_packet_to_peer(self.known_peers[child], packet)
+		if self.direct_routes and packet.source == self.id and packet.type in DIRECT_TYPES \
+				and self.send_direct(packet):
+			return True
+
+		if self.shortcuts and packet.dst_number:
+			port = self.shortcut_port(packet.dst_number)
+			if port:
+				if log.level >= 3:
+					log.write(3, 'route packet with source %s and destination %s to SHORTCUT with port %s',
+							  packet.source, packet.destination, port)
+				self.send_packet_to_peer(port, packet)
 				return True
 
-		if self.parent_port:
-			dprint(
-				f'route packet with source {packet.source} and destination {packet.destination} to PARENT {self.parent_id} with port {self.parent_port}',
-				level=3)
+		child_port = self.get_child_port(packet.destination, packet.dst_number)
+		if child_port:
+			if log.level >= 3:
+				log.write(3, 'route packet with source %s and destination %s to CHILD with port %s',
+						  packet.source, packet.destination, child_port)
+			self.send_packet_to_peer(child_port, packet)
+			return True
+
+		if self.parent_port and not self.in_subtree(packet.dst_number):
+			if log.level >= 3:
+				log.write(3, 'route packet with source %s and destination %s to PARENT %s with port %s',
+						  packet.source, packet.destination, self.parent_id, self.parent_port)
 			self.send_packet_to_peer(self.parent_port, packet)
 			return True
 
@@ -178,287 +732,787 @@ class Peer(BaseSenderReceiver):
 									  f"DESTINATION {packet.destination} NOT FOUND")
 			self.send_packet_to_peer(self.get_listen_port_from_sending_port(sender_port), not_found_packet)
 
-		dprint(f'could not route packet with source {packet.source} and destination {packet.destination}', level=3)
+		if log.level >= 3:
+			log.write(3, 'could not route packet with source %s and destination %s', packet.source, packet.destination)
 		return False
 
-	def peer_receiving_handler(self, server):
-		''' Receive messages from peers '''
-		while True:
-			try:
-				packet, peer_port = self.receive_packet_from_server(server)
-
-				# If packet is routing response we need to change it before continue
-				if packet.type == PacketType.ROUTING_RESPONSE:
-					if self.are_ports_for_same_peer(self.parent_port, peer_port):
-						new_data = f'{self.id} <- {packet.data}'
-					else:
-						new_data = f'{self.id} -> {packet.data}'
-					packet = Packet(PacketType.ROUTING_RESPONSE, packet.source, packet.destination, new_data)
-
-				# If packet dest is not only us we need to route it
-				if packet.destination != self.id:
-					self.route_packet(packet, peer_port)
-					# If we aren't included in packet dist we pass
-					if packet.destination != '-1':
-						print(f"{packet.type.code} Packet from {packet.source} to {packet.destination}")
-						continue
+	def send_direct(self, packet: Packet):
+		''' send a packet straight to its destination if we know its port. return False to route it through the tree '''
+		now = self.clock()
+		port = self.route_cache.get(packet.destination, now)
+		if port is None:
+			if self.route_cache.miss(packet.destination, now):
+				# the threaded peer has the answer now, AsyncPeer for the next packets
+				self.lookup_port(packet.destination)
+			port = self.route_cache.get(packet.destination, now)
+			if port is None:
+				return False
 
-				self.add_to_known_peers(packet.source)
+		if log.level >= 3:
+			log.write(3, 'route packet with source %s and destination %s DIRECTLY to port %s',
+					  packet.source, packet.destination, port)
+		if not self.send_packet_to_peer(port, packet):
+			self.route_cache.evict(packet.destination)
+			return False
+		self.metrics.count('direct', packet.type)
+		return True
 
-				# If we reach here it means packet is for us
-				if packet.type == PacketType.CONNECTION_REQUEST:
-					peer_port = int(packet.data)
-					self.add_to_known_peers(packet.source, peer_port)
-					self.advertise_to_parent(packet.source)
-					self.add_new_child(packet.source)
+	def lookup_port(self, peer_id):
+		''' ask admin for the listening port of peer_id and cache it '''
+		self.ask_admin_then(f"PORT OF {peer_id}", lambda msg: self.learn_port(peer_id, msg))
 
-				elif packet.type == PacketType.PARENT_ADVERTISE:
-					peer_id = packet.data
-					self.add_to_known_peers(peer_id)
-					self.advertise_to_parent(peer_id)
-					self.add_to_child_subtree(peer_id, packet.source)
+	def learn_port(self, peer_id, msg):
+		if msg is not None and re.fullmatch('(\w+) IS ON PORT (\d+)', msg, flags=re.IGNORECASE):
+			self.route_cache.put(peer_id, int(msg.split()[-1]), self.clock())
 
-				elif packet.type == PacketType.ADVERTISE:
-					peer_id = packet.data
-					self.add_to_known_peers(peer_id)
-					self.add_to_child_subtree(peer_id, packet.source)
+	def is_neighbor(self, peer_port):
+		''' True if peer_port is the sending port of our parent, one of our children or a shortcut link '''
+		if self.are_ports_for_same_peer(self.parent_port, peer_port):
+			return True
+		if any(self.are_ports_for_same_peer(port, peer_port) for port in self.fingers.values()):
+			return True
+		return any(self.are_ports_for_same_peer(self.known_peers.get(child), peer_port) for child in self.children_subtree)
 
-				elif packet.type == PacketType.ROUTING_REQUEST:
-					response_packet = Packet(PacketType.ROUTING_RESPONSE, self.id, packet.source, self.id)
-					self.route_packet(response_packet, peer_port)
+	def handle_packet(self, packet: Packet, peer_port):
+		''' Handle a packet that passed the firewall. peer_port is the port it was sent from '''
+		if self.pool is not None:
+			self.pool.handled(packet)
 
-				elif packet.type == PacketType.ROUTING_RESPONSE and self.current_chatroom == None:
-					print(packet.data)
-
-				elif packet.type == PacketType.DESTINATION_NOT_FOUND and self.current_chatroom == None:
-					print(packet.data)
-
-				elif packet.type == PacketType.MESSAGE:
-					# handling Salam message
-					if packet.data.startswith('SALAM:') and self.current_chatroom == None:
-						hello_msg = packet.data.removeprefix('SALAM:').strip()
-						if re.fullmatch('Salam Salam Sad Ta Salam', hello_msg, flags=re.IGNORECASE):
-							response_msg = "Hezaro Sisad Ta Salam"
-							response_packet = Packet(PacketType.MESSAGE, self.id, packet.source,
-													 f'SALAM:{response_msg}')
-							print(f"{hello_msg} ({packet.source})")
-							self.route_packet(response_packet, peer_port)
-
-						elif re.fullmatch('Hezaro Sisad Ta Salam', hello_msg, flags=re.IGNORECASE):
-							print(f"{hello_msg} ({packet.source})")
-
-					# Chat messages
-					elif packet.data.startswith('CHAT:') and not self.chat_disabled:
-
-						chat_msg = packet.data.removeprefix('CHAT:').strip()
-
-						dprint(
-							f"recieved chat message {chat_msg} - currectly have chatroom: {self.current_chatroom != None}",
-							level=3)
-
-						# If we are not in chatroom
-						if self.current_chatroom is None:
-							dprint(f"we are not in chatroom {chat_msg}", level=2)
-							if re.match('^REQUESTS FOR STARTING CHAT WITH', chat_msg,
-											flags=re.IGNORECASE):
-								chatname_invitor = chat_msg.split(": ")[0].split()[-1]
-								id_invitor = chat_msg.split(": ")[1].split(", ")[0]
-								members = chat_msg.splitlines()[0].split(": ")[1].split(", ")
-								chat_id = int(chat_msg.splitlines()[1])
-
-								print(
-									f"{chatname_invitor} with id {id_invitor} has asked you to join a chat. Would you like to join?[Y/N]")
-								dprint(f"members {members}", level=3)
-
-								self.wait_for_YN += 1
-								self.pending_chat_requests.append((chatname_invitor, id_invitor, members, chat_id))
-
-						# If we are in chatroom
-						else:
-							chat_id_ = int(chat_msg.splitlines()[1])
-							if self.current_chatroom.chat_id == chat_id_:
-								if re.match('^JOIN:', chat_msg, flags=re.IGNORECASE):
-									chat_msg = chat_msg.removeprefix('JOIN:')
-									splited = chat_msg.splitlines()[0].split(':')
-									id_ = splited[0]
-									chat_name = splited[1]
-
-									self.current_chatroom.add_member(id_, chat_name)
-									print(f'{chat_name}({id_}) was joind to the chat.')
-
-									response_msg = f"CHAT:METOO:{self.id}:{self.current_chatroom.my_name}\n{self.current_chatroom.chat_id}"
-									packet = Packet(PacketType.MESSAGE, self.id, id_, response_msg)
-									self.route_packet(packet)
-
-								elif re.match('^METOO:', chat_msg, flags=re.IGNORECASE):
-									chat_msg = chat_msg.removeprefix("METOO:")
-									splited = chat_msg.splitlines()[0].split(':')
-									id_ = splited[0]
-									chat_name = splited[1]
-									self.current_chatroom.add_member(id_, chat_name)
-
-								elif re.match('^NEW:', chat_msg, flags=re.IGNORECASE):
-									peer_id = packet.source
-									peer_chat_name = self.current_chatroom.get_peer_chatname(peer_id)
-									new_chat = chat_msg.removeprefix('NEW:')
-									print(f"{peer_chat_name}: {new_chat.splitlines()[0]}")
-
-								elif re.match('^EXIT CHAT', chat_msg, flags=re.IGNORECASE):
-									exited_peer_id = chat_msg.split()[2]
-									exited_peer_name = self.current_chatroom.get_peer_chatname(exited_peer_id)
-
-									self.current_chatroom.remove_member(exited_peer_id)
-									print(f"{exited_peer_name}({exited_peer_id}) left the chat.")
+		if packet.type == PacketType.HEARTBEAT:
+			self.detector.heartbeat(self.get_listen_port_from_sending_port(peer_port), self.clock())
+			return
 
+		if packet.src_number:
+			self.directory[packet.source] = packet.src_number
 
-			except OSError as e:
-				dprint(f"Error", e)
-				pass
+		# If packet is routing response we need to change it before continue
+		if packet.type == PacketType.ROUTING_RESPONSE:
+			if self.are_ports_for_same_peer(self.parent_port, peer_port):
+				new_data = f'{self.id} <- {packet.data}'
+			else:
+				new_data = f'{self.id} -> {packet.data}'
+			src_number, dst_number = packet.src_number, packet.dst_number
+			packet = Packet(PacketType.ROUTING_RESPONSE, packet.source, packet.destination, new_data)
+			packet.src_number, packet.dst_number = src_number, dst_number
+
+		# Multicast packet is a MESSAGE for us if we are one of its members
+		if packet.type == PacketType.MULTICAST:
+			if not self.route_multicast(packet, peer_port):
+				self.output(f"{packet.type.code} Packet from {packet.source} to {packet.destination}")
+				return
+			packet = Packet(PacketType.MESSAGE, packet.source, self.id, packet.data)
+			if not self.firewall_check(packet, flag=False):
+				self.metrics.count('input_dropped', packet.type)
+				return
+
+		# If packet dest is not only us we need to route it
+		if packet.destination != self.id:
+			self.metrics.count('forwarded', packet.type)
+			self.route_packet(packet, peer_port)
+			# If we aren't included in packet dist we pass. fragments are forwarded as they are and not announced
+			if packet.type == PacketType.FRAGMENT:
+				return
+			if packet.destination != '-1':
+				self.output(f"{packet.type.code} Packet from {packet.source} to {packet.destination}")
+				return
+
+		self.add_to_known_peers(packet.source)
+		if self.direct_routes and packet.type in DIRECT_TYPES and not self.is_neighbor(peer_port):
+			# only the source itself sends to us from outside the tree, answer it the same way
+			self.route_cache.put(packet.source, self.get_listen_port_from_sending_port(peer_port), self.clock())
+
+		# If we reach here it means packet is for us
+		if packet.type == PacketType.CONNECTION_REQUEST:
+			# data is child listening port, and its heap number if it has one
+			if not re.fullmatch('\d+( \d+)?', packet.data):
+				dprint(f"invalid connection request from {packet.source}: {packet.data}")
+				return
+			data = packet.data.split()
+			peer_port = int(data[0])
+			self.add_to_known_peers(packet.source, peer_port)
+			if len(data) > 1:
+				self.child_ports[int(data[1])] = peer_port
+				self.directory[packet.source] = int(data[1])
+			if not self.heap_routing:
+				self.advertise_to_parent(packet.source)
+			self.add_new_child(packet.source)
+
+		elif packet.type == PacketType.PARENT_ADVERTISE:
+			peer_id = packet.data
+			self.add_to_known_peers(peer_id)
+			self.advertise_to_parent(peer_id)
+			self.add_to_child_subtree(peer_id, packet.source)
+
+		elif packet.type == PacketType.ADVERTISE_DELTA:
+			# peers a child learned of in one window: apply them together and pass them on together
+			peer_ids = packet.data.split()
+			if self.aggregate:
+				self.queue_advertisements(peer_ids)
+			else:
+				self.send_advertisements(peer_ids)
+			self.add_subtree(peer_ids, packet.source)
+
+		elif packet.type == PacketType.ADVERTISE:
+			peer_id = packet.data
+			self.add_to_known_peers(peer_id)
+			self.add_to_child_subtree(peer_id, packet.source)
+
+		elif packet.type == PacketType.FRAGMENT:
+			self.receive_fragment(packet)
+
+		elif packet.type == PacketType.SHORTCUT:
+			# data is the listening port and heap number of a peer that links to us
+			if re.fullmatch('\d+ \d+', packet.data):
+				port, number = packet.data.split()
+				self.fingers[int(number)] = int(port)
+				self.directory[packet.source] = int(number)
+
+		elif packet.type == PacketType.ROUTING_REQUEST:
+			response_packet = Packet(PacketType.ROUTING_RESPONSE, self.id, packet.source, self.id)
+			self.route_packet(response_packet, peer_port)
+
+		elif packet.type == PacketType.ROUTING_RESPONSE:
+			# the route is there, from now on we can skip it
+			if self.direct_routes:
+				self.lookup_port(packet.source)
+			if self.current_chatroom == None:
+				self.output(packet.data)
+
+		elif packet.type == PacketType.DESTINATION_NOT_FOUND:
+			# the number or port we had for it is stale, look it up again next time
+			match = re.fullmatch('DESTINATION (\w+) NOT FOUND', packet.data)
+			if match:
+				self.directory.pop(match.group(1), None)
+				self.route_cache.evict(match.group(1))
+			if self.current_chatroom == None:
+				self.output(packet.data)
+
+		elif packet.type == PacketType.WITHDRAW:
+			# a child lost its route to a peer. drop ours if it went through that child and tell our parent
+			peer_id = packet.data
+			if self.routing_table.get(peer_id) == self.get_listen_port_from_sending_port(peer_port):
+				del self.routing_table[peer_id]
+				self.children_subtree.get(packet.source, set()).discard(peer_id)
+				if self.known_peers.get(peer_id, 0) is None:
+					del self.known_peers[peer_id]
+				self.withdraw_from_parent(peer_id)
+
+		elif packet.type == PacketType.REHOME:
+			# a neighbor of a dead peer passes on admin's answer that we take its place. anyone can
+			# send this, so we only move after admin tells us the number itself
+			if not self.heartbeats or not re.fullmatch('REHOME (\w+) (\d+) (\d+) (-?\w+):(-?\d+)( \w+:\d+)*', packet.data) \
+					or packet.data.split()[1] != self.id:
+				dprint(f"ignored rehome from {packet.source}: {packet.data}")
+			else:
+				self.ask_admin_then(f"WHERE IS {self.id}", lambda msg, order=packet.data: self.confirm_rehome(order, msg))
+
+		elif packet.type == PacketType.ADOPT:
+			# our parent died and the peer that took its place is our parent now. data is its port and number
+			if not self.heartbeats or not re.fullmatch('\d+ \d+', packet.data) \
+					or not self.number or int(packet.data.split()[1]) != Network.parent(self.number):
+				dprint(f"ignored adopt from {packet.source}: {packet.data}")
+				return
+			port, number = packet.data.split()
+			self.set_parent(packet.source, int(port), int(number))
+			if not self.heap_routing:
+				if self.aggregate:
+					self.queue_advertisements([peer_id for members in self.children_subtree.values() for peer_id in members])
+				else:
+					for members in self.children_subtree.values():
+						for peer_id in members:
+							self.advertise_to_parent(peer_id)
+
+		elif packet.type == PacketType.LEAVE:
+			# a child moved to the place of a dead peer
+			if packet.source in self.children_subtree:
+				self.remove_neighbor(packet.source)
+
+		elif packet.type == PacketType.MESSAGE:
+			# handling Salam message
+			if packet.data.startswith('SALAM:') and self.current_chatroom == None:
+				hello_msg = packet.data.removeprefix('SALAM:').strip()
+				if re.fullmatch('Salam Salam Sad Ta Salam', hello_msg, flags=re.IGNORECASE):
+					response_msg = "Hezaro Sisad Ta Salam"
+					response_packet = Packet(PacketType.MESSAGE, self.id, packet.source,
+											 f'SALAM:{response_msg}')
+					self.output(f"{hello_msg} ({packet.source})")
+					self.route_packet(response_packet, peer_port)
 
-	def input_handler(self):
-		''' Get inputs from terminal and send messages '''
-		while True:
-			msg = input()
+				elif re.fullmatch('Hezaro Sisad Ta Salam', hello_msg, flags=re.IGNORECASE):
+					self.output(f"{hello_msg} ({packet.source})")
 
-			# Check if any chat request is pending
-			if self.wait_for_YN > 0:
-				self.wait_for_YN -= 1
+			# Chat messages
+			elif packet.data.startswith('CHAT:') and not self.chat_disabled:
 
-				chatname_invitor, id_invitor, members, chat_id = self.pending_chat_requests[0]
-				self.pending_chat_requests = self.pending_chat_requests[1:]
+				chat_msg = packet.data.removeprefix('CHAT:').strip()
+
+				if log.level >= 3:
+					log.write(3, "recieved chat message %s - currectly have chatroom: %s", chat_msg,
+							  self.current_chatroom != None)
 
-				answer = msg
-				if answer == "Y":
-					print("Choose a name for yourself")
-					chat_name = input()
-					response_message = f"CHAT:JOIN:{self.id}:{chat_name}\n{chat_id}"
+				# If we are not in chatroom
+				if self.current_chatroom is None:
+					if log.level >= 2:
+						log.write(2, "we are not in chatroom %s", chat_msg)
+					if re.match('^REQUESTS FOR STARTING CHAT WITH', chat_msg,
+									flags=re.IGNORECASE):
+						chatname_invitor = chat_msg.split(": ")[0].split()[-1]
+						id_invitor = chat_msg.split(": ")[1].split(", ")[0]
+						members = chat_msg.splitlines()[0].split(": ")[1].split(", ")
+						chat_id = int(chat_msg.splitlines()[1])
 
-					self.current_chatroom = Chatroom.Chatroom(chat_name, chat_id)
-					self.current_chatroom.add_member(id_invitor, chatname_invitor)
+						self.output(
+							f"{chatname_invitor} with id {id_invitor} has asked you to join a chat. Would you like to join?[Y/N]")
+						if log.level >= 3:
+							log.write(3, "members %s", members)
 
-					for member_id in members:
-						if member_id != self.id:
-							self.add_to_known_peers(member_id)
-							self.current_chatroom.add_member(member_id)
+						self.wait_for_YN += 1
+						self.pending_chat_requests.append((chatname_invitor, id_invitor, members, chat_id))
 
-							packet = Packet(PacketType.MESSAGE, self.id, member_id, response_message)
+				# If we are in chatroom
+				else:
+					chat_id_ = int(chat_msg.splitlines()[1])
+					if self.current_chatroom.chat_id == chat_id_:
+						if re.match('^JOIN:', chat_msg, flags=re.IGNORECASE):
+							chat_msg = chat_msg.removeprefix('JOIN:')
+							splited = chat_msg.splitlines()[0].split(':')
+							id_ = splited[0]
+							chat_name = splited[1]
+
+							self.current_chatroom.add_member(id_, chat_name)
+							self.output(f'{chat_name}({id_}) was joind to the chat.')
+
+							response_msg = f"CHAT:METOO:{self.id}:{self.current_chatroom.my_name}\n{self.current_chatroom.chat_id}"
+							packet = Packet(PacketType.MESSAGE, self.id, id_, response_msg)
 							self.route_packet(packet)
 
-					self.pending_chat_requests = []
+						elif re.match('^METOO:', chat_msg, flags=re.IGNORECASE):
+							chat_msg = chat_msg.removeprefix("METOO:")
+							splited = chat_msg.splitlines()[0].split(':')
+							id_ = splited[0]
+							chat_name = splited[1]
+							self.current_chatroom.add_member(id_, chat_name)
+
+						elif re.match('^NEW:', chat_msg, flags=re.IGNORECASE):
+							peer_id = packet.source
+							peer_chat_name = self.current_chatroom.get_peer_chatname(peer_id)
+							new_chat = chat_msg.removeprefix('NEW:')
+							self.output(f"{peer_chat_name}: {new_chat.splitlines()[0]}")
+							self.log_chat(chat_id_, peer_chat_name, new_chat.splitlines()[0])
+
+						elif re.match('^HISTORY:', chat_msg, flags=re.IGNORECASE):
+							# SINCE seq or LAST n, only for members that joined the chatroom
+							spec = chat_msg.removeprefix('HISTORY:').splitlines()[0]
+							if not self.current_chatroom.members.get(packet.source):
+								dprint(f"history request from {packet.source}, not a member of chat {chat_id_}, ignored")
+							elif not re.fullmatch('(SINCE|LAST) \d+', spec, flags=re.IGNORECASE):
+								dprint(f"invalid history request from {packet.source}: {spec}")
+							elif spec.split()[0].upper() == 'SINCE':
+								self.send_history(packet.source, chat_id_, since=int(spec.split()[1]))
+							else:
+								self.send_history(packet.source, chat_id_, last=int(spec.split()[1]))
+
+						elif re.match('^EXIT CHAT', chat_msg, flags=re.IGNORECASE):
+							exited_peer_id = chat_msg.split()[2]
+							exited_peer_name = self.current_chatroom.get_peer_chatname(exited_peer_id)
+
+							self.current_chatroom.remove_member(exited_peer_id)
+							self.output(f"{exited_peer_name}({exited_peer_id}) left the chat.")
+
+
+	def send_file(self, destination, path):
+		''' stream a file to destination in fragments, once we know where it is '''
+		if destination == self.id:
+			self.output(f'Unknown destination {destination}')
+			return False
+		if self.needs_lookup(destination, True):
+			self.resolve(destination, lambda found: self.send_file_resolved(destination, path, found))
+			return True
+		return self.send_file_resolved(destination, path, True)
 
-			elif self.current_chatroom is None:
-				if re.fullmatch('SHOW KNOWN CLIENTS', msg, flags=re.IGNORECASE):
-					for p in self.known_peers.keys():
-						print(p)
+	def send_file_resolved(self, destination, path, found):
+		''' start streaming a file. return False if it can not be sent '''
+		if not found and destination not in self.known_peers:
+			self.output(f'Unknown destination {destination}')
+			return False
+		try:
+			transfer = Bulk.OutgoingTransfer.from_path(destination, path)
+		except OSError as e:
+			self.output(f"ERROR: could not read {path}: {e.strerror}")
+			return False
 
-				elif re.fullmatch('ROUTE (\w+)', msg, flags=re.IGNORECASE):
-					dest_id = msg.split()[1]
+		self.outgoing_transfers.append(transfer)
+		self.pump_transfers()
+		return True
 
-					if dest_id == self.id:
-						print(self.id)
+	def pump_transfers(self):
+		''' hand fragments of outgoing transfers to the reliable channel while it has room for them '''
+		if not self.outgoing_transfers or not self.transfer_lock.acquire(blocking=False):
+			return
+		try:
+			while self.outgoing_transfers and self.channel.pending() < Bulk.PIPELINE:
+				transfer = self.outgoing_transfers[0]
+				payload = transfer.next_fragment()
+				if payload is not None:
+					packet = Packet(PacketType.FRAGMENT, self.id, transfer.destination, None, payload=payload)
+					if self.route_packet(packet):
 						continue
+					self.output(f"ERROR: could not send {transfer.name.decode()} to {transfer.destination}")
+				else:
+					self.output(f"Sent file {transfer.name.decode()} ({transfer.size} bytes) to {transfer.destination}")
+				self.outgoing_transfers.pop(0)
+				transfer.close()
+		finally:
+			self.transfer_lock.release()
 
-					packet = Packet(PacketType.ROUTING_REQUEST, self.id, dest_id, '')
-					self.route_packet(packet)
-
-				elif re.fullmatch('ADVERTISE (-?\w+)', msg, flags=re.IGNORECASE):
-					dest_id = msg.split()[1]
-					packet = Packet(PacketType.ADVERTISE, self.id, dest_id, self.id)
-					self.route_packet(packet)
-
-				elif re.fullmatch('FIlTER (INPUT|OUTPUT|FORWARD) (\w+|[*]) (\w+|[*]) (\w+) (ACCEPT|DROP)', msg,
-								  flags=re.IGNORECASE):
-					direction, id_src, id_dst, typ, action = msg.split()[1:]
-					self.firewall.insert(0, (direction, id_src, id_dst, PacketType.get_packet_type_from_code(typ), action))
-
-				elif re.fullmatch('FW CHAT (ACCEPT|DROP)', msg, flags=re.IGNORECASE):
-					action = msg.split()[-1]
-					if action == "ACCEPT":
-						self.chat_disabled = False
-					elif action == "DROP":
-						self.chat_disabled = True
-
-				elif re.fullmatch('Salam Salam Sad Ta Salam (-?\w+)', msg, flags=re.IGNORECASE):
-					dest_id = msg.split()[-1]
-					packet = Packet(PacketType.MESSAGE, self.id, dest_id, 'SALAM:Salam Salam Sad Ta Salam')
-					self.route_packet(packet)
-
-				elif re.fullmatch('START CHAT (\w+):( ((\w+), )*(\w+))?', msg, flags=re.IGNORECASE):
-					if self.chat_disabled:
-						print('Chat is disabled. Make sure the firewall allows you to chat.')
-						continue
+	def receive_fragment(self, packet):
+		try:
+			done = self.reassembler.add(packet.source, packet.payload, self.clock())
+		except (ValueError, OSError) as e:
+			dprint(f"could not take fragment from {packet.source}, err: {e}")
+			return
+		if done:
+			name, path, size = done
+			if History.history_chat_id(name) is not None:
+				self.show_history(packet.source, path)
+				return
+			self.output(f"Received file {name} ({size} bytes) from {packet.source}: {path}")
+
+	def log_chat(self, chat_id, name, text):
+		''' keep a chat message in the log of its chatroom '''
+		if not self.history:
+			return
+		chat_log = self.chat_logs.get(chat_id)
+		if chat_log is None:
+			os.makedirs(History.HISTORY_DIR, exist_ok=True)
+			chat_log = self.chat_logs[chat_id] = History.ChatLog(os.path.join(History.HISTORY_DIR, f'{self.id}-{chat_id}'))
+		chat_log.append(name, text)
+		if not self.history_flush_scheduled:
+			self.history_flush_scheduled = True
+			self.call_later(History.FLUSH_INTERVAL, self.flush_history)
+
+	def flush_history(self):
+		self.history_flush_scheduled = False
+		for chat_log in list(self.chat_logs.values()):
+			chat_log.flush()
+
+	def send_history(self, destination, chat_id, since=None, last=None):
+		''' stream the messages of a chatroom after since, or the last `last` of them, to destination '''
+		chat_log = self.chat_logs.get(chat_id)
+		reader = chat_log.reader(since, last) if chat_log is not None else History.LogReader([])
+		transfer = Bulk.OutgoingTransfer(destination, History.HISTORY_NAME.format(chat_id=chat_id), reader, reader.size)
+		self.outgoing_transfers.append(transfer)
+		self.pump_transfers()
+
+	def show_history(self, source, path):
+		''' show the messages of a history transfer, read from the received file one at a time '''
+		with open(path, 'rb') as file:
+			size = os.fstat(file.fileno()).st_size
+			shown = 0
+			if size:
+				with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as history:
+					for seq, name, text in History.records(history):
+						self.output(f"[{seq}] {name}: {text}")
+						shown += 1
+		os.remove(path)
+		self.output(f"{shown} messages of history from {source}")
+
+	def stop_capture(self):
+		capture, self.capture = self.capture, None
+		if capture is not None:
+			capture.close()
+			self.output(f"captured {capture.count} datagrams to {capture.path}")
+
+	def multicast(self, members, data):
+		''' send data to all members with one packet per tree branch instead of one packet per member '''
+		members = [member for member in members if member != self.id]
+		# in heap mode a member we only know by id still needs its number, or it is dropped at the root
+		missing = [member for member in members if self.needs_lookup(member, True)]
+		self.resolve_all(missing, lambda not_found: self.send_multicast(members, data, not_found))
+
+	def send_multicast(self, members, data, unknown):
+		destinations = []
+		for member in members:
+			if member in unknown:
+				self.output(f'Unknown destination {member}')
+				continue
+			number = self.directory.get(member) if self.heap_routing else None
+			destinations.append(f'{member}:{number}' if number else member)
 
-					random.seed()
-					chat_id = random.randint(1, 1000000)
-					splited = msg.split(": ")
-					chat_name = splited[0].split()[2]
-					possible_members = splited[1].split(", ")
+		if not destinations:
+			return False
 
-					self.current_chatroom = Chatroom.Chatroom(chat_name, chat_id)
+		packet = Packet(PacketType.MULTICAST, self.id, ','.join(destinations), data)
+		if self.heap_routing:
+			packet.src_number = self.number
+		self.route_multicast(packet)
+		return True
 
-					for member in possible_members:
-						if member in self.known_peers:
-							self.current_chatroom.add_member(member)
+	def route_multicast(self, packet: Packet, sender_port=None):
+		'''
+		Forward a multicast packet. Its destination is a comma separated list of members (`id` or
+		`id:heap number`). Members are grouped by next hop and each next hop gets one copy with only
+		its members. return True if we are one of the members.
+		'''
+		from_parent = sender_port is not None and self.are_ports_for_same_peer(self.parent_port, sender_port)
+		destinations = packet.destination.split(',')
+		for_us = False
+		next_hops = {}  # dict of {port: list of destinations}
+		for destination in destinations:
+			member, _, number = destination.partition(':')
+			number = int(number) if number else 0
+			if member == self.id:
+				for_us = True
+				continue
+			# each member used to get its own MESSAGE, so OUTPUT and FORWARD rules for type 00 still decide per member
+			if not self.firewall_check(Packet(PacketType.MESSAGE, packet.source, member, None), flag=True):
+				self.metrics.count('output_dropped', PacketType.MESSAGE)
+				continue
 
-					member_list_msg = self.id
-					for member in self.current_chatroom.members:
-						if member != self.id:
-							member_list_msg += ", "
-							member_list_msg += member
+			port = self.get_child_port(member, number)
+			# never send back up what our parent sent down, that could only loop
+			if not port and self.parent_port and not from_parent and not self.in_subtree(number):
+				port = self.parent_port
+			if port:
+				next_hops.setdefault(port, []).append(destination)
+			else:
+				if log.level >= 3:
+					log.write(3, 'could not route multicast packet with source %s to %s', packet.source, member)
 
-					request_msg = f"CHAT:REQUESTS FOR STARTING CHAT WITH {chat_name}: {member_list_msg}\n{chat_id}"
+		if sender_port is not None and next_hops:
+			self.metrics.count('forwarded', packet.type)
 
-					for member in self.current_chatroom.members:
-						if member != self.id:
-							packet = Packet(PacketType.MESSAGE, self.id, member, request_msg)
-							self.route_packet(packet)
+		for port, port_destinations in next_hops.items():
+			if len(port_destinations) == len(destinations):
+				copy = packet  # whole group goes the same way, relay it as it is
+			else:
+				copy = Packet(PacketType.MULTICAST, packet.source, ','.join(port_destinations), packet.data)
+				copy.src_number = packet.src_number
+			if log.level >= 3:
+				log.write(3, 'route multicast packet with source %s to %s members with port %s',
+						  packet.source, len(port_destinations), port)
+			self.send_packet_to_peer(port, copy)
 
-				else:
-					print("INVALID COMMAND")
+		return for_us
+
+	def peer_receiving_handler(self, server):
+		''' Receive messages from peers and the ones our workers pass on to us, and run timers and commands '''
+		self.wakeup = socket.socketpair()
+		self.wakeup[1].setblocking(False)
+		relay = self.pool.relay if self.pool is not None else None
+		waiting = [server, self.wakeup[0]] + ([relay] if relay is not None else [])
+		while True:
+			try:
+				# wait for a neighbor, a worker or a timer, unless there are packets in the inbox to handle
+				ready = select.select(waiting, [], [], 0 if self.inbox or self.due else None)[0]
+				if self.wakeup[0] in ready:
+					self.wakeup[0].recv(4096)
+				self.run_due()
+				if relay in ready:
+					self.pool.receive_relayed()
+				if server in ready:
+					# handled right away, or queued in the inbox if there is one
+					self.receive_waiting(server)
+				if self.inbox is not None:
+					self.handle_inbox()
+
+			except OSError as e:
+				dprint(f"Error", e)
+				pass
+			except (ValueError, IndexError) as e:
+				# a packet we could not make sense of must not stop the receive thread
+				self.metrics.count('invalid')
+				dprint(f"Error handling packet", e)
+
+	def stats(self, top_rules=None):
+		''' packet counters, receive latency and firewall rule hits as a json-able dict '''
+		stats = self.metrics.snapshot()
+		stats['id'] = self.id
+		rules = self.firewall.rule_hits()
+		if top_rules is not None:
+			rules = sorted((item for item in rules if item[1]), key=lambda item: item[1], reverse=True)[:top_rules]
+		stats['firewall'] = [{'rule': f'{direction} {id_src} {id_dst} {typ.code} {action}', 'hits': hits}
+							 for (direction, id_src, id_dst, typ, action), hits in rules]
+		stats['limits'] = [{'rule': f'{id_src} {getattr(typ, "code", typ)} {rate:g} {burst:g}', 'dropped': dropped}
+						   for (id_src, typ, rate, burst), dropped in self.limiter.rule_drops()]
+		if self.pool is not None:
+			self.pool.merge_stats(stats)
+		return stats
+
+	def stats_response(self, datagram):
+		''' reply to a datagram that reached our stats endpoint, None if it is not a STATS request '''
+		if bytes(datagram).strip().upper() != b'STATS':
+			return None
+		return json.dumps(self.stats(STATS_TOP_RULES)).encode('ascii')
+
+	def stats_handler(self):
+		''' Answer STATS requests (admin scrapes) that arrive on the sending socket '''
+		while True:
+			try:
+				datagram, address = self.sending_socket.recvfrom(MSG_SIZE)
+				response = self.stats_response(datagram)
+				if response:
+					self.sending_socket.sendto(response, address)
+
+			except (OSError, RuntimeError, ValueError) as e:
+				# one failed scrape must not stop us answering the next
+				dprint(f"Error", e)
 
-			# In Chatroom
+	def show_stats(self):
+		stats = self.stats()
+		for name, count in stats['counters'].items():
+			self.output(f"{name} {count}")
+		latency = stats['latency_ns']
+		self.output(f"latency count={latency['count']} mean={latency['mean'] / 1e3:.1f}us p50={latency['p50'] / 1e3:.1f}us "
+					f"p90={latency['p90'] / 1e3:.1f}us p99={latency['p99'] / 1e3:.1f}us max={latency['max'] / 1e3:.1f}us")
+		for rule in stats['firewall']:
+			self.output(f"rule {rule['rule']} hits={rule['hits']}")
+		for rule in stats['limits']:
+			self.output(f"limit {rule['rule']} dropped={rule['dropped']}")
+
+	def handle_command(self, msg):
+		''' Handle one command typed by the user '''
+		if self.pool is not None:
+			self.pool.changed()
+
+		# Check if we asked for a name to join a chat with
+		if self.wait_for_chat_name:
+			self.wait_for_chat_name = 0
+
+			chatname_invitor, id_invitor, members, chat_id = self.pending_chat_requests[0]
+			chat_name = msg
+			response_message = f"CHAT:JOIN:{self.id}:{chat_name}\n{chat_id}"
+
+			self.current_chatroom = Chatroom.Chatroom(chat_name, chat_id)
+			self.current_chatroom.add_member(id_invitor, chatname_invitor)
+
+			for member_id in members:
+				if member_id != self.id:
+					self.add_to_known_peers(member_id)
+					self.current_chatroom.add_member(member_id)
+
+			self.multicast(members, response_message)
+
+			self.pending_chat_requests = []
+
+		# Check if any chat request is pending
+		elif self.wait_for_YN > 0:
+			self.wait_for_YN -= 1
+
+			answer = msg
+			if answer == "Y":
+				self.output("Choose a name for yourself")
+				self.wait_for_chat_name = 1
 			else:
-				if re.fullmatch('EXIT CHAT', msg, flags=re.IGNORECASE):
-					packet_data = f"CHAT:EXIT CHAT {self.id}\n{self.current_chatroom.chat_id}"
-					for member in self.current_chatroom.get_definite_members():
-						packet = Packet(PacketType.MESSAGE, self.id, member, packet_data)
-						self.route_packet(packet)
+				self.pending_chat_requests = self.pending_chat_requests[1:]
 
-					self.current_chatroom = None
+		elif self.current_chatroom is None:
+			if re.fullmatch('SHOW KNOWN CLIENTS', msg, flags=re.IGNORECASE):
+				for p in self.known_peers.keys():
+					self.output(p)
+
+			elif re.fullmatch('SEND FILE (\w+) (.+)', msg, flags=re.IGNORECASE):
+				_, _, dest_id, path = msg.split(maxsplit=3)
+				self.send_file(dest_id, path)
+
+			elif re.fullmatch('SHOW STATS', msg, flags=re.IGNORECASE):
+				self.show_stats()
+
+			elif re.fullmatch('ROUTE (\w+)', msg, flags=re.IGNORECASE):
+				dest_id = msg.split()[1]
+
+				if dest_id == self.id:
+					self.output(self.id)
+					return
+
+				packet = Packet(PacketType.ROUTING_REQUEST, self.id, dest_id, '')
+				self.route_packet(packet)
+
+			elif re.fullmatch('ADVERTISE (-?\w+)', msg, flags=re.IGNORECASE):
+				dest_id = msg.split()[1]
+				packet = Packet(PacketType.ADVERTISE, self.id, dest_id, self.id)
+				self.route_packet(packet)
+
+			elif re.fullmatch('FIlTER (INPUT|OUTPUT|FORWARD) (\w+|[*]) (\w+|[*]) (\w+) (ACCEPT|DROP)', msg,
+							  flags=re.IGNORECASE):
+				direction, id_src, id_dst, typ, action = msg.split()[1:]
+				self.firewall.add_rule(direction, id_src, id_dst, PacketType.get_packet_type_from_code(typ), action)
+
+			elif re.fullmatch('LIMIT (\w+|[*]) (\d+|[*]) (\d+(?:\.\d+)?) (\d+)', msg, flags=re.IGNORECASE):
+				id_src, typ, rate, burst = msg.split()[1:]
+				if typ != '*':
+					typ = PacketType.get_packet_type_from_code(typ)
+					if typ is None:
+						self.output("INVALID COMMAND")
+						return
+				self.limiter.add_rule(id_src, typ, rate, burst)
+
+			elif re.fullmatch('CAPTURE ON (\S+)(?: (\d+))?', msg, flags=re.IGNORECASE):
+				msg_arr = msg.split()
+				self.stop_capture()
+				try:
+					self.capture = CaptureRing(msg_arr[2], *(int(slots) for slots in msg_arr[3:]))
+				except (OSError, ValueError) as e:
+					self.output(f"could not capture to {msg_arr[2]}: {e}")
 
-				else:
-					packet_data = f"CHAT:NEW:{msg}\n{self.current_chatroom.chat_id}"
-					for member in self.current_chatroom.get_definite_members():
-						packet = Packet(PacketType.MESSAGE, self.id, member, packet_data)
-						self.route_packet(packet)
+			elif re.fullmatch('CAPTURE OFF', msg, flags=re.IGNORECASE):
+				self.stop_capture()
+
+			elif re.fullmatch('LOG LEVEL (\d+)', msg, flags=re.IGNORECASE):
+				log.level = int(msg.split()[-1])
+
+			elif re.fullmatch('LOG FORMAT (TEXT|JSON)', msg, flags=re.IGNORECASE):
+				log.json_lines = msg.split()[-1].upper() == 'JSON'
+
+			elif re.fullmatch('FW CHAT (ACCEPT|DROP)', msg, flags=re.IGNORECASE):
+				action = msg.split()[-1]
+				if action == "ACCEPT":
+					self.chat_disabled = False
+				elif action == "DROP":
+					self.chat_disabled = True
+
+			elif re.fullmatch('Salam Salam Sad Ta Salam (-?\w+)', msg, flags=re.IGNORECASE):
+				dest_id = msg.split()[-1]
+				packet = Packet(PacketType.MESSAGE, self.id, dest_id, 'SALAM:Salam Salam Sad Ta Salam')
+				self.route_packet(packet)
+
+			elif re.fullmatch('START CHAT (\w+):( ((\w+), )*(\w+))?', msg, flags=re.IGNORECASE):
+				if self.chat_disabled:
+					self.output('Chat is disabled. Make sure the firewall allows you to chat.')
+					return
+
+				random.seed()
+				chat_id = random.randint(1, 1000000)
+				splited = msg.split(": ")
+				chat_name = splited[0].split()[2]
+				possible_members = splited[1].split(", ")
+
+				self.current_chatroom = Chatroom.Chatroom(chat_name, chat_id)
+
+				for member in possible_members:
+					if member in self.known_peers:
+						self.current_chatroom.add_member(member)
+
+				member_list_msg = self.id
+				for member in self.current_chatroom.members:
+					if member != self.id:
+						member_list_msg += ", "
+						member_list_msg += member
+
+				request_msg = f"CHAT:REQUESTS FOR STARTING CHAT WITH {chat_name}: {member_list_msg}\n{chat_id}"
+
+				self.multicast(self.current_chatroom.members, request_msg)
+
+			else:
+				self.output("INVALID COMMAND")
+
+		# In Chatroom
+		else:
+			if re.fullmatch('EXIT CHAT', msg, flags=re.IGNORECASE):
+				packet_data = f"CHAT:EXIT CHAT {self.id}\n{self.current_chatroom.chat_id}"
+				self.multicast(self.current_chatroom.get_definite_members(), packet_data)
+
+				self.current_chatroom = None
+
+			# the leading / keeps chat lines like "history of 3" from being read as commands
+			elif re.fullmatch('/HISTORY (\d+)', msg, flags=re.IGNORECASE):
+				chat_log = self.chat_logs.get(self.current_chatroom.chat_id)
+				if chat_log is not None:
+					for seq, name, text in chat_log.replay(last=int(msg.split()[1])):
+						self.output(f"[{seq}] {name}: {text}")
+
+			elif re.fullmatch('/HISTORY (\w+) (\d+|SINCE \d+)', msg, flags=re.IGNORECASE):
+				# ask a member for the last n messages, or for the ones after a sequence number of theirs
+				msg_arr = msg.split()
+				spec = f"SINCE {msg_arr[-1]}" if len(msg_arr) == 4 else f"LAST {msg_arr[-1]}"
+				packet = Packet(PacketType.MESSAGE, self.id, msg_arr[1], f"CHAT:HISTORY:{spec}\n{self.current_chatroom.chat_id}")
+				self.route_packet(packet)
+
+			else:
+				packet_data = f"CHAT:NEW:{msg}\n{self.current_chatroom.chat_id}"
+				self.multicast(self.current_chatroom.get_definite_members(), packet_data)
+				self.log_chat(self.current_chatroom.chat_id, self.current_chatroom.my_name, msg)
+
+	def input_handler(self):
+		''' Get inputs from terminal and send messages '''
+		while True:
+			self.run_on_receiver(self.handle_command, input())
 
 
 	def init_sender(self):
 		sending_port = self.get_sending_port_from_listening_port(self.listening_port)
 		try:
 			self.sending_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
+			if self.workers:
+				self.sending_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 			self.sending_socket.bind((self.host, sending_port))
 		except OSError as e:
-			print(f"ERROR: could not bind sending socket to {sending_port}")
+			self.output(f"ERROR: could not bind sending socket to {sending_port}")
+			return False
+
+		return True
+
+	def start_workers(self, server, spread=FORWARD_SPREAD, quiet=False):
+		''' start forwarding workers on our ports. server is our listening socket, bound with SO_REUSEPORT '''
+		from Workers import WorkerPool  # Workers imports Peer
+		self.pool = WorkerPool(self, self.workers, spread, quiet)
+		self.pool.start(server)
+
+	def connection_message(self):
+		return f"{self.id} REQUESTS FOR CONNECTING TO NETWORK ON PORT {self.listening_port}"
+
+	def handle_admin_response(self, msg):
+		''' Set our parent from admin response. return False if admin did not let us in '''
+		match = re.fullmatch('CONNECT TO (-?\w+) WITH PORT (-?\d+)( AS NUMBER (\d+))?', msg, flags=re.IGNORECASE)
+		if match:
+			self.parent_id = match.group(1) if match.group(1) != '-1' else None
+			self.parent_port = int(match.group(2)) if match.group(1) != '-1' else None
+			self.number = int(match.group(4)) if match.group(4) else None
+			return True
+
+		self.output(msg)
+		return False
+
+	def join_network(self):
+		''' connect to parent and send listening port to parent if it is not root '''
+		if self.parent_id:
+			self.add_to_known_peers(self.parent_id, self.parent_port)
+			if self.number:
+				self.directory[self.parent_id] = Network.parent(self.number)
+			data = f"{self.listening_port} {self.number}" if self.heap_routing and self.number else self.listening_port
+			packet = Packet(PacketType.CONNECTION_REQUEST, self.id, self.parent_id, data)
+			self.send_packet_to_peer(self.parent_port, packet)
+		if self.shortcuts:
+			self.add_shortcuts()
+		if self.heartbeats:
+			self.start_heartbeats()
+
+		dprint('successfully connected to network')
+
+	def set_identity(self, connect_msg):
+		''' set id and listening port from a CONNECT command. return False if it is not one '''
+		if not re.fullmatch('CONNECT AS (\w+) ON PORT (\d+)', connect_msg, flags=re.IGNORECASE):
 			return False
 
+		connect_msg_arr = connect_msg.split()
+		self.id, self.listening_port = connect_msg_arr[2], int(connect_msg_arr[-1])
+		self.add_to_known_peers(self.id, self.listening_port)
 		return True
 
 	def start(self):
 		''' Get inputs from terminal and send messages '''
 		while True:
 			start_msg = input()
-			if re.fullmatch('CONNECT AS (\w+) ON PORT (\d+)', start_msg, flags=re.IGNORECASE):
-				start_msg_arr = start_msg.split()
-				self.id, self.listening_port = start_msg_arr[2], int(start_msg_arr[-1])
-				self.add_to_known_peers(self.id, self.listening_port)
-
+			if self.set_identity(start_msg):
 				try:
 					server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
 					server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+					if self.workers:
+						server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+					server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
 					server.bind((self.host, self.listening_port))  # passing zero will choose a random free port
 				except OSError:
-					print(f"ERROR: could not bind listening socket to {self.host} {self.listening_port}")
+					self.output(f"ERROR: could not bind listening socket to {self.host} {self.listening_port}")
 					continue
 
 				# connect to admin to get parent in network
@@ -466,39 +1520,29 @@ class Peer(BaseSenderReceiver):
 					peer.connect((self.admin_host, self.admin_port))
 					dprint(f"Peer is connected to admin {self.admin_host}:{self.admin_port}")
 
-					conn_msg = f"{self.id} REQUESTS FOR CONNECTING TO NETWORK ON PORT {self.listening_port}"
-					self.send(peer, conn_msg)
-
-					msg = self.receive(peer)
-					if re.fullmatch('CONNECT TO (-?\w+) WITH PORT (-?\d+)', msg, flags=re.IGNORECASE):
-						msg_splited = msg.split()
-						self.parent_id = msg_splited[2] if msg_splited[2] != '-1' else None
-						self.parent_port = int(msg_splited[-1]) if msg_splited[2] != '-1' else None
-					else:
-						print(msg)
+					self.send(peer, self.connection_message())
+					if not self.handle_admin_response(self.receive(peer)):
 						continue
 
-				# start listening for incoming messages from peers
-				thread = threading.Thread(target=self.peer_receiving_handler, args=[server])
-				thread.start()
-
 				# init sending socket
 				if not self.init_sender():
 					continue
+				threading.Thread(target=self.stats_handler, daemon=True).start()
+				# before the receive loop starts, so it waits on what workers relay too
+				if self.workers:
+					self.start_workers(server)
 
-				# connect to parent and send listening port to parent if it is not root
-				if self.parent_id:
-					self.add_to_known_peers(self.parent_id, self.parent_port)
-					packet = Packet(PacketType.CONNECTION_REQUEST, self.id, self.parent_id, self.listening_port)
-					self.send_packet_to_peer(self.parent_port, packet)
+				# start listening for incoming messages from peers
+				thread = threading.Thread(target=self.peer_receiving_handler, args=[server])
+				thread.start()
 
-				dprint('successfully connected to network')
+				self.run_on_receiver(self.join_network)
 
 				# start listening for commands
 				self.input_handler()
 
 			else:
-				print("INVALID COMMAND")
+				self.output("INVALID COMMAND")
 
 
 if __name__ == "__main__":
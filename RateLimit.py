@@ -0,0 +1,66 @@
+import threading
+
+MAX_BUCKETS = 65536  # token buckets kept, the oldest ones are dropped (a dropped bucket starts over full)
+
+
+class RateLimiter:
+	'''
+	Token buckets for packets we receive, one per source and rule. A rule gives a rate (packets per
+	second) and a burst (size of the bucket) to the packets of a source and type; `*` matches any
+	source or type. A `*` source rule still gives every source a bucket of its own, so one peer that
+	floods us only uses up its own tokens. A `*` type rule shares one bucket between all types.
+
+	Each packet is charged to the most specific rule that matches it: (source, type), (source, *),
+	(*, type), then (*, *). A packet that finds its bucket empty is dropped.
+	'''
+	def __init__(self, max_buckets=MAX_BUCKETS):
+		self.max_buckets = max_buckets
+		self.rules = {}  # dict of {(id_src, packet type or '*'): [rate, burst, packets dropped]}
+		self.buckets = {}  # dict of {((id_src, type), source): [tokens, time of last refill]}, oldest first
+		self.lock = threading.Lock()  # the threaded peer adds rules from its input thread
+
+	def __len__(self):
+		return len(self.rules)
+
+	def add_rule(self, id_src, typ, rate, burst):
+		''' limit packets from id_src of type typ (a PacketType or '*') to rate per second, bursts of burst '''
+		with self.lock:
+			key = (id_src, typ)
+			self.rules[key] = [float(rate), float(burst), 0]
+			# buckets of an older rule with the same key start over with the new burst
+			for bucket_key in [bucket_key for bucket_key in self.buckets if bucket_key[0] == key]:
+				del self.buckets[bucket_key]
+
+	def match(self, typ, source):
+		''' key of the rule that limits packets from source of type typ, or None '''
+		for key in ((source, typ), (source, '*'), ('*', typ), ('*', '*')):
+			if key in self.rules:
+				return key
+		return None
+
+	def allow(self, typ, source, now):
+		''' take a token for a packet. return False if it should be dropped '''
+		with self.lock:
+			key = self.match(typ, source)
+			if key is None:
+				return True
+			rule = self.rules[key]
+			bucket_key = (key, source)
+			bucket = self.buckets.get(bucket_key)
+			if bucket is None:
+				bucket = self.buckets[bucket_key] = [rule[1], now]
+				if len(self.buckets) > self.max_buckets:
+					del self.buckets[next(iter(self.buckets))]
+			else:
+				bucket[0] = min(bucket[0] + (now - bucket[1]) * rule[0], rule[1])
+				bucket[1] = now
+			if bucket[0] >= 1:
+				bucket[0] -= 1
+				return True
+			rule[2] += 1
+			return False
+
+	def rule_drops(self):
+		''' list of ((id_src, type, rate, burst), packets dropped) in the order rules were added '''
+		with self.lock:
+			return [((id_src, typ, rate, burst), dropped) for (id_src, typ), (rate, burst, dropped) in self.rules.items()]
@@ -0,0 +1,255 @@
+import collections
+import random
+import struct
+import threading
+
+LINK_MAGIC = 0xCF  # first byte of a reliable channel frame. packets start with WIRE_MAGIC or an ascii digit
+KIND_DATA = 0
+KIND_ACK = 1
+# magic, kind, epoch, sequence number. DATA frames carry an encoded packet after it
+FRAME_HEADER = struct.Struct('!BBHI')
+# ACK frames: FRAME_HEADER with the cumulative ack (every sequence number below it was received) as
+# sequence number, then the number of SACK blocks and [start, end) of each
+SACK_COUNT = struct.Struct('!B')
+SACK_BLOCK = struct.Struct('!II')
+
+WINDOW = 64  # frames in flight per link
+BACKLOG = 4096  # frames waiting for the window per link, newer ones are dropped
+MAX_SACK_BLOCKS = 4
+DUP_THRESH = 3  # a frame is lost once this many frames sent after it were acked
+RTO_INITIAL = 0.2  # seconds, before the first RTT sample
+RTO_MIN = 0.01  # loopback and LAN RTTs are far below the 1 s of RFC 6298
+RTO_MAX = 10.0
+
+
+class ReliableLink:
+	''' Sending and receiving state of the channel with one neighbor '''
+	__slots__ = ('next_seq', 'in_flight', 'backlog', 'srtt', 'rttvar', 'rto', 'deadline', 'timer_armed',
+				 'peer_epoch', 'cumulative', 'above')
+
+	def __init__(self):
+		# sending
+		self.next_seq = 0
+		self.in_flight = {}  # dict of {seq: [frame, time sent, retransmitted]} in seq order
+		self.backlog = collections.deque()  # encoded packets waiting for room in the window
+		self.srtt = None
+		self.rttvar = None
+		self.rto = RTO_INITIAL
+		self.deadline = 0  # time the oldest frame in flight times out
+		self.timer_armed = False
+
+		# receiving
+		self.peer_epoch = None
+		self.cumulative = 0  # every seq below it was received
+		self.above = set()  # received seqs above cumulative
+
+
+class ReliableChannel:
+	'''
+	Reliable delivery over UDP to neighbors, one sliding window per neighbor link.
+
+	Every frame has a sequence number. The receiver answers each DATA frame with an ACK that has its
+	cumulative ack and up to MAX_SACK_BLOCKS ranges it got above it (selective acks), and drops
+	duplicates. The sender keeps up to `window` frames in flight and resends a frame when DUP_THRESH
+	frames after it were acked, one of them sent after it (fast retransmit, no need to wait for a
+	timeout, and a lost resend is found the same way), or when its retransmission timeout passes.
+	The timeout adapts to the measured RTT as in RFC 6298 (Karn's rule: no samples from retransmitted
+	frames) and backs off exponentially.
+
+	Frames are handed up as they arrive, out of order if some are lost: packets never depended on
+	order, and waiting for a lost frame would hold back every frame after it.
+
+	Links are keyed by the neighbor's listening port. A random epoch per channel lets a neighbor see
+	that we restarted and our sequence numbers start over.
+	'''
+	def __init__(self, send_frame, call_later, clock, window=WINDOW, metrics=None, on_acked=None):
+		self.send_frame = send_frame  # send_frame(frame bytes, port)
+		self.call_later = call_later  # call_later(delay seconds, callback, *args)
+		self.clock = clock
+		self.on_acked = on_acked  # on_acked() after an ack made room, e.g. to queue more frames
+		self.window = window
+		self.metrics = metrics
+		self.epoch = random.getrandbits(16)
+		self.links = {}  # dict of {neighbor listening port: ReliableLink}
+		self.lock = threading.Lock()  # the threaded peer sends, receives and times out on different threads
+
+	def link(self, port):
+		link = self.links.get(port)
+		if link is None:
+			link = self.links[port] = ReliableLink()
+		return link
+
+	def count(self, event, n=1):
+		if self.metrics is not None:
+			self.metrics.count(event, None, n)
+
+	def send(self, port, data):
+		''' send an encoded packet to the neighbor listening on port '''
+		with self.lock:
+			link = self.link(port)
+			if len(link.in_flight) < self.window and not link.backlog:
+				self.transmit(port, link, data)
+			elif len(link.backlog) < BACKLOG:
+				link.backlog.append(data)
+			else:
+				self.count('reliable_overflow')
+
+	def transmit(self, port, link, data):
+		seq = link.next_seq
+		link.next_seq += 1
+		frame = FRAME_HEADER.pack(LINK_MAGIC, KIND_DATA, self.epoch, seq) + data
+		link.in_flight[seq] = [frame, self.clock(), False]
+		if not link.timer_armed:
+			link.deadline = self.clock() + link.rto
+			self.arm(port, link, link.rto)
+		self.send_frame(frame, port)
+
+	def arm(self, port, link, delay):
+		link.timer_armed = True
+		self.call_later(delay, self.on_timer, port)
+
+	def on_timer(self, port):
+		with self.lock:
+			link = self.links.get(port)
+			if link is None:
+				return
+			link.timer_armed = False
+			if not link.in_flight:
+				return
+			now = self.clock()
+			if now < link.deadline:
+				self.arm(port, link, link.deadline - now)
+				return
+
+			# timeout: resend the oldest frame and back off
+			seq, entry = next(iter(link.in_flight.items()))
+			entry[1], entry[2] = now, True
+			link.rto = min(link.rto * 2, RTO_MAX)
+			link.deadline = now + link.rto
+			self.count('reliable_timeouts')
+			self.count('retransmitted')
+			self.arm(port, link, link.rto)
+			self.send_frame(entry[0], port)
+
+	def receive(self, datagram, port):
+		''' handle a frame from the neighbor listening on port. return the packet bytes it carries, or None '''
+		try:
+			_, kind, epoch, seq = FRAME_HEADER.unpack_from(datagram)
+		except struct.error:
+			return None
+		if kind == KIND_ACK:
+			self.receive_ack(datagram, port, epoch, seq)
+			return None
+
+		with self.lock:
+			link = self.link(port)
+			if link.peer_epoch != epoch:
+				link.peer_epoch, link.cumulative, link.above = epoch, 0, set()
+
+			duplicate = seq < link.cumulative or seq in link.above
+			if not duplicate:
+				if seq == link.cumulative:
+					link.cumulative += 1
+					while link.cumulative in link.above:
+						link.above.remove(link.cumulative)
+						link.cumulative += 1
+				else:
+					link.above.add(seq)
+			ack = self.ack_frame(link, epoch)
+
+		self.send_frame(ack, port)
+		if duplicate:
+			self.count('duplicates')
+			return None
+		return datagram[FRAME_HEADER.size:]
+
+	def ack_frame(self, link, epoch):
+		blocks = []
+		for seq in sorted(link.above):
+			if blocks and blocks[-1][1] == seq:
+				blocks[-1][1] = seq + 1
+			elif len(blocks) < MAX_SACK_BLOCKS:
+				blocks.append([seq, seq + 1])
+			else:
+				break
+		return b''.join([FRAME_HEADER.pack(LINK_MAGIC, KIND_ACK, epoch, link.cumulative), SACK_COUNT.pack(len(blocks))] +
+						[SACK_BLOCK.pack(start, end) for start, end in blocks])
+
+	def receive_ack(self, datagram, port, epoch, cumulative):
+		if epoch != self.epoch:
+			return
+		try:
+			count, = SACK_COUNT.unpack_from(datagram, FRAME_HEADER.size)
+			blocks = [SACK_BLOCK.unpack_from(datagram, FRAME_HEADER.size + SACK_COUNT.size + i * SACK_BLOCK.size)
+					  for i in range(count)]
+		except struct.error:
+			return
+
+		with self.lock:
+			if not self.handle_ack(port, cumulative, blocks):
+				return
+		if self.on_acked is not None:
+			self.on_acked()
+
+	def handle_ack(self, port, cumulative, blocks):
+		''' drop acked frames, resend lost ones and fill the window. return True if something was acked '''
+		link = self.links.get(port)
+		if link is None or not link.in_flight:
+			return False
+		now = self.clock()
+		highest = cumulative - 1
+
+		# frames below the cumulative ack are the oldest in flight
+		acked = []
+		for seq in link.in_flight:
+			if seq >= cumulative:
+				break
+			acked.append(seq)
+		# SACK blocks come from the peer, only the part of them that is in flight is looked at
+		oldest = next(iter(link.in_flight))
+		for start, end in blocks:
+			start, end = max(start, oldest), min(end, link.next_seq)
+			if start < end:
+				highest = max(highest, end - 1)
+				acked.extend(seq for seq in range(start, end) if seq in link.in_flight)
+		if not acked:
+			return False
+
+		sample = None
+		newest_sent = None  # latest send time of the frames this ack acked
+		for seq in acked:
+			entry = link.in_flight.pop(seq, None)
+			if entry is None:
+				continue
+			if not entry[2]:
+				sample = now - entry[1]
+			if newest_sent is None or entry[1] > newest_sent:
+				newest_sent = entry[1]
+		if sample is not None:
+			self.update_rto(link, sample)
+		link.deadline = now + link.rto
+
+		# a frame is lost if DUP_THRESH later frames were acked and one of them was sent after it
+		for seq, entry in link.in_flight.items():
+			if seq + DUP_THRESH > highest:
+				break
+			if entry[1] < newest_sent:
+				entry[1], entry[2] = now, True
+				self.count('retransmitted')
+				self.send_frame(entry[0], port)
+
+		while link.backlog and len(link.in_flight) < self.window:
+			self.transmit(port, link, link.backlog.popleft())
+		return True
+
+	def update_rto(self, link, rtt):
+		if link.srtt is None:
+			link.srtt, link.rttvar = rtt, rtt / 2
+		else:
+			link.rttvar = 0.75 * link.rttvar + 0.25 * abs(link.srtt - rtt)
+			link.srtt = 0.875 * link.srtt + 0.125 * rtt
+		link.rto = min(max(link.srtt + 4 * link.rttvar, RTO_MIN), RTO_MAX)
+
+	def pending(self):
+		''' frames in flight or waiting for the window on all links '''
+		return sum(len(link.in_flight) + len(link.backlog) for link in self.links.values())
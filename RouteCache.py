@@ -0,0 +1,65 @@
+import collections
+import threading
+
+CACHE_SIZE = 1024  # destinations a peer keeps, least recently used ones are dropped
+TTL = 30.0  # seconds a cached port is used before it is looked up again
+LOOKUP_AFTER = 3  # packets routed through the tree to a destination before we look up its port
+
+
+class RouteCache:
+	'''
+	Bounded cache of {peer_id: listening port} for sending straight to a peer instead of through
+	the tree. Entries expire after `ttl` seconds and the least recently used entry is dropped when
+	the cache is full.
+
+	A destination whose port is not known yet has an entry with port None that counts the packets
+	sent to it, so a peer only asks admin for the ports of destinations it keeps talking to.
+	'''
+	def __init__(self, size=CACHE_SIZE, ttl=TTL, lookup_after=LOOKUP_AFTER):
+		self.size = size
+		self.ttl = ttl
+		self.lookup_after = lookup_after
+		self.entries = collections.OrderedDict()  # {peer_id: [port or None, expiry time, packets]}, oldest use first
+		self.lock = threading.Lock()  # the threaded peer routes from its input and receiving threads
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, peer_id, now):
+		''' cached port of peer_id, or None if it is not cached or expired '''
+		with self.lock:
+			entry = self.entries.get(peer_id)
+			if entry is None or entry[0] is None:
+				return None
+			if entry[1] <= now:
+				del self.entries[peer_id]
+				return None
+			self.entries.move_to_end(peer_id)
+			return entry[0]
+
+	def miss(self, peer_id, now):
+		''' count a packet routed through the tree to peer_id. return True when it is time to look up its port '''
+		with self.lock:
+			entry = self.entries.get(peer_id)
+			if entry is None or entry[1] <= now:
+				entry = self.insert(peer_id, None, now)
+			else:
+				self.entries.move_to_end(peer_id)
+			entry[2] += 1
+			# ask once, a failed lookup waits for the entry to expire
+			return entry[0] is None and entry[2] == self.lookup_after
+
+	def put(self, peer_id, port, now):
+		with self.lock:
+			self.insert(peer_id, port, now)
+
+	def insert(self, peer_id, port, now):
+		entry = self.entries[peer_id] = [port, now + self.ttl, 0]
+		self.entries.move_to_end(peer_id)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+		return entry
+
+	def evict(self, peer_id):
+		with self.lock:
+			self.entries.pop(peer_id, None)
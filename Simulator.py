@@ -0,0 +1,207 @@
+import heapq
+import random
+
+from Admin import Admin
+from Peer import Peer, PEER_HOST, HEAP_ROUTING, RELIABLE, COALESCE, DIRECT_ROUTES, SHORTCUTS, HEARTBEATS, AGGREGATE_ADVERTS
+
+
+class Link:
+	''' latency (seconds), loss (probability) and bandwidth (bytes per second, None for unlimited) of a link '''
+	__slots__ = ('latency', 'loss', 'bandwidth')
+
+	def __init__(self, latency=0.001, loss=0.0, bandwidth=None):
+		self.latency = latency
+		self.loss = loss
+		self.bandwidth = bandwidth
+
+
+class SimTransport:
+	''' Endpoint bound to a port of a `Simulator`. It has `sendto` like a UDP socket, so peers send through it unchanged '''
+
+	def __init__(self, sim, port, node):
+		self.sim = sim
+		self.port = port
+		self.node = node  # listening port of the peer that owns this endpoint, links are between nodes
+
+	def sendto(self, data, addr):
+		self.sim.send(self, bytes(data), addr[1])
+
+	def close(self):
+		self.sim.unbind(self.port)
+
+
+class Simulator:
+	'''
+	Discrete-event, in-memory stand-in for the UDP network between peers. A datagram sent on a
+	`SimTransport` reaches the endpoint bound to its destination port after the transmission time
+	(size / bandwidth, datagrams queue behind each other on a link) and the latency of the link, or
+	is lost with the link's loss probability.
+
+	Nothing waits in real time: `run` jumps from one event to the next, and admin is called
+	directly instead of over TCP, so trees of 100k peers can be simulated in one process. Runs with
+	the same seed and the same commands are the same.
+	'''
+	def __init__(self, latency=0.001, loss=0.0, bandwidth=None, seed=0):
+		self.now = 0.0
+		self.events = []  # heap of (time, sequence, callback, args)
+		self.sequence = 0
+		self.random = random.Random(seed)
+
+		self.default_link = Link(latency, loss, bandwidth)
+		self.links = {}  # dict of {(node, node): Link}, smaller node first. links not in it are default_link
+		self.link_free = {}  # dict of {(from node, to node): time the link is done sending what it has}
+		self.endpoints = {}  # dict of {port: (on_datagram(data, source port), node)}
+
+		self.admin = Admin(max_port=2 ** 32 - 1)  # network ports are 32 bit
+		self.peers = {}  # dict of {peer_id: SimPeer}
+
+		self.sent = 0
+		self.delivered = 0
+		self.lost = 0
+
+	def schedule(self, delay, callback, *args):
+		heapq.heappush(self.events, (self.now + delay, self.sequence, callback, args))
+		self.sequence += 1
+
+	def run(self, until=None, max_events=None):
+		''' process events in time order until there are none left, or until time `until`. return the count '''
+		events = 0
+		while self.events and (max_events is None or events < max_events):
+			when, _, callback, args = self.events[0]
+			if until is not None and when > until:
+				break
+			heapq.heappop(self.events)
+			self.now = when
+			callback(*args)
+			events += 1
+		if until is not None and self.now < until:
+			self.now = until
+		return events
+
+	def set_link(self, node_a, node_b, latency=None, loss=None, bandwidth=None):
+		''' set latency, loss or bandwidth between two peers (by listening port), both ways '''
+		key = (min(node_a, node_b), max(node_a, node_b))
+		default = self.links.get(key, self.default_link)
+		self.links[key] = Link(default.latency if latency is None else latency,
+							   default.loss if loss is None else loss,
+							   default.bandwidth if bandwidth is None else bandwidth)
+
+	def link(self, node_a, node_b):
+		if not self.links:
+			return self.default_link
+		return self.links.get((min(node_a, node_b), max(node_a, node_b)), self.default_link)
+
+	def bind(self, port, on_datagram, node):
+		''' return a transport on port. datagrams sent to the port are handed to on_datagram(data, source port) '''
+		if port in self.endpoints:
+			raise OSError(f"port {port} is already bound")
+		self.endpoints[port] = (on_datagram, node)
+		return SimTransport(self, port, node)
+
+	def unbind(self, port):
+		self.endpoints.pop(port, None)
+
+	def send(self, transport, data, port):
+		self.sent += 1
+		endpoint = self.endpoints.get(port)
+		if endpoint is None:
+			self.lost += 1
+			return
+
+		link = self.link(transport.node, endpoint[1])
+		if link.loss and self.random.random() < link.loss:
+			self.lost += 1
+			return
+
+		delay = link.latency
+		if link.bandwidth:
+			key = (transport.node, endpoint[1])
+			start = max(self.now, self.link_free.get(key, 0.0))
+			self.link_free[key] = start + len(data) / link.bandwidth
+			delay += self.link_free[key] - self.now
+		self.schedule(delay, self.deliver, port, data, transport.port)
+
+	def deliver(self, port, data, source_port):
+		endpoint = self.endpoints.get(port)
+		if endpoint is None:  # unbound while the datagram was on its way
+			self.lost += 1
+			return
+		self.delivered += 1
+		endpoint[0](data, source_port)
+
+	def add_peer(self, peer_id, port, peer_class=None, **kwargs):
+		''' create a peer, join it to the network and return it. the join is done when its packets are delivered '''
+		peer = (peer_class or SimPeer)(self, **kwargs)
+		if not peer.connect(f"CONNECT AS {peer_id} ON PORT {port}"):
+			return None
+		self.peers[peer_id] = peer
+		return peer
+
+	def build_tree(self, n, base_port=10000, **kwargs):
+		''' join n peers named 0..n-1, peer i listens on base_port + 2 * i, and deliver everything they send '''
+		peers = [self.add_peer(str(i), base_port + 2 * i, **kwargs) for i in range(n)]
+		self.run()
+		return peers
+
+
+class SimPeer(Peer):
+	''' Peer on a `Simulator`: sockets are simulator endpoints and admin is called in memory '''
+
+	def __init__(self, sim, heap_routing=HEAP_ROUTING, reliable=RELIABLE, coalesce=COALESCE,
+				 direct_routes=DIRECT_ROUTES, shortcuts=SHORTCUTS, heartbeats=HEARTBEATS, aggregate=AGGREGATE_ADVERTS):
+		# the simulator hands datagrams over one at a time, so there is nothing for an inbox to reorder
+		Peer.__init__(self, None, None, PEER_HOST, heap_routing, reliable, coalesce, direct_routes, shortcuts,
+					  heartbeats, priority=False, aggregate=aggregate)
+		self.sim = sim
+		self.listening_transport = None
+		self.outputs = []  # what the peer showed its user
+
+	def output(self, *args):
+		self.outputs.append(' '.join(str(arg) for arg in args))
+
+	def ask_admin(self, msg):
+		return self.sim.admin.handle_message(msg)
+
+	def call_later(self, delay, callback, *args):
+		self.sim.schedule(delay, callback, *args)
+
+	def clock(self):
+		return self.sim.now
+
+	def init_sender(self):
+		sending_port = self.get_sending_port_from_listening_port(self.listening_port)
+		try:
+			self.sending_socket = self.sim.bind(sending_port, self.receive_stats_request, self.listening_port)
+		except OSError:
+			self.output(f"ERROR: could not bind sending socket to {sending_port}")
+			return False
+		return True
+
+	def receive_stats_request(self, datagram, peer_port):
+		response = self.stats_response(datagram)
+		if response:
+			self.sending_socket.sendto(response, (self.host, peer_port))
+
+	def connect(self, connect_msg):
+		''' same steps as `Peer.start` for one CONNECT command. return True if we joined '''
+		if not self.set_identity(connect_msg):
+			self.output("INVALID COMMAND")
+			return False
+		try:
+			self.listening_transport = self.sim.bind(self.listening_port, self.receive_datagram, self.listening_port)
+		except OSError:
+			self.output(f"ERROR: could not bind listening socket to {self.host} {self.listening_port}")
+			return False
+
+		if not self.handle_admin_response(self.ask_admin(self.connection_message())) or not self.init_sender():
+			self.close()
+			return False
+
+		self.join_network()
+		return True
+
+	def close(self):
+		self.heartbeating = False
+		for transport in (self.listening_transport, self.sending_socket):
+			if transport is not None:
+				transport.close()
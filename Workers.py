@@ -0,0 +1,311 @@
+import ctypes
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+
+from Firewall import Firewall
+from Metrics import Histogram
+from Packet import Packet, PacketType
+from Peer import Peer
+from RateLimit import RateLimiter
+from Coalesce import BATCH_MAGIC
+from Reliable import LINK_MAGIC
+import commons
+from commons import dprint, DATAGRAM_SIZE, MSG_SIZE, RECEIVE_BUFFER
+
+REPLICATE_INTERVAL = 0.01  # seconds between checks for state changes to send to workers
+REPLICATE_REFRESH = 1.0  # seconds after which state is compared even if nothing was marked changed
+METRICS_INTERVAL = 1.0  # seconds between workers sending their counters to the peer
+RELAY_BATCH = 64  # relayed datagrams the peer handles before it looks at its own socket again
+
+# what a worker can forward from its replica. everything else goes to the peer, which owns the state
+FORWARD_TYPES = frozenset((PacketType.MESSAGE,))
+
+# peer attributes that workers need to route, copied to them whenever they change
+REPLICATED = ('id', 'number', 'listening_port', 'parent_id', 'parent_port', 'known_peers', 'routing_table',
+			  'child_ports', 'fingers', 'directory')
+
+# relay messages from workers to the peer: kind, port, then the datagram or json
+RELAY_HEADER = struct.Struct('!BH')
+RELAY_PACKET = 0  # datagram from a neighbor that the worker can not handle
+RELAY_STATS = 1  # datagram that reached the worker's sending socket, e.g. an admin STATS scrape
+RELAY_METRICS = 2  # json counters of the worker
+
+SO_ATTACH_REUSEPORT_CBPF = 51
+_SKF_AD_RANDOM = -0x1000 + 56  # SKF_AD_OFF + SKF_AD_RANDOM, a random 32 bit number
+
+
+def reuseport_socket(host, port):
+	''' udp socket bound to (host, port) that other processes of ours can bind too '''
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+		sock.bind((host, port))
+	except OSError:
+		sock.close()
+		raise
+	return sock
+
+
+class _sock_filter(ctypes.Structure):
+	_fields_ = [('code', ctypes.c_uint16), ('jt', ctypes.c_uint8), ('jf', ctypes.c_uint8), ('k', ctypes.c_uint32)]
+
+
+class _sock_fprog(ctypes.Structure):
+	_fields_ = [('len', ctypes.c_uint16), ('filter', ctypes.POINTER(_sock_filter))]
+
+
+def spread_randomly(sock, sockets):
+	'''
+	Have the kernel hand each datagram of sock's SO_REUSEPORT group to a random one of its `sockets`
+	sockets, instead of by a hash of the sender's address. A peer gets all the traffic of a neighbor from
+	one port, so without this one busy neighbor keeps one worker busy and the others idle.
+	'''
+	program = (_sock_filter * 3)(
+		_sock_filter(0x20, 0, 0, _SKF_AD_RANDOM & 0xffffffff),  # ld random
+		_sock_filter(0x94, 0, 0, sockets),  # mod sockets
+		_sock_filter(0x16, 0, 0, 0),  # ret a
+	)
+	fprog = _sock_fprog(len(program), program)
+	sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, bytes(fprog))
+
+
+def snapshot(peer):
+	''' what workers need of peer's state, None if it changed while we read it '''
+	try:
+		state = {name: getattr(peer, name) for name in REPLICATED}
+		state['firewall'] = list(peer.firewall.rules)
+		state['limits'] = [(id_src, typ, rate, burst) for (id_src, typ, rate, burst), _ in peer.limiter.rule_drops()]
+		return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+	except RuntimeError:
+		# a dict changed size while we pickled it, another thread is handling a packet
+		return None
+
+
+def forwardable(peer, packet):
+	''' True if a worker can forward packet with a replica of peer's state: a unicast message for another peer '''
+	return packet.type in FORWARD_TYPES and packet.destination != peer.id and packet.destination != '-1'
+
+
+class WorkerPool:
+	'''
+	Worker processes that share a peer's listening port with SO_REUSEPORT and forward messages for it.
+
+	The peer stays the single writer of routing, firewall and known peer state. Whenever it changes,
+	the peer sends a copy to every worker, at most every REPLICATE_INTERVAL, and workers route with
+	their copy. Datagrams a worker can not handle alone (joins, advertisements, reliable frames,
+	broadcasts, packets for the peer itself) are relayed to the peer over a unix socket, with the port
+	they came from. The peer's receive loop waits on that socket next to its listening socket and
+	handles them as if it had received them, so one thread handles every packet that changes state.
+	The peer's own listening socket is in the group too, so it forwards its share as well.
+
+	spread is 'flow' to let the kernel pick a socket by the sender's address, which keeps the
+	packets of a neighbor in order, or 'random' to spread every datagram (see `spread_randomly`).
+	'''
+	def __init__(self, peer, workers, spread='flow', quiet=False):
+		self.peer = peer
+		self.workers = workers
+		self.spread = spread
+		self.quiet = quiet
+		self.conns = []
+		self.processes = []
+		self.relay = None
+		self.dirty = False
+		self.last_state = None
+		self.worker_metrics = {}  # dict of {worker index: metrics snapshot}
+
+	def start(self, server):
+		''' start workers. server is the peer's listening socket, bound with SO_REUSEPORT '''
+		self.relay, worker_relay = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self.relay.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+		self.last_state = snapshot(self.peer)
+		peer = self.peer
+		settings = (peer.host, peer.heap_routing, peer.coalesce, peer.shortcuts, self.quiet)
+
+		context = multiprocessing.get_context('spawn')
+		for index in range(self.workers):
+			conn, child_conn = context.Pipe()
+			process = context.Process(target=_worker, args=(index, settings, child_conn, worker_relay, commons.log.level),
+									  daemon=True)
+			process.start()
+			conn.send_bytes(self.last_state)
+			self.conns.append(conn)
+			self.processes.append(process)
+		worker_relay.close()
+
+		# a worker is in the group once it has bound the port
+		for conn in self.conns:
+			conn.recv()
+		if self.spread == 'random':
+			spread_randomly(server, self.workers + 1)
+
+		threading.Thread(target=self.replicate, daemon=True).start()
+
+	def changed(self):
+		''' state of the peer may have changed, workers get a copy on the next check '''
+		self.dirty = True
+
+	def handled(self, packet):
+		''' the peer is handling packet '''
+		if not forwardable(self.peer, packet):
+			self.changed()
+
+	def replicate(self):
+		''' send a copy of the peer's state to the workers whenever it changes '''
+		last_check = time.monotonic()
+		while True:
+			time.sleep(REPLICATE_INTERVAL)
+			now = time.monotonic()
+			if not self.dirty and now - last_check < REPLICATE_REFRESH:
+				continue
+			self.dirty = False
+			last_check = now
+			state = snapshot(self.peer)
+			if state is None:
+				self.dirty = True
+				continue
+			if state == self.last_state:
+				continue
+			self.last_state = state
+			for conn in self.conns:
+				try:
+					conn.send_bytes(state)
+				except OSError as e:
+					dprint(f"could not update worker, err: {e}")
+
+	def receive_relayed(self, limit=RELAY_BATCH):
+		''' handle what workers passed to us, up to limit messages. runs on the peer's receive loop '''
+		for _ in range(limit):
+			try:
+				message = self.relay.recv(RELAY_HEADER.size + DATAGRAM_SIZE, socket.MSG_DONTWAIT)
+			except BlockingIOError:
+				return
+			try:
+				kind, port = RELAY_HEADER.unpack_from(message)
+				data = memoryview(message)[RELAY_HEADER.size:]
+				if kind == RELAY_PACKET:
+					self.peer.receive_datagram(data, port)
+				elif kind == RELAY_STATS:
+					response = self.peer.stats_response(data)
+					if response:
+						self.peer.sending_socket.sendto(response, (self.peer.host, port))
+				elif kind == RELAY_METRICS:
+					metrics = json.loads(bytes(data))
+					self.worker_metrics[metrics.pop('worker')] = metrics
+
+			except (OSError, ValueError, struct.error) as e:
+				dprint(f"Error", e)
+
+	def merge_stats(self, stats):
+		''' add the counters and latencies workers last sent to the peer's stats '''
+		counters = stats['counters']
+		latency = Histogram()
+		latency.merge(stats['latency_ns']['buckets'], stats['latency_ns']['max'])
+		for metrics in list(self.worker_metrics.values()):
+			for name, count in metrics['counters'].items():
+				counters[name] = counters.get(name, 0) + count
+			latency.merge(metrics['latency_ns']['buckets'], metrics['latency_ns']['max'])
+		stats['counters'] = dict(sorted(counters.items()))
+		stats['latency_ns'] = latency.snapshot()
+
+
+class ForwardingWorker(Peer):
+	'''
+	Routes messages for a peer with a copy of its state and passes everything else to it. Its
+	replies and forwarded packets go out of a socket bound to the peer's sending port, so
+	neighbors can not tell it from the peer.
+	'''
+	def __init__(self, index, settings, conn, relay):
+		host, heap_routing, coalesce, shortcuts, quiet = settings
+		# forwarded messages go out unreliably: sequence numbers are per link and the peer owns them
+		Peer.__init__(self, None, None, host, heap_routing=heap_routing, reliable=False, coalesce=coalesce,
+					  shortcuts=shortcuts, heartbeats=False, priority=False)
+		self.index = index
+		self.quiet = quiet
+		self.conn = conn  # copies of the peer's state come on it
+		self.relay_socket = relay
+
+	def output(self, *args):
+		if not self.quiet:
+			Peer.output(self, *args)
+
+	def apply(self, state):
+		''' take a copy of the peer's state '''
+		state = pickle.loads(state)
+		rules = state.pop('firewall')
+		if rules != self.firewall.rules:
+			firewall = Firewall()
+			for rule in rules:
+				firewall.add_rule(*rule)
+			self.firewall = firewall
+		limits = state.pop('limits')
+		if limits != [rule for rule, _ in self.limiter.rule_drops()]:
+			# buckets start over, so only when the rules changed
+			limiter = RateLimiter()
+			for rule in limits:
+				limiter.add_rule(*rule)
+			self.limiter = limiter
+		self.__dict__.update(state)
+
+	def relay(self, kind, port, data):
+		self.relay_socket.send(RELAY_HEADER.pack(kind, port) + bytes(data))
+
+	def handle_datagram(self, datagram, peer_port):
+		if datagram and datagram[0] == BATCH_MAGIC:
+			# unpacks the batch and gives us its packets one by one
+			Peer.handle_datagram(self, datagram, peer_port)
+			return
+		start = time.perf_counter_ns()
+		packet = None if not datagram or datagram[0] == LINK_MAGIC else Packet.parse(datagram)
+		if packet is None or not forwardable(self, packet):
+			self.relay(RELAY_PACKET, peer_port, datagram)
+			return
+		self.accept_packet(packet, peer_port, start)
+
+	def replica_handler(self):
+		while True:
+			try:
+				state = self.conn.recv_bytes()
+			except (EOFError, OSError):
+				# the peer is gone, stop answering on its ports
+				os._exit(0)
+			self.apply(state)
+
+	def stats_handler(self):
+		''' what reaches our sending socket is for the peer '''
+		while True:
+			try:
+				datagram, address = self.sending_socket.recvfrom(MSG_SIZE)
+				self.relay(RELAY_STATS, address[1], datagram)
+			except OSError as e:
+				dprint(f"Error", e)
+
+	def report_metrics(self):
+		while True:
+			time.sleep(METRICS_INTERVAL)
+			metrics = self.metrics.snapshot()
+			metrics['worker'] = self.index
+			self.relay(RELAY_METRICS, 0, json.dumps(metrics).encode('ascii'))
+
+	def serve(self):
+		''' bind the peer's ports next to it and forward until the peer exits '''
+		self.apply(self.conn.recv_bytes())
+		server = reuseport_socket(self.host, self.listening_port)
+		self.sending_socket = reuseport_socket(self.host, self.get_sending_port_from_listening_port(self.listening_port))
+		self.conn.send('bound')
+
+		threading.Thread(target=self.replica_handler, daemon=True).start()
+		threading.Thread(target=self.stats_handler, daemon=True).start()
+		threading.Thread(target=self.report_metrics, daemon=True).start()
+		self.peer_receiving_handler(server)
+
+
+def _worker(index, settings, conn, relay, log_level):
+	commons.log.level = log_level
+	ForwardingWorker(index, settings, conn, relay).serve()
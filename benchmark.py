@@ -0,0 +1,868 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+
+import commons
+import FailureDetector
+from Packet import Packet, PacketType
+from Firewall import Firewall
+from Peer import Peer
+from Admin import Admin
+from AsyncPeer import AsyncPeer
+from Simulator import Simulator, SimPeer
+from Inbox import PriorityInbox
+from RateLimit import RateLimiter
+
+
+def _per_op(fn, ops):
+	start = time.perf_counter()
+	fn(ops)
+	return (time.perf_counter() - start) / ops
+
+
+def bench_firewall(rule_counts=(10, 100, 1000, 10000), ops=100000, cached=True):
+	''' per-packet firewall check cost as the number of FILTER rules grows '''
+	results = {}
+	random.seed(0)
+	ids = [str(i) for i in range(64)]
+	types = list(PacketType)
+
+	for n in rule_counts:
+		firewall = Firewall() if cached else Firewall(cache_size=0)
+		for _ in range(n):
+			firewall.add_rule(random.choice(['INPUT', 'OUTPUT', 'FORWARD']), random.choice(ids + ['*']),
+							  random.choice(ids + ['*']), random.choice(types), random.choice(['ACCEPT', 'DROP']))
+		packets = [Packet(random.choice(types), random.choice(ids), random.choice(ids + ['-1']), '') for _ in range(1024)]
+
+		def run(ops):
+			for i in range(ops):
+				firewall.check(packets[i & 1023], '0', True)
+
+		results[n] = _per_op(run, ops)
+	return results
+
+
+class _NullPeer(Peer):
+	''' peer that drops everything it sends, used to time routing decisions alone '''
+
+	def send_packet_to_peer(self, peer_port, packet):
+		return True
+
+
+def bench_routing(subtree_sizes=(100, 1000, 10000, 50000), ops=100000):
+	''' per-packet cost of choosing a next hop at a root with two children '''
+	results = {}
+	random.seed(0)
+	for n in subtree_sizes:
+		peer = _NullPeer(None, None, '127.0.0.1')
+		peer.id, peer.listening_port = '0', 10000
+		for child, port in (('1', 10002), ('2', 10004)):
+			peer.add_to_known_peers(child, port)
+			peer.add_new_child(child)
+		for i in range(3, n):
+			peer.add_to_child_subtree(str(i), '1' if i % 2 else '2')
+		packets = [Packet(PacketType.MESSAGE, '0', str(random.randrange(1, n)), '') for _ in range(1024)]
+
+		def run(ops):
+			for i in range(ops):
+				peer.route_packet(packets[i & 1023], 10003)
+
+		results[n] = _per_op(run, ops)
+	return results
+
+
+def bench_wire(payload_sizes=(16, 256, 1000), ops=200000):
+	''' packets per second per core for one forwarding hop: parse a datagram, then encode it for the next hop '''
+	results = {}
+	sender = _NullPeer(None, None, '127.0.0.1')
+	for size in payload_sizes:
+		packet = Packet(PacketType.MESSAGE, 'peer1', 'peer2', 'CHAT:NEW:' + 'x' * (size - 9))
+		for wire_format in ('text', 'binary'):
+			commons.WIRE_FORMAT = wire_format
+			datagram = memoryview(bytearray(sender.encode_packet(packet)))
+
+			def run(ops):
+				for _ in range(ops):
+					sender.encode_packet(Packet.parse(datagram))
+
+			results[(wire_format, size)] = 1 / _per_op(run, ops)
+	commons.WIRE_FORMAT = 'binary'
+	return results
+
+
+async def _join(host, port, peer_id, peer_port):
+	reader, writer = await asyncio.open_connection(host, port)
+	writer.write(f"{peer_id} REQUESTS FOR CONNECTING TO NETWORK ON PORT {peer_port}".encode("ascii"))
+	await reader.read(commons.MSG_SIZE)
+	writer.close()
+
+
+async def _bench_admin(joins, concurrency):
+	admin = Admin()
+	server = await admin.start('127.0.0.1', 0)
+	port = server.sockets[0].getsockname()[1]
+	semaphore = asyncio.Semaphore(concurrency)
+
+	async def join(i):
+		async with semaphore:
+			await _join('127.0.0.1', port, f'p{i}', 10000 + 2 * i)
+
+	start = time.perf_counter()
+	await asyncio.gather(*(join(i) for i in range(joins)))
+	elapsed = time.perf_counter() - start
+	server.close()
+
+	stats = admin.registration_stats()
+	stats['wall_time'] = elapsed
+	return stats
+
+
+def bench_admin(joins=10000, concurrency=512):
+	''' admin registration throughput and latency with many peers joining at once '''
+	return asyncio.run(_bench_admin(joins, concurrency))
+
+
+class _TreePeer(AsyncPeer):
+	'''
+	in-process peer that keeps quiet, reports packets it handles, counts datagrams it sends and drops
+	`loss` of them. admin runs on the same loop, so requests to it are calls instead of blocking TCP
+	'''
+
+	def __init__(self, admin, admin_port, peer_host, on_packet):
+		AsyncPeer.__init__(self, '127.0.0.1', admin_port, peer_host)
+		self.admin = admin
+		self.on_packet = on_packet
+		self.sent = 0
+		self.loss = 0
+
+	def ask_admin(self, msg):
+		return self.admin.handle_message(msg)
+
+	# admin answers right away, so lookups need not wait for a task like on a real loop
+	ask_admin_then = Peer.ask_admin_then
+
+	def send_bytes(self, socket, msg, addr=None):
+		if self.loss and random.random() < self.loss:
+			return
+		AsyncPeer.send_bytes(self, socket, msg, addr)
+
+	def output(self, *args):
+		pass
+
+	def send_packet_to_peer(self, peer_port, packet):
+		self.sent += 1
+		return AsyncPeer.send_packet_to_peer(self, peer_port, packet)
+
+	def send_packet_to_peers(self, peer_ports, packet):
+		self.sent += len(peer_ports)
+		return AsyncPeer.send_packet_to_peers(self, peer_ports, packet)
+
+	def handle_packet(self, packet, peer_port):
+		self.on_packet(self, packet)
+		AsyncPeer.handle_packet(self, packet, peer_port)
+
+
+async def _start_tree(n, base_port, on_packet=None):
+	''' start admin and n peers on the running loop, peer i listens on base_port + 2 * i '''
+	admin = Admin()
+	server = await admin.start('127.0.0.1', 0)
+	admin_port = server.sockets[0].getsockname()[1]
+	peers = []
+	for i in range(n):
+		peer = _TreePeer(admin, admin_port, '127.0.0.1', on_packet or (lambda peer, packet: None))
+		await peer.execute(f"CONNECT AS p{i} ON PORT {base_port + 2 * i}")
+		peers.append(peer)
+	# let CONNECTION_REQUESTs and advertisements settle
+	await asyncio.sleep(0.5)
+	return server, peers
+
+
+def _close_tree(server, peers):
+	for peer in peers:
+		peer.close()
+	server.close()
+
+
+async def _bench_broadcast(n, base_port, trials):
+	received = 0
+	done = None
+
+	def on_packet(peer, packet):
+		nonlocal received
+		if packet.destination == '-1' and packet.type == PacketType.ADVERTISE:
+			received += 1
+			if received == n - 1:
+				done.set_result(time.perf_counter())
+
+	server, peers = await _start_tree(n, base_port, on_packet)
+	try:
+		times = []
+		for _ in range(trials):
+			received, done = 0, asyncio.get_running_loop().create_future()
+			start = time.perf_counter()
+			peers[-1].handle_command("ADVERTISE -1")
+			times.append(await asyncio.wait_for(done, 10) - start)
+	finally:
+		_close_tree(server, peers)
+	return sorted(times)[len(times) // 2]
+
+
+def bench_broadcast(n=1023, base_port=30000, trials=20):
+	''' median time for an ADVERTISE -1 from a leaf to reach every peer of an n-peer loopback tree '''
+	return asyncio.run(_bench_broadcast(n, base_port, trials))
+
+
+async def _bench_chat(n, members, base_port, messages):
+	received = 0
+	done = None
+
+	def on_packet(peer, packet):
+		nonlocal received
+		if packet.type == PacketType.MESSAGE and packet.destination == peer.id or \
+				packet.type == PacketType.MULTICAST and peer.id in packet.destination.split(','):
+			received += 1
+			if received == len(room):
+				done.set_result(time.perf_counter())
+
+	server, peers = await _start_tree(n, base_port, on_packet)
+	random.seed(0)
+	sender = peers[-1]
+	room = [peer.id for peer in random.sample(peers[:-1], members)]
+	for peer in peers:
+		# everybody knows everybody, as if they had all advertised
+		for member in room:
+			peer.add_to_known_peers(member)
+
+	results = {}
+	try:
+		for method in ('unicast', 'multicast'):
+			for peer in peers:
+				peer.sent = 0
+			elapsed = 0
+			for i in range(messages):
+				received, done = 0, asyncio.get_running_loop().create_future()
+				data = f"CHAT:NEW:message {i}\n1"
+				start = time.perf_counter()
+				if method == 'multicast':
+					sender.multicast(room, data)
+				else:
+					for member in room:
+						sender.route_packet(Packet(PacketType.MESSAGE, sender.id, member, data))
+				elapsed += await asyncio.wait_for(done, 30) - start
+			results[method] = {'datagrams_per_message': sum(peer.sent for peer in peers) / messages,
+							   'time_per_message': elapsed / messages}
+	finally:
+		_close_tree(server, peers)
+	return results
+
+
+def bench_chat(n=1023, members=200, base_port=30000, messages=20):
+	''' datagrams and time for a chat line to reach every member of a room, per member unicast vs multicast '''
+	return asyncio.run(_bench_chat(n, members, base_port, messages))
+
+
+async def _bench_reliable(losses, messages, size, base_port):
+	received = 0
+	last = None
+
+	def on_packet(peer, packet):
+		nonlocal received, last
+		if packet.type == PacketType.MESSAGE and packet.destination == peer.id:
+			received += 1
+			last = time.perf_counter()
+
+	server, peers = await _start_tree(2, base_port, on_packet)
+	parent, child = peers
+	data = 'x' * size
+	results = {}
+	try:
+		for loss in losses:
+			parent.loss = child.loss = loss
+			for mode, reliable, window in (('udp', False, 0), ('stop-and-wait', True, 1), ('window', True, 64)):
+				child.reliable, child.channel.window = reliable, window or child.channel.window
+				received, last = 0, None
+				start = time.perf_counter()
+				for i in range(messages):
+					child.send_packet_to_peer(parent.listening_port, Packet(PacketType.MESSAGE, child.id, parent.id, data))
+				# wait until everything arrived or nothing arrived for a while
+				seen = -1
+				while received < messages and received != seen:
+					seen = received
+					await asyncio.sleep(1)
+				elapsed = last - start if last else float('inf')
+				results[(mode, loss)] = {'delivered': received / messages, 'goodput': received * size / elapsed}
+				while child.channel.pending():
+					await asyncio.sleep(0.1)
+	finally:
+		_close_tree(server, peers)
+	return results
+
+
+def bench_reliable(losses=(0, 0.01, 0.05), messages=2000, size=1000, base_port=30000):
+	''' goodput between two loopback peers for a burst of messages: plain UDP, reliable with a window of 1 and of 64 '''
+	random.seed(0)
+	return asyncio.run(_bench_reliable(losses, messages, size, base_port))
+
+
+async def _bench_bulk(size, base_port):
+	server, peers = await _start_tree(3, base_port)
+	sender, receiver = peers[1], peers[2]
+	sender.add_to_known_peers(receiver.id)
+	done = asyncio.get_running_loop().create_future()
+	receiver.output = lambda *args: done.done() or done.set_result(time.perf_counter())
+	try:
+		with tempfile.TemporaryDirectory() as directory:
+			receiver.reassembler.directory = directory
+			path = os.path.join(directory, 'blob')
+			with open(path, 'wb') as f:
+				f.write(os.urandom(size))
+			start = time.perf_counter()
+			sender.send_file(receiver.id, path)
+			elapsed = await asyncio.wait_for(done, 120) - start
+	finally:
+		_close_tree(server, peers)
+	return size / elapsed
+
+
+def bench_bulk(size=16 * 1024 * 1024, base_port=30000):
+	''' throughput of SEND FILE from one leaf to the other of a 3-peer loopback tree, through the root '''
+	return asyncio.run(_bench_bulk(size, base_port))
+
+
+async def _bench_coalesce(n, base_port, rounds, burst):
+	received = 0
+	done = None
+
+	def on_packet(peer, packet):
+		nonlocal received
+		if packet.type == PacketType.MESSAGE and packet.destination == peer.id:
+			received += 1
+			if received == expected:
+				done.set_result(time.perf_counter())
+
+	server, peers = await _start_tree(n, base_port, on_packet)
+	root = peers[0]
+	# the leaves of the left half of the tree chat with the leaves of the right half, all through the root
+	leaves = peers[n // 2:]
+	pairs = list(zip(leaves[:len(leaves) // 2], leaves[len(leaves) // 2:]))
+	for peer in peers:
+		for _, destination in pairs:
+			peer.add_to_known_peers(destination.id)
+	expected = len(pairs) * burst
+
+	results = {}
+	try:
+		for coalesce in (False, True):
+			for peer in peers:
+				peer.coalesce = coalesce
+			root.metrics.counters.clear()
+			elapsed = 0
+			for i in range(rounds):
+				received, done = 0, asyncio.get_running_loop().create_future()
+				start = time.perf_counter()
+				for source, destination in pairs:
+					for j in range(burst):
+						source.route_packet(Packet(PacketType.MESSAGE, source.id, destination.id, f"CHAT:line {i} {j}"))
+				elapsed += await asyncio.wait_for(done, 30) - start
+			counters = root.metrics.snapshot()['counters']
+			forwarded = counters.get('forwarded.message', 0)
+			results['on' if coalesce else 'off'] = {
+				'packets_per_second': forwarded / elapsed,
+				'datagrams_per_packet': (counters.get('batches', 0) + forwarded - counters.get('coalesced', 0)) / forwarded,
+			}
+	finally:
+		_close_tree(server, peers)
+	return results
+
+
+def bench_coalesce(n=63, base_port=30000, rounds=20, burst=50):
+	''' packets per second the root forwards when half of the leaves chat with the other half, coalescing off and on '''
+	return asyncio.run(_bench_coalesce(n, base_port, rounds, burst))
+
+
+async def _bench_direct(n, base_port, messages):
+	done = None
+	sender_id = f"p{n // 2}"
+
+	def on_packet(peer, packet):
+		if peer.id == sender_id and packet.type == PacketType.MESSAGE and packet.data.startswith('SALAM:Hezaro'):
+			done.set_result(time.perf_counter())
+
+	server, peers = await _start_tree(n, base_port, on_packet)
+	# two leaves on different sides of the root
+	sender, receiver = peers[n // 2], peers[-1]
+	for peer in peers:
+		peer.add_to_known_peers(sender.id)
+		peer.add_to_known_peers(receiver.id)
+
+	results = {}
+	try:
+		for direct in (False, True):
+			for peer in peers:
+				peer.direct_routes = direct
+				peer.route_cache.entries.clear()
+			times = []
+			for i in range(messages):
+				done = asyncio.get_running_loop().create_future()
+				start = time.perf_counter()
+				sender.handle_command(f"Salam Salam Sad Ta Salam {receiver.id}")
+				times.append(await asyncio.wait_for(done, 10) - start)
+			results['direct' if direct else 'tree'] = sorted(times)[len(times) // 2]
+	finally:
+		_close_tree(server, peers)
+	return results
+
+
+def bench_direct(n=1023, base_port=30000, messages=50):
+	''' median SALAM round trip between two leaves of an n-peer loopback tree, through the tree and with direct routes '''
+	return asyncio.run(_bench_direct(n, base_port, messages))
+
+
+def bench_sim(n=100000, latency=0.001):
+	''' wall time to simulate joining an n-peer tree and a broadcast from its last leaf, and the simulated broadcast time '''
+	results = {}
+	for heap_routing in (True, False):
+		sim = Simulator(latency=latency)
+		start = time.perf_counter()
+		peers = sim.build_tree(n, heap_routing=heap_routing)
+		joined = time.perf_counter()
+		sent, sim_start = sim.sent, sim.now
+		peers[-1].handle_command("ADVERTISE -1")
+		sim.run()
+		results['heap' if heap_routing else 'subtree'] = {
+			'join_wall': joined - start,
+			'broadcast_wall': time.perf_counter() - joined,
+			'broadcast_sim': sim.now - sim_start,
+			'broadcast_datagrams': sim.sent - sent,
+		}
+	return results
+
+
+def bench_joins(sizes=(1023, 8191), latency=0.001):
+	'''
+	advertisements the root receives while n peers join in one burst, all datagrams of the burst and the
+	simulated time until the root can route to every peer, with one advertisement per peer and with deltas
+	'''
+	results = {}
+	for n in sizes:
+		for aggregate in (False, True):
+			sim = Simulator(latency=latency)
+			peers = sim.build_tree(n, aggregate=aggregate)
+			root = peers[0]
+			counters = root.metrics.counters
+			results[(n, aggregate)] = {
+				'root_adverts': counters.get(('received', PacketType.PARENT_ADVERTISE), 0) +
+								counters.get(('received', PacketType.ADVERTISE_DELTA), 0),
+				'datagrams': sim.sent,
+				'converged': sim.now,
+				'routes': len(root.routing_table),
+			}
+	return results
+
+
+def bench_shortcuts(sizes=(1023, 16383), messages=2000):
+	''' simulated hops per message and share of messages the root forwards between random peers, heap routing with and without shortcuts '''
+	results = {}
+	for n in sizes:
+		for shortcuts in (False, True):
+			sim = Simulator()
+			peers = sim.build_tree(n, heap_routing=True, shortcuts=shortcuts)
+			rng = random.Random(0)
+			sent, root = sim.sent, peers[0]
+			forwarded = root.metrics.counters.get(('forwarded', PacketType.MESSAGE), 0)
+			for _ in range(messages):
+				source, destination = rng.sample(peers, 2)
+				source.route_packet(Packet(PacketType.MESSAGE, source.id, destination.id, 'x'))
+			sim.run()
+			results[(n, 'shortcuts' if shortcuts else 'tree')] = {
+				'hops': (sim.sent - sent) / messages,
+				'root_share': (root.metrics.counters.get(('forwarded', PacketType.MESSAGE), 0) - forwarded) / messages,
+			}
+	return results
+
+
+class _ProbePeer(SimPeer):
+	''' simulated peer that keeps the send times of the probe messages that reached it '''
+
+	def __init__(self, sim, **kwargs):
+		SimPeer.__init__(self, sim, **kwargs)
+		self.probes = set()
+
+	def handle_packet(self, packet, peer_port):
+		if packet.type == PacketType.MESSAGE and packet.destination == self.id and packet.data.startswith('probe '):
+			self.probes.add(packet.data.split()[1])
+		SimPeer.handle_packet(self, packet, peer_port)
+
+
+def bench_failover(n=1023, interval=0.01, latency=0.001):
+	'''
+	simulated time from killing heap number 2 (the root of half the tree) until probes between a leaf
+	under it and a leaf on the other side get through again, for each routing mode and failure detector
+	'''
+	results = {}
+	for heap_routing in (True, False):
+		for detector in FailureDetector.DETECTORS:
+			sim = Simulator(latency=latency)
+			peers = [sim.add_peer(str(i), 10000 + 2 * i, peer_class=_ProbePeer, heap_routing=heap_routing, heartbeats=True)
+					 for i in range(n)]
+			for peer in peers:
+				peer.detector = FailureDetector.DETECTORS[detector]()
+			sim.run(until=1.0)
+			# peer i joined as heap number i + 1
+			victim, a, b = peers[1], peers[n * 2 // 3], peers[-1]
+			a.add_to_known_peers(b.id)
+
+			victim.close()
+			kill = sim.now
+			probes = [f'{kill + i * interval:.3f}' for i in range(int(3 / interval))]
+			for sent in probes:
+				sim.schedule(float(sent) - sim.now, a.route_packet, Packet(PacketType.MESSAGE, a.id, b.id, f'probe {sent}'))
+			sim.run(until=kill + 3 + 1)
+			lost = [float(sent) for sent in probes if sent not in b.probes]
+			results[('heap' if heap_routing else 'subtree', detector)] = {
+				'recovery': max(lost) + interval - kill if lost else 0,
+				'lost': len(lost),
+			}
+	return results
+
+
+def _storm(root_port, sending_port, rate, stop):
+	''' broadcast SALAMs to the root from sending_port, rate per second, until stop is set '''
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+		sock.bind(('127.0.0.1', sending_port))
+		datagram = Packet(PacketType.MESSAGE, 'c1', '-1', 'SALAM:Salam Salam Sad Ta Salam').to_bytes()
+		start, sent = time.perf_counter(), 0
+		while not stop.is_set():
+			for _ in range(100):
+				sock.sendto(datagram, ('127.0.0.1', root_port))
+			sent += 100
+			ahead = start + sent / rate - time.perf_counter()
+			if ahead > 0:
+				time.sleep(ahead)
+
+
+def _storm_probe(root_port, listening_port, probes, interval, warmup, timeout, results):
+	''' send ROUTE requests to the root from a child and put their round trips (None if not answered in timeout) in results '''
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as listen, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as send:
+		listen.bind(('127.0.0.1', listening_port))
+		send.bind(('127.0.0.1', listening_port + 1))
+		request = Packet(PacketType.ROUTING_REQUEST, 'c0', 'p0', '').to_bytes()
+		time.sleep(warmup)
+		times = []
+		for _ in range(probes):
+			start = time.perf_counter()
+			send.sendto(request, ('127.0.0.1', root_port))
+			elapsed = None
+			try:
+				# the storm is broadcast to us too, so wait for the answer until a deadline
+				while elapsed is None:
+					listen.settimeout(max(start + timeout - time.perf_counter(), 1e-6))
+					packet = Packet.parse(listen.recv(commons.MSG_SIZE))
+					if packet is not None and packet.type == PacketType.ROUTING_RESPONSE:
+						elapsed = time.perf_counter() - start
+			except socket.timeout:
+				pass
+			times.append(elapsed)
+			time.sleep(interval)
+	results.put(times)
+
+
+async def _bench_storm(base_port, probes, interval, rate):
+	server, peers = await _start_tree(1, base_port)
+	root = peers[0]
+	# children we play from other processes: c0 asks ROUTE, c1 floods, c2 only receives
+	ports = {f'c{i}': base_port + 100 + 2 * i for i in range(3)}
+	for child, port in ports.items():
+		root.handle_packet(Packet(PacketType.CONNECTION_REQUEST, child, root.id, str(port)), port + 1)
+
+	loop = asyncio.get_running_loop()
+	context = multiprocessing.get_context('spawn')
+	results = {}
+	try:
+		for mode in ('idle', 'fifo', 'inbox', 'inbox+limit'):
+			root.inbox = PriorityInbox() if mode.startswith('inbox') else None
+			root.limiter = RateLimiter()
+			if mode == 'inbox+limit':
+				root.handle_command('LIMIT * 00 1000 100')
+			stop, queue = context.Event(), context.Queue()
+			processes = [context.Process(target=_storm_probe, args=(root.listening_port, ports['c0'], probes, interval, 0.5, 0.5, queue))]
+			if mode != 'idle':
+				processes.append(context.Process(target=_storm, args=(root.listening_port, ports['c1'] + 1, rate, stop)))
+			forwarded = root.metrics.counters.get(('forwarded', PacketType.MESSAGE), 0)
+			start = time.perf_counter()
+			for process in processes:
+				process.start()
+			# the root keeps serving on this loop while we wait
+			times = await loop.run_in_executor(None, queue.get)
+			elapsed = time.perf_counter() - start
+			stop.set()
+			for process in processes:
+				await loop.run_in_executor(None, process.join)
+			received = sorted(t for t in times if t is not None)
+			results[mode] = {
+				'p50': received[len(received) // 2] if received else None,
+				'p99': received[min(len(received) * 99 // 100, len(received) - 1)] if received else None,
+				'lost': len(times) - len(received),
+				'forwarded': (root.metrics.counters.get(('forwarded', PacketType.MESSAGE), 0) - forwarded) / elapsed,
+			}
+			# let what the storm left in the socket drain
+			await asyncio.sleep(1)
+	finally:
+		_close_tree(server, peers)
+	return results
+
+
+def bench_storm(base_port=30000, probes=200, interval=0.01, rate=50000):
+	'''
+	ROUTE round trips of a child of the root while another child floods it with `rate` broadcast SALAMs a second:
+	without the storm, arrival order, the priority inbox, and the inbox with a MESSAGE rate limit
+	'''
+	return asyncio.run(_bench_storm(base_port, probes, interval, rate))
+
+
+class _QuietPeer(Peer):
+	def output(self, *args):
+		pass
+
+
+def _flood(root_port, source, destination, start_at, duration):
+	''' send MESSAGEs from source to destination to the root as fast as we can, from start_at for duration seconds '''
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+		sock.bind(('127.0.0.1', 0))
+		datagram = Packet(PacketType.MESSAGE, source, destination, 'x' * 64).to_bytes()
+		time.sleep(max(start_at - time.perf_counter(), 0))
+		end = start_at + duration
+		while time.perf_counter() < end:
+			for _ in range(64):
+				try:
+					sock.sendto(datagram, ('127.0.0.1', root_port))
+				except OSError:
+					pass
+
+
+def _sink(port, start_at, duration, results):
+	''' count datagrams that reach port between start_at and start_at + duration '''
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, commons.RECEIVE_BUFFER)
+		sock.bind(('127.0.0.1', port))
+		buffer = bytearray(commons.DATAGRAM_SIZE)
+		end = start_at + duration
+		received = 0
+		while True:
+			sock.settimeout(max(end + 0.5 - time.perf_counter(), 1e-3))
+			try:
+				sock.recv_into(buffer)
+			except socket.timeout:
+				break
+			if time.perf_counter() < end:
+				received += 1
+	results.put(received)
+
+
+def bench_workers(worker_counts=(0, 1, 2, 4), spread='random', senders=4, duration=3.0, base_port=31000):
+	'''
+	messages a second a root forwards from one child to the other with no workers and with SO_REUSEPORT
+	workers, while `senders` processes flood it as fast as they can
+	'''
+	import Workers
+	context = multiprocessing.get_context('spawn')
+	results = {}
+	for i, workers in enumerate(worker_counts):
+		port = base_port + 10 * i
+		root = _QuietPeer(None, None, '127.0.0.1', workers=workers)
+		root.id, root.listening_port = 'root', port
+		server = Workers.reuseport_socket('127.0.0.1', port)
+		root.init_sender()
+		for child, child_port in (('c1', port + 2), ('c2', port + 4)):
+			root.handle_packet(Packet(PacketType.CONNECTION_REQUEST, child, 'root', str(child_port)), child_port + 1)
+		if workers:
+			root.start_workers(server, spread, quiet=True)
+		threading.Thread(target=root.peer_receiving_handler, args=[server], daemon=True).start()
+
+		start_at = time.perf_counter() + 1
+		queue = context.Queue()
+		processes = [context.Process(target=_sink, args=(port + 4, start_at, duration, queue))]
+		processes += [context.Process(target=_flood, args=(port, 'c1', 'c2', start_at, duration)) for _ in range(senders)]
+		for process in processes:
+			process.start()
+		results[workers] = queue.get() / duration
+		for process in processes:
+			process.join()
+		if root.pool is not None:
+			for process in root.pool.processes:
+				process.terminate()
+	return results
+
+
+def bench_history(counts=(10000, 100000), length=60):
+	''' append `count` chat messages to a log, then replay all of them: time and peak memory of the replay '''
+	import History
+	import tracemalloc
+	results = {}
+	text = 'x' * length
+	for count in counts:
+		with tempfile.TemporaryDirectory() as directory:
+			chat_log = History.ChatLog(os.path.join(directory, 'chat'))
+			start = time.perf_counter()
+			for i in range(count):
+				chat_log.append('alice', text)
+			chat_log.flush()
+			append = time.perf_counter() - start
+
+			start = time.perf_counter()
+			replayed = sum(1 for _ in chat_log.replay())
+			replay = time.perf_counter() - start
+			# again to see what it allocates, tracemalloc slows it down
+			tracemalloc.start()
+			sum(1 for _ in chat_log.replay())
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+
+			# what a member gets: the bytes of the records, read as fragments
+			reader = chat_log.reader(last=count)
+			start = time.perf_counter()
+			while reader.read(1400):
+				pass
+			stream = time.perf_counter() - start
+			chat_log.close()
+		results[count] = {'append': append / count, 'replay': replay, 'replayed': replayed, 'peak': peak,
+						  'stream': stream, 'bytes': reader.size}
+	return results
+
+
+def bench_capture(count=20000, speeds=(0, 0.1), base_port=32000):
+	'''
+	ns a root takes to receive and forward a message with capture off and on, and what a fresh root
+	forwards when the captured datagrams are replayed into it at each speed (0 is as fast as they can be sent)
+	'''
+	import Capture
+	results = {}
+	datagram = Packet(PacketType.MESSAGE, 'c1', 'c2', 'x' * 64).to_bytes()
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'capture.bin')
+		roots = []
+		for port in (base_port, base_port + 10):
+			root = _QuietPeer(None, None, '127.0.0.1')
+			root.id, root.listening_port = 'root', port
+			root.init_sender()
+			for child, child_port in (('c1', base_port + 2), ('c2', base_port + 4)):
+				root.handle_packet(Packet(PacketType.CONNECTION_REQUEST, child, 'root', str(child_port)), child_port + 1)
+			roots.append(root)
+		root, fresh = roots
+
+		for capture in ('off', 'on'):
+			if capture == 'on':
+				root.handle_command(f'CAPTURE ON {path} {count * 2}')
+			start = time.perf_counter()
+			for _ in range(count):
+				root.receive_datagram(datagram, base_port + 3)
+			results[capture] = (time.perf_counter() - start) / count
+		root.handle_command('CAPTURE OFF')
+
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, commons.RECEIVE_BUFFER)
+		server.bind(('127.0.0.1', fresh.listening_port))
+		threading.Thread(target=fresh.peer_receiving_handler, args=[server], daemon=True).start()
+		for speed in speeds:
+			before = fresh.metrics.snapshot()['counters'].get('forwarded.message', 0)
+			replayer = Capture.Replayer('127.0.0.1', fresh.listening_port)
+			sent, elapsed = replayer.replay(Capture.read_capture(path), speed)
+			replayer.close()
+			forwarded = -1
+			while forwarded != fresh.metrics.snapshot()['counters'].get('forwarded.message', 0) - before:
+				# wait until the root handled what is queued in its socket
+				forwarded = fresh.metrics.snapshot()['counters'].get('forwarded.message', 0) - before
+				time.sleep(0.2)
+			results[speed] = {'sent': sent, 'rate': sent / elapsed, 'forwarded': forwarded}
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Micro benchmarks for peer hot paths')
+	parser.add_argument('name', choices=['firewall', 'routing', 'wire', 'admin', 'broadcast', 'chat', 'sim', 'reliable', 'bulk', 'coalesce', 'direct', 'shortcuts', 'failover', 'storm', 'workers', 'history', 'capture', 'joins'])
+	args = parser.parse_args()
+
+	commons.log.level = 0
+	if args.name == 'firewall':
+		for cached in (True, False):
+			for n, cost in bench_firewall(cached=cached).items():
+				print(f"firewall rules={n:<6} cache={'on ' if cached else 'off'} {cost * 1e9:8.0f} ns/packet")
+	elif args.name == 'routing':
+		for n, cost in bench_routing().items():
+			print(f"routing subtree={n:<6} {cost * 1e9:8.0f} ns/packet")
+	elif args.name == 'wire':
+		for (wire_format, size), pps in bench_wire().items():
+			print(f"wire format={wire_format:<6} payload={size:<5} {pps:10.0f} packets/s")
+	elif args.name == 'admin':
+		stats = bench_admin()
+		print(f"admin joins={stats['registrations']} wall={stats['wall_time']:.2f}s "
+			  f"throughput={stats['throughput']:.0f}/s handling p50={stats['handling_p50'] * 1e6:.0f}us p99={stats['handling_p99'] * 1e6:.0f}us")
+	elif args.name == 'broadcast':
+		print(f"broadcast peers=1023 {bench_broadcast() * 1e3:8.2f} ms")
+	elif args.name == 'chat':
+		for method, result in bench_chat().items():
+			print(f"chat peers=1023 members=200 {method:<9} {result['datagrams_per_message']:6.0f} datagrams/message "
+				  f"{result['time_per_message'] * 1e3:8.2f} ms/message")
+	elif args.name == 'reliable':
+		for (mode, loss), result in bench_reliable().items():
+			print(f"reliable loss={loss:<4} send={mode:<13} delivered {result['delivered']:6.1%} "
+				  f"goodput {result['goodput'] / 1e6:7.2f} MB/s")
+	elif args.name == 'bulk':
+		print(f"bulk 16 MB over 2 hops {bench_bulk() / 1e6:7.2f} MB/s")
+	elif args.name == 'coalesce':
+		for coalesce, result in bench_coalesce().items():
+			print(f"coalesce peers=63 {coalesce:<3} root forwards {result['packets_per_second']:8.0f} packets/s "
+				  f"{result['datagrams_per_packet']:5.2f} datagrams/packet")
+	elif args.name == 'direct':
+		for route, elapsed in bench_direct().items():
+			print(f"direct peers=1023 route={route:<6} {elapsed * 1e3:8.3f} ms round trip")
+	elif args.name == 'shortcuts':
+		for (n, routing), result in bench_shortcuts().items():
+			print(f"shortcuts peers={n:<6} routing={routing:<9} {result['hops']:6.2f} hops/message "
+				  f"root forwards {result['root_share']:6.1%} of messages")
+	elif args.name == 'joins':
+		for (n, aggregate), result in bench_joins().items():
+			print(f"joins peers={n:<5} adverts={'delta' if aggregate else 'single':<6} root receives "
+				  f"{result['root_adverts']:6} advertisements, {result['datagrams']:7} datagrams in the burst, "
+				  f"root routes to {result['routes']} peers after {result['converged'] * 1e3:5.1f} ms simulated")
+	elif args.name == 'failover':
+		for (routing, detector), result in bench_failover().items():
+			print(f"failover peers=1023 routing={routing:<7} detector={detector:<5} recovered in "
+				  f"{result['recovery'] * 1e3:6.0f} ms simulated, {result['lost']} probes lost")
+	elif args.name == 'storm':
+		for mode, result in bench_storm().items():
+			p50 = 'lost' if result['p50'] is None else f"{result['p50'] * 1e3:7.2f} ms"
+			p99 = 'lost' if result['p99'] is None else f"{result['p99'] * 1e3:7.2f} ms"
+			print(f"storm {mode:<11} ROUTE p50 {p50} p99 {p99} lost {result['lost']:3} "
+				  f"root forwards {result['forwarded']:8.0f} messages/s")
+	elif args.name == 'workers':
+		for workers, rate in bench_workers().items():
+			print(f"workers={workers} cores={os.cpu_count()} root forwards {rate:8.0f} messages/s")
+	elif args.name == 'history':
+		for count, result in bench_history().items():
+			print(f"history messages={count:<6} append {result['append'] * 1e6:5.2f} us/message, replay "
+				  f"{result['replay'] * 1e3:7.1f} ms peak {result['peak'] / 1024:6.1f} KiB, stream "
+				  f"{result['bytes'] / 1e6:5.1f} MB as fragments in {result['stream'] * 1e3:6.1f} ms")
+	elif args.name == 'capture':
+		result = bench_capture()
+		print(f"capture off {result['off'] * 1e9:6.0f} ns/message, on {result['on'] * 1e9:6.0f} ns/message "
+			  f"(in and out recorded)")
+		for speed in (0, 0.1):
+			replay = result[speed]
+			print(f"capture replay speed={speed:<4} sent {replay['sent']} messages at {replay['rate']:8.0f}/s, "
+				  f"fresh root forwarded {replay['forwarded']}")
+	elif args.name == 'sim':
+		for routing, result in bench_sim().items():
+			print(f"sim peers=100000 routing={routing:<7} join {result['join_wall']:6.2f}s wall, broadcast "
+				  f"{result['broadcast_wall']:6.2f}s wall {result['broadcast_sim'] * 1e3:6.1f}ms simulated "
+				  f"{result['broadcast_datagrams']} datagrams")
+
+
+if __name__ == "__main__":
+	main()
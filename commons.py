@@ -1,9 +1,19 @@
 
 from Packet import Packet, PacketType
+import atexit
+import collections
+import json
+import sys
 import socket
+import threading
+import time
 
-LOG_LEVEL = 2	# higher number -> more log
+LOG_LEVEL = 2	# higher number -> more log. initial level of `log`, change `log.level` at runtime
+LOG_FORMAT = 'text'	# 'text' (colored) or 'json' (one json object per line)
 MSG_SIZE = 1024
+DATAGRAM_SIZE = 65535
+RECEIVE_BUFFER = 1 << 21	# SO_RCVBUF of listening sockets, the default overflows under a full reliable window of fragments
+WIRE_FORMAT = 'binary'	# format of packets we send: 'binary' or 'text'. we can receive both
 
 class bcolors:
 	PINK = '\033[95m'
@@ -16,49 +26,148 @@ class bcolors:
 	BOLD = '\033[1m'
 	UNDERLINE = '\033[4m'
 
+class Log:
+	'''
+	Log records go into a bounded ring buffer (oldest records are dropped when it is full) and a
+	background thread formats and writes them. Appending to and popping from a deque are atomic,
+	so neither side takes a lock.
+
+	On hot paths guard the call so nothing is built when the level is off, and pass arguments
+	instead of an f-string so formatting happens in the writer:
+
+		if log.level >= 3:
+			log.write(3, 'route packet %s to %s', packet.source, port)
+	'''
+	def __init__(self, level=LOG_LEVEL, json_lines=LOG_FORMAT == 'json', capacity=65536, flush_interval=0.05,
+				 stream=None):
+		self.level = level
+		self.json_lines = json_lines
+		self.flush_interval = flush_interval
+		self.stream = stream
+		self.records = collections.deque(maxlen=capacity)
+		self.writer = None
+
+	def write(self, level, fmt, *args):
+		''' add a record. fmt is %-formatted with args by the writer '''
+		self.records.append((time.time(), level, fmt, args))
+		if self.writer is None or not self.writer.is_alive():
+			self.start_writer()
+
+	def start_writer(self):
+		self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+		self.writer.start()
+
+	def writer_loop(self):
+		while True:
+			time.sleep(self.flush_interval)
+			self.flush()
+
+	def format(self, record):
+		timestamp, level, fmt, args = record
+		msg = fmt % args if args else fmt
+		if self.json_lines:
+			return json.dumps({'time': timestamp, 'level': level, 'msg': msg})
+		color = bcolors.GREEN if level == 1 else bcolors.BLUE if level == 2 else bcolors.PINK
+		return f"{color} {msg} {bcolors.NORMAL}"
+
+	def flush(self):
+		stream = self.stream or sys.stdout
+		lines = []
+		while True:
+			try:
+				record = self.records.popleft()
+			except IndexError:
+				break
+			try:
+				lines.append(self.format(record))
+			except Exception as e:
+				# one bad record must not lose the others or stop the writer
+				lines.append(f"could not format log record {record[2]!r}: {e!r}")
+		if lines:
+			stream.write('\n'.join(lines) + '\n')
+			stream.flush()
+
+log = Log()
+atexit.register(log.flush)
+
 def dprint(*args, level=1):
-	if LOG_LEVEL >= level:
-		if level == 1:
-			print(bcolors.GREEN, *args, bcolors.NORMAL)
-		elif level == 2:
-			print(bcolors.BLUE, *args, bcolors.NORMAL)
-		else:
-			print(bcolors.PINK, *args, bcolors.NORMAL)
+	if log.level >= level:
+		log.write(level, ' '.join(str(arg) for arg in args))
 
 class BaseSenderReceiver:
+	def __init__(self):
+		# reusable buffer for incoming datagrams, parsed packets only copy what they keep.
+		# made on first use, peers that are handed datagrams (asyncio, simulation) never need one
+		self.receive_buffer = None
+		self.receive_view = None
+
 	def send(self, socket: socket.SocketType, msg, addr=None):
-		dprint(f"Send message to peer {addr if addr else socket.getpeername()} msg: {msg}", level=2)
-		msg = msg.encode("ascii")
+		if log.level >= 2:
+			log.write(2, "Send message to peer %s msg: %s", addr if addr else socket.getpeername(), msg)
+		self.send_bytes(socket, msg.encode("ascii"), addr)
+
+	def send_bytes(self, socket: socket.SocketType, msg: bytes, addr=None):
 		if not addr:
 			socket.send(msg)
 		else:
 			socket.sendto(msg, addr)
 
+	def send_bytes_batch(self, sock, msg: bytes, addrs):
+		''' send the same msg to all addrs. one peer we cannot send to does not stop the others '''
+		for addr in addrs:
+			try:
+				sock.sendto(msg, addr)
+			except OSError as e:
+				dprint(f"could not send to {addr}, err: {e}")
+
 	def receive(self, socket: socket.SocketType):
 		msg = socket.recv(MSG_SIZE).decode("ascii")
 		msg = msg.strip()
-		if msg:
-			dprint(f"Got message from peer {socket.getpeername()}: {msg}")
+		if msg and log.level >= 1:
+			log.write(1, "Got message from peer %s: %s", socket.getpeername(), msg)
 		return msg
 
-	def send_packet(self, socket: socket.SocketType, packet: Packet, addr=None):	
-		self.send(socket, packet.__str__(), addr)
+	def encode_packet(self, packet: Packet) -> bytes:
+		if packet.raw is not None:
+			return packet.raw
+		# fragments carry binary payloads that the text format can not hold
+		if WIRE_FORMAT == 'text' and packet.type != PacketType.FRAGMENT:
+			return packet.__str__().encode("ascii")
+		return packet.to_bytes()
+
+	def send_packet(self, socket: socket.SocketType, packet: Packet, addr=None):
+		if log.level >= 2:
+			log.write(2, "Send message to peer %s msg: %s", addr if addr else socket.getpeername(), packet)
+		self.send_bytes(socket, self.encode_packet(packet), addr)
+
+	def send_packet_batch(self, socket: socket.SocketType, packet: Packet, addrs):
+		''' serialize packet once and send it to all addrs '''
+		if log.level >= 2:
+			log.write(2, "Send message to peers %s msg: %s", addrs, packet)
+		self.send_bytes_batch(socket, self.encode_packet(packet), addrs)
 
 	def receive_packet(self, socket) -> Packet:
 		msg = self.receive(socket)
 		if not msg:
 			return None
-		splited = msg.split('|')
-		packet = Packet(PacketType.get_packet_type_from_code(splited[0]), splited[1], splited[2], splited[3])
-		return packet
+		return Packet.from_text(msg)
+
+	def receive_datagram_udp(self, socket: socket.SocketType, flags=0):
+		''' receive one datagram into our reusable buffer. return (memoryview of it, address) '''
+		if self.receive_buffer is None:
+			self.receive_buffer = bytearray(DATAGRAM_SIZE)
+			self.receive_view = memoryview(self.receive_buffer)
+		nbytes, address = socket.recvfrom_into(self.receive_buffer, 0, flags)
+		return self.receive_view[:nbytes], address
 
 	def receive_packet_udp(self, socket: socket.SocketType):
-		msg, address = socket.recvfrom(MSG_SIZE)
-		if not msg:
+		datagram, address = self.receive_datagram_udp(socket)
+		if not datagram:
 			return None
-		msg = msg.decode("ascii")
-		msg = msg.strip()
-		dprint(f"Got message from peer {address}: {msg}")
-		splited = msg.split('|')
-		packet = Packet(PacketType.get_packet_type_from_code(splited[0]), splited[1], splited[2], splited[3])
+		packet = Packet.parse(datagram)
+		if packet is None:
+			dprint(f"Got invalid packet from peer {address}")
+			return None
+		if log.level >= 1:
+			log.write(1, "Got message from peer %s: %s", address, packet)
 		return packet, address
@@ -0,0 +1,436 @@
+'''
+Loopback load test: admin and N peers on 127.0.0.1, driven through a scripted API instead of stdin.
+
+	python loadtest.py                              # N = 7, 127, 1023, 8191 on this process
+	python loadtest.py -n 7 127 --workers 4         # peers spread over 4 worker processes
+	python loadtest.py --output new.json --baseline old.json
+
+For every N it measures join throughput and convergence, ROUTE round trip, broadcast completion,
+chat fan-out and what installed firewall rules cost a broadcast. Results are JSON, and with
+--baseline the run is compared with an earlier one and exits with 1 if something got slower.
+
+Admin always runs on this process. Peers either all run on its event loop (`LocalCluster`) or on
+worker processes with a loop each (`ProcessCluster`). Times are perf_counter values, which on Linux
+is CLOCK_MONOTONIC, so times taken on workers compare with times taken here.
+'''
+import abc
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import commons
+from Admin import Admin
+from AsyncPeer import AsyncPeer
+from Network import Network
+from Packet import PacketType
+
+HOST = '127.0.0.1'
+BASE_PORT = 10000  # peer i listens on BASE_PORT + 2 * i. keep below the ephemeral port range
+PEER_COUNTS = (7, 127, 1023, 8191)
+TIMEOUT = 60  # seconds to wait for one measurement before it is recorded as null
+
+
+def _joined(peer, packet):
+	return packet.type in (PacketType.CONNECTION_REQUEST, PacketType.PARENT_ADVERTISE)
+
+
+def _broadcast(peer, packet):
+	return packet.type == PacketType.ADVERTISE and packet.destination == '-1'
+
+
+def _route(peer, packet):
+	return packet.type == PacketType.ROUTING_RESPONSE and packet.destination == peer.id
+
+
+def _chat(peer, packet):
+	if packet.type == PacketType.MULTICAST:
+		return any(member.partition(':')[0] == peer.id for member in packet.destination.split(','))
+	return packet.type == PacketType.MESSAGE and packet.destination == peer.id
+
+
+# packets we wait for in a measurement, by name so workers can be told what to watch
+WATCHES = {'joined': _joined, 'broadcast': _broadcast, 'route': _route, 'chat': _chat}
+
+
+def expected_join_packets(n):
+	''' CONNECTION_REQUESTs and PARENT_ADVERTISEs handled until a tree of n peers has converged '''
+	# a new peer sends a CONNECTION_REQUEST to its parent, which advertises it up to the root
+	return sum(Network.depth(number) for number in range(2, n + 1))
+
+
+class LoadPeer(AsyncPeer):
+	''' quiet peer that tells its shard about every packet it handles '''
+
+	def __init__(self, admin_host, admin_port, peer_host, on_packet):
+		AsyncPeer.__init__(self, admin_host, admin_port, peer_host)
+		self.on_packet = on_packet
+
+	def output(self, *args):
+		pass
+
+	def handle_packet(self, packet, peer_port):
+		self.on_packet(self, packet)
+		AsyncPeer.handle_packet(self, packet, peer_port)
+
+
+class Shard:
+	''' Peers of one event loop. Runs harness operations on them and reports watched packets to on_hit '''
+
+	def __init__(self, admin_port, on_hit):
+		self.admin_port = admin_port
+		self.on_hit = on_hit
+		self.peers = {}  # dict of {peer index: peer}
+		self.watch = None
+
+	def on_packet(self, peer, packet):
+		if self.watch is not None and self.watch(peer, packet):
+			self.on_hit(time.perf_counter())
+
+	def set_watch(self, name):
+		self.watch = WATCHES[name] if name else None
+
+	async def join(self, index, port):
+		peer = LoadPeer(HOST, self.admin_port, HOST, self.on_packet)
+		await peer.execute(f"CONNECT AS p{index} ON PORT {port}")
+		self.peers[index] = peer
+		return peer.sending_socket is not None
+
+	def call(self, index, method, *args):
+		''' call a method of peer index, e.g. handle_command with a command line '''
+		return getattr(self.peers[index], method)(*args)
+
+	def call_all(self, method, *args):
+		for peer in self.peers.values():
+			getattr(peer, method)(*args)
+
+	def close(self):
+		for peer in self.peers.values():
+			peer.close()
+
+
+class Cluster(abc.ABC):
+	''' Runs operations on the shard that has a peer and times how long watched packets take to arrive '''
+
+	def __init__(self):
+		self.hits = 0
+		self.expected = 0
+		self.last_hit = 0
+		self.done = None
+
+	def hit(self, when):
+		self.hits += 1
+		self.last_hit = max(self.last_hit, when)
+		if self.hits == self.expected and not self.done.done():
+			self.done.set_result(None)
+
+	async def watch(self, name, expected):
+		''' count packets named by `name` from now on and expect `expected` of them '''
+		await self.all('set_watch', name)
+		self.hits, self.expected, self.last_hit = 0, expected, 0
+		self.done = asyncio.get_running_loop().create_future()
+
+	async def wait(self, start, timeout=TIMEOUT):
+		''' seconds from start to the last expected packet, None if they did not all arrive in time '''
+		try:
+			await asyncio.wait_for(asyncio.shield(self.done), timeout)
+		except asyncio.TimeoutError:
+			return None
+		return self.last_hit - start
+
+	async def measure(self, name, expected, index, method, *args, timeout=TIMEOUT):
+		''' time from calling method of peer index until `expected` packets named by `name` were handled '''
+		await self.watch(name, expected)
+		start = time.perf_counter()
+		await self.on(index, 'call', index, method, *args)
+		return await self.wait(start, timeout)
+
+	@abc.abstractmethod
+	async def on(self, index, op, *args):
+		''' run shard operation op on the shard that has peer index and return its result '''
+
+	@abc.abstractmethod
+	async def all(self, op, *args):
+		''' run shard operation op on every shard '''
+
+
+class LocalCluster(Cluster):
+	''' all peers on the running event loop '''
+
+	def __init__(self, admin_port):
+		Cluster.__init__(self)
+		self.shard = Shard(admin_port, self.hit)
+
+	async def start(self):
+		pass
+
+	async def on(self, index, op, *args):
+		result = getattr(self.shard, op)(*args)
+		if asyncio.iscoroutine(result):
+			result = await result
+		return result
+
+	async def all(self, op, *args):
+		return await self.on(None, op, *args)
+
+	def close(self):
+		self.shard.close()
+
+
+def _worker(conn, admin_port, log_level):
+	commons.log.level = log_level
+	asyncio.run(_serve_shard(conn, admin_port))
+
+
+async def _serve_shard(conn, admin_port):
+	''' run the operations that come on conn against a shard, replying ('done', result) to each '''
+	loop = asyncio.get_running_loop()
+	shard = Shard(admin_port, lambda when: conn.send(('hit', when)))
+	requests = asyncio.Queue()
+	loop.add_reader(conn.fileno(), lambda: requests.put_nowait(conn.recv()))
+	while True:
+		op, args = await requests.get()
+		result = getattr(shard, op)(*args)
+		if asyncio.iscoroutine(result):
+			result = await result
+		conn.send(('done', result))
+		if op == 'close':
+			return
+
+
+class ProcessCluster(Cluster):
+	''' peers spread over worker processes, peer i lives on worker i % workers '''
+
+	def __init__(self, admin_port, workers):
+		Cluster.__init__(self)
+		self.admin_port = admin_port
+		self.workers = workers
+		self.conns = []
+		self.processes = []
+		self.pending = []  # per worker, futures of operations waiting for 'done' in send order
+
+	async def start(self):
+		loop = asyncio.get_running_loop()
+		context = multiprocessing.get_context('spawn')
+		for worker in range(self.workers):
+			conn, child_conn = context.Pipe()
+			process = context.Process(target=_worker, args=(child_conn, self.admin_port, commons.log.level),
+									  daemon=True)
+			process.start()
+			self.conns.append(conn)
+			self.processes.append(process)
+			self.pending.append([])
+			loop.add_reader(conn.fileno(), self.receive, worker)
+
+	def receive(self, worker):
+		kind, value = self.conns[worker].recv()
+		if kind == 'hit':
+			self.hit(value)
+		else:
+			self.pending[worker].pop(0).set_result(value)
+
+	async def request(self, worker, op, *args):
+		future = asyncio.get_running_loop().create_future()
+		self.pending[worker].append(future)
+		self.conns[worker].send((op, args))
+		return await future
+
+	async def on(self, index, op, *args):
+		return await self.request(index % self.workers, op, *args)
+
+	async def all(self, op, *args):
+		return await asyncio.gather(*(self.request(worker, op, *args) for worker in range(self.workers)))
+
+	def close(self):
+		loop = asyncio.get_event_loop()
+		for worker, conn in enumerate(self.conns):
+			loop.remove_reader(conn.fileno())
+			conn.send(('close', ()))
+		for process in self.processes:
+			process.join(5)
+
+
+async def _join(cluster, admin, n, base_port):
+	''' join peers one by one, like users starting them, and wait for the tree to converge '''
+	await cluster.watch('joined', expected_join_packets(n))
+	start = time.perf_counter()
+	joined = 0
+	for i in range(n):
+		joined += bool(await cluster.on(i, 'join', i, base_port + 2 * i))
+	join_time = time.perf_counter() - start
+	converge_time = await cluster.wait(start)
+
+	stats = admin.registration_stats()
+	return {
+		'joined': joined,
+		'join_time': join_time,
+		'joins_per_s': joined / join_time,
+		'admin_handling_p50': stats['handling_p50'],
+		'admin_handling_p99': stats['handling_p99'],
+		'converge_time': converge_time,
+	}
+
+
+def _summary(times):
+	''' median and worst of a list of measurements, None if any of them timed out '''
+	if not times or None in times:
+		return {'p50': None, 'max': None}
+	return {'p50': statistics.median(times), 'max': max(times)}
+
+
+async def _route(cluster, n, trials):
+	sender = n - 1
+	targets = [random.randrange(n - 1) for _ in range(trials)]
+	for target in set(targets):
+		await cluster.on(sender, 'call', sender, 'add_to_known_peers', f'p{target}')
+	times = [await cluster.measure('route', 1, sender, 'handle_command', f'ROUTE p{target}') for target in targets]
+	return _summary(times)
+
+
+async def _broadcast(cluster, n, trials):
+	times = [await cluster.measure('broadcast', n - 1, n - 1, 'handle_command', 'ADVERTISE -1') for _ in range(trials)]
+	return _summary(times)
+
+
+async def _chat(cluster, n, members, messages):
+	sender = n - 1
+	room = [f'p{i}' for i in random.sample(range(n - 1), min(members, n - 1))]
+	for member in room:
+		await cluster.on(sender, 'call', sender, 'add_to_known_peers', member)
+
+	times = []
+	for i in range(messages):
+		times.append(await cluster.measure('chat', len(room), sender, 'multicast', room, f"CHAT:NEW:message {i}\n1"))
+	result = {'members': len(room), **_summary(times)}
+	elapsed = None if None in times else sum(times)
+	result['messages_per_s'] = messages / elapsed if elapsed else None
+	result['deliveries_per_s'] = messages * len(room) / elapsed if elapsed else None
+	return result
+
+
+async def _firewall(cluster, n, rules, trials, without_rules):
+	''' broadcast again with `rules` FORWARD/INPUT rules for the broadcast's type that match nothing on every peer '''
+	for i in range(rules):
+		direction = ('FORWARD', 'INPUT')[i % 2]
+		await cluster.all('call_all', 'handle_command', f'FILTER {direction} x{i} * {PacketType.ADVERTISE.code} DROP')
+	with_rules = await _broadcast(cluster, n, trials)
+	overhead = None
+	if with_rules['p50'] is not None and without_rules['p50'] is not None:
+		overhead = with_rules['p50'] / without_rules['p50'] - 1
+	return {'rules': rules, 'broadcast': with_rules, 'overhead': overhead}
+
+
+async def run_load_test(n, workers=0, base_port=BASE_PORT, trials=10, members=200, messages=10, rules=100, seed=0):
+	''' start admin and n peers, run every measurement and return the results as a dict '''
+	random.seed(seed)
+	admin = Admin()
+	server = await admin.start(HOST, 0)
+	admin_port = server.sockets[0].getsockname()[1]
+	cluster = ProcessCluster(admin_port, workers) if workers else LocalCluster(admin_port)
+	await cluster.start()
+	try:
+		result = {'peers': n, 'join': await _join(cluster, admin, n, base_port)}
+		result['route'] = await _route(cluster, n, trials)
+		result['broadcast'] = await _broadcast(cluster, n, trials)
+		result['chat'] = await _chat(cluster, n, members, messages)
+		result['firewall'] = await _firewall(cluster, n, rules, trials, result['broadcast'])
+	finally:
+		cluster.close()
+		server.close()
+	return result
+
+
+def _git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def _flatten(results, prefix=''):
+	''' {'n': {'a': {'b': 1}}} -> {'n.a.b': 1} for numbers '''
+	flat = {}
+	for key, value in results.items():
+		name = f'{prefix}{key}'
+		if isinstance(value, dict):
+			flat.update(_flatten(value, name + '.'))
+		elif isinstance(value, (int, float)) and not isinstance(value, bool):
+			flat[name] = value
+	return flat
+
+
+# counts and settings, not performance
+_NOT_COMPARED = ('.peers', '.joined', '.members', '.rules', '.overhead')
+
+
+def compare(baseline, results, tolerance):
+	''' print metrics side by side and return names of the ones that got worse by more than tolerance '''
+	old, new = _flatten(baseline['results']), _flatten(results['results'])
+	regressions = []
+	for name in sorted(old.keys() & new.keys()):
+		if name.endswith(_NOT_COMPARED) or not old[name]:
+			continue
+		change = new[name] / old[name] - 1
+		# throughputs should go up, times should go down
+		worse = -change if name.endswith('_per_s') else change
+		flag = ''
+		if worse > tolerance:
+			flag = ' REGRESSION'
+			regressions.append(name)
+		print(f"{name:<40} {old[name]:12.6g} {new[name]:12.6g} {change:+8.1%}{flag}")
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Loopback load test of admin and N peers')
+	parser.add_argument('-n', type=int, nargs='+', default=PEER_COUNTS, help='peer counts to test')
+	parser.add_argument('--workers', type=int, default=0, help='worker processes for peers, 0 runs them here')
+	parser.add_argument('--base-port', type=int, default=BASE_PORT)
+	parser.add_argument('--trials', type=int, default=10, help='ROUTE and broadcast repetitions')
+	parser.add_argument('--members', type=int, default=200, help='chat room size')
+	parser.add_argument('--messages', type=int, default=10, help='chat lines to send')
+	parser.add_argument('--rules', type=int, default=100, help='firewall rules per peer')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--output', help='write results to this file instead of stdout')
+	parser.add_argument('--baseline', help='results of an earlier run to compare with')
+	parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+	args = parser.parse_args()
+
+	commons.log.level = 0
+	results = {
+		'meta': {
+			'commit': _git_commit(),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'time': time.time(),
+			'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+		},
+		'results': {},
+	}
+	for n in args.n:
+		results['results'][str(n)] = asyncio.run(run_load_test(
+			n, args.workers, args.base_port, args.trials, args.members, args.messages, args.rules, args.seed))
+		print(f"peers={n} done", file=sys.stderr)
+
+	text = json.dumps(results, indent=2)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(text + '\n')
+	else:
+		print(text)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compare(json.load(f), results, args.tolerance)
+		if regressions:
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,4 @@
+import commons
+
+# tests check behavior, not log lines
+commons.log.level = 0
@@ -0,0 +1,90 @@
+import io
+import os
+
+import pytest
+
+import Bulk
+from Bulk import FRAGMENT_HEADER, OutgoingTransfer, Reassembler
+
+
+def fragments(data, name='notes.txt', fragment_size=4):
+	transfer = OutgoingTransfer('b', name, io.BytesIO(data), len(data), fragment_size)
+	result = []
+	while (payload := transfer.next_fragment()) is not None:
+		result.append(payload)
+	return result
+
+
+def fragment(index, count, size, data=b'', fragment_size=4, transfer_id=1, name=b'f'):
+	return FRAGMENT_HEADER.pack(transfer_id, index, count, size, fragment_size, len(name)) + name + data
+
+
+def test_fragments_are_reassembled_in_any_order(tmp_path):
+	reassembler = Reassembler(str(tmp_path))
+	data = b'0123456789abcdefghij!'
+	parts = fragments(data)
+	assert len(parts) == 6
+	# last fragment first, and some of them twice
+	order = [parts[5], parts[3], parts[3], parts[4], parts[1], parts[2], parts[1], parts[0]]
+	results = [reassembler.add('a', payload, 0) for payload in order]
+	assert results[:-1] == [None] * (len(order) - 1)
+	name, path, size = results[-1]
+	assert (name, size) == ('notes.txt', len(data))
+	with open(path, 'rb') as file:
+		assert file.read() == data
+	assert not reassembler.transfers
+
+
+def test_empty_file_is_one_fragment(tmp_path):
+	reassembler = Reassembler(str(tmp_path))
+	[payload] = fragments(b'')
+	name, path, size = reassembler.add('a', payload, 0)
+	assert size == 0 and os.path.getsize(path) == 0
+
+
+@pytest.mark.parametrize('payload', [
+	fragment(3, 3, 12),  # index past the last fragment
+	fragment(2, 3, 10, b'abcd'),  # ends after the file
+	fragment(0, 2, 12),  # count does not match size and fragment size
+	fragment(0, 1, 0, fragment_size=0),
+	fragment(0, -(-(Bulk.MAX_SIZE + 1) // 65535), Bulk.MAX_SIZE + 1, fragment_size=65535),  # too big
+	fragment(0, Bulk.MAX_FRAGMENTS + 1, Bulk.MAX_FRAGMENTS + 1, fragment_size=1),  # too many fragments
+	FRAGMENT_HEADER.pack(1, 0, 1, 4, 4, 0)[:-3],  # truncated header
+])
+def test_invalid_fragments_are_rejected(tmp_path, payload):
+	reassembler = Reassembler(str(tmp_path))
+	with pytest.raises(ValueError):
+		reassembler.add('a', payload, 0)
+	assert not reassembler.transfers
+	assert os.listdir(tmp_path) == []  # nothing was written for it
+
+
+@pytest.mark.parametrize('source', ['../up', 'a/b', '', 'a b'])
+def test_source_must_be_a_peer_id(tmp_path, source):
+	with pytest.raises(ValueError):
+		Reassembler(str(tmp_path)).add(source, fragment(0, 1, 1, b'x'), 0)
+
+
+def test_name_cannot_leave_the_receive_directory(tmp_path):
+	reassembler = Reassembler(str(tmp_path / 'received'))
+	name, path, _ = reassembler.add('a', fragment(0, 1, 1, b'x', name=b'../../evil'), 0)
+	assert name == 'evil'
+	assert os.path.dirname(path) == str(tmp_path / 'received')
+
+
+def test_fragment_must_match_its_transfer(tmp_path):
+	reassembler = Reassembler(str(tmp_path))
+	assert reassembler.add('a', fragment(0, 3, 12, b'abcd'), 0) is None
+	with pytest.raises(ValueError):
+		reassembler.add('a', fragment(1, 4, 16, b'efgh'), 0)
+
+
+def test_incoming_transfers_are_bounded_and_expire(tmp_path):
+	reassembler = Reassembler(str(tmp_path), max_incoming=2, timeout=10)
+	for transfer_id in (1, 2):
+		reassembler.add('a', fragment(0, 2, 8, b'abcd', transfer_id=transfer_id), 0)
+	with pytest.raises(ValueError):
+		reassembler.add('a', fragment(0, 2, 8, b'abcd', transfer_id=3), 5)
+	# after the timeout the old transfers make room
+	assert reassembler.add('a', fragment(0, 2, 8, b'abcd', transfer_id=3), 11) is None
+	assert list(reassembler.transfers) == [('a', 3)]
@@ -0,0 +1,74 @@
+import pytest
+
+from Coalesce import BATCH_ITEM, BATCH_MAGIC, Coalescer, unpack_batch
+
+
+def batch(*items):
+	return bytes((BATCH_MAGIC,)) + b''.join(BATCH_ITEM.pack(len(item)) + item for item in items)
+
+
+class Sent:
+	def __init__(self):
+		self.datagrams = []
+		self.timers = []
+
+	def send_datagram(self, data, port):
+		self.datagrams.append((port, data))
+
+	def call_later(self, delay, callback, *args):
+		self.timers.append((callback, args))
+
+
+def test_batch_round_trip():
+	sent = Sent()
+	coalescer = Coalescer(sent.send_datagram, sent.call_later)
+	for data in (b'one', b'two', b''):
+		coalescer.add(2000, data)
+	assert sent.datagrams == []
+	coalescer.flush(2000)
+	[(port, datagram)] = sent.datagrams
+	assert port == 2000 and unpack_batch(datagram) == [b'one', b'two', b'']
+
+
+def test_one_packet_is_sent_alone():
+	sent = Sent()
+	coalescer = Coalescer(sent.send_datagram, sent.call_later)
+	coalescer.add(2000, b'alone')
+	for callback, args in sent.timers:
+		callback(*args)
+	assert sent.datagrams == [(2000, b'alone')]
+
+
+def test_big_packet_goes_after_what_is_buffered():
+	sent = Sent()
+	coalescer = Coalescer(sent.send_datagram, sent.call_later, size=100)
+	coalescer.add(2000, b'small')
+	coalescer.add(2000, b'x' * 200)
+	assert sent.datagrams == [(2000, b'small'), (2000, b'x' * 200)]
+
+
+def test_full_buffer_is_sent_without_waiting():
+	sent = Sent()
+	coalescer = Coalescer(sent.send_datagram, sent.call_later, size=100)
+	for _ in range(10):
+		coalescer.add(2000, b'y' * 20)
+	assert all(len(datagram) <= 100 for _, datagram in sent.datagrams)
+	assert sum(len(unpack_batch(datagram)) for _, datagram in sent.datagrams) == 8
+
+
+@pytest.mark.parametrize('datagram', [
+	batch(b'abc')[:-1],  # item cut off
+	batch(b'abc') + b'\x00',  # length cut off
+	batch(b'ok', batch(b'inner')),  # nested
+])
+def test_malformed_batches_are_rejected(datagram):
+	with pytest.raises(ValueError):
+		unpack_batch(datagram)
+
+
+def test_deeply_nested_batch_is_rejected():
+	datagram = b'packet'
+	for _ in range(1000):
+		datagram = batch(datagram)
+	with pytest.raises(ValueError):
+		unpack_batch(datagram)
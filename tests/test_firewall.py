@@ -0,0 +1,68 @@
+from Firewall import Firewall
+from Packet import Packet, PacketType
+
+MESSAGE = PacketType.MESSAGE
+
+
+def received(firewall, source, local='me'):
+	return firewall.check(Packet(MESSAGE, source, local, ''), local, False)
+
+
+def forwarded(firewall, source, destination, local='me'):
+	return firewall.check(Packet(MESSAGE, source, destination, ''), local, True)
+
+
+def test_packets_without_a_matching_rule_are_accepted():
+	firewall = Firewall()
+	firewall.add_rule('INPUT', 'x', '*', MESSAGE, 'DROP')
+	firewall.add_rule('INPUT', '*', '*', PacketType.ADVERTISE, 'DROP')
+	assert received(firewall, 'a')
+
+
+def test_newest_rule_wins_over_an_older_one_of_the_same_bucket():
+	firewall = Firewall()
+	firewall.add_rule('INPUT', 'a', '*', MESSAGE, 'DROP')
+	assert not received(firewall, 'a')
+	firewall.add_rule('INPUT', 'a', '*', MESSAGE, 'ACCEPT')
+	assert received(firewall, 'a')
+
+
+def test_newest_rule_wins_between_wildcard_and_exact_rules():
+	firewall = Firewall()
+	firewall.add_rule('INPUT', '*', '*', MESSAGE, 'DROP')
+	firewall.add_rule('INPUT', 'a', '*', MESSAGE, 'ACCEPT')
+	assert received(firewall, 'a')
+	assert not received(firewall, 'b')
+	# a newer wildcard shadows the older exact rule
+	firewall.add_rule('INPUT', '*', '*', MESSAGE, 'ACCEPT')
+	firewall.add_rule('INPUT', '*', '*', MESSAGE, 'DROP')
+	assert not received(firewall, 'a')
+
+
+def test_forward_rules_match_source_and_destination_pairs():
+	firewall = Firewall()
+	firewall.add_rule('FORWARD', '*', 'c', MESSAGE, 'DROP')
+	firewall.add_rule('FORWARD', 'a', 'c', MESSAGE, 'ACCEPT')
+	assert forwarded(firewall, 'a', 'c')
+	assert not forwarded(firewall, 'b', 'c')
+	assert forwarded(firewall, 'b', 'd')
+	# forward rules are not asked about packets for us
+	assert received(firewall, 'b', local='c')
+
+
+def test_cached_decisions_are_dropped_when_a_rule_is_added():
+	firewall = Firewall()
+	assert received(firewall, 'a')
+	assert received(firewall, 'a')  # now cached
+	firewall.add_rule('INPUT', 'a', '*', MESSAGE, 'DROP')
+	assert not received(firewall, 'a')
+
+
+def test_hits_are_counted_for_the_rule_that_decided():
+	firewall = Firewall()
+	firewall.add_rule('INPUT', '*', '*', MESSAGE, 'ACCEPT')
+	firewall.add_rule('INPUT', 'a', '*', MESSAGE, 'DROP')
+	for source in ('a', 'a', 'b'):
+		received(firewall, source)
+	# newest first
+	assert [hits for _, hits in firewall.rule_hits()] == [2, 1]
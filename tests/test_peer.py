@@ -0,0 +1,72 @@
+from Coalesce import BATCH_ITEM, BATCH_MAGIC
+from Packet import Packet, PacketType
+from Simulator import Simulator, SimPeer
+
+
+class RecordingPeer(SimPeer):
+	''' keeps what it shows instead of printing it '''
+
+	def __init__(self, sim, **kwargs):
+		SimPeer.__init__(self, sim, **kwargs)
+		self.shown = []
+
+	def output(self, *args):
+		self.shown.append(' '.join(str(arg) for arg in args))
+
+
+def tree(n, **kwargs):
+	sim = Simulator(latency=0.001)
+	peers = [sim.add_peer(str(i), 10000 + 2 * i, peer_class=RecordingPeer, **kwargs) for i in range(n)]
+	sim.run(until=1.0)
+	return sim, peers
+
+
+def test_multicast_reaches_every_member():
+	sim, peers = tree(7, heap_routing=True)
+	peers[3].multicast(['4', '5', '6'], 'SALAM:Salam Salam Sad Ta Salam')
+	sim.run(until=2.0)
+	for member in ('4', '5', '6'):
+		assert 'Salam Salam Sad Ta Salam (3)' in peers[int(member)].shown
+
+
+def test_multicast_leaves_out_members_a_forward_rule_drops():
+	sim, peers = tree(7, heap_routing=True)
+	# the root forwards to 2 (heap number 3) and drops the copy for 5 that goes the same way
+	peers[0].handle_command('FILTER FORWARD 3 5 00 DROP')
+	peers[3].multicast(['5', '6'], 'SALAM:Salam Salam Sad Ta Salam')
+	sim.run(until=2.0)
+	assert 'Salam Salam Sad Ta Salam (3)' in peers[6].shown
+	assert 'Salam Salam Sad Ta Salam (3)' not in peers[5].shown
+
+
+def test_nested_batch_is_counted_invalid():
+	sim, peers = tree(2)
+	inner = bytes((BATCH_MAGIC,)) + BATCH_ITEM.pack(1) + b'x'
+	peers[1].handle_datagram(bytes((BATCH_MAGIC,)) + BATCH_ITEM.pack(len(inner)) + inner, peers[0].listening_port + 1)
+	assert peers[1].metrics.counters[('invalid', None)] == 1
+
+
+def test_tree_repairs_after_a_peer_dies():
+	sim, peers = tree(7, heap_routing=True, heartbeats=True)
+	peers[1].close()  # heap number 2, parent of 3 and 4
+	sim.run(until=3.0)
+	# the last peer took its place and adopted its children
+	assert peers[6].number == 2 and peers[6].parent_id == '0'
+	assert peers[3].parent_id == '6' and peers[4].parent_id == '6'
+	peers[3].add_to_known_peers('5')
+	peers[3].route_packet(Packet(PacketType.MESSAGE, '3', '5', 'SALAM:Salam Salam Sad Ta Salam'))
+	sim.run(until=4.0)
+	assert 'Salam Salam Sad Ta Salam (3)' in peers[5].shown
+
+
+def test_rehome_and_adopt_from_a_stranger_are_ignored():
+	sim, peers = tree(7, heap_routing=True, heartbeats=True)
+	peer = peers[3]  # heap number 4, parent 1
+	peer.handle_packet(Packet(PacketType.REHOME, 'x', '3', f'REHOME 3 {peer.listening_port} 9 evil:6666'), 6667)
+	peer.handle_packet(Packet(PacketType.ADOPT, 'evil', '3', '7777 1'), 7778)
+	for data in ('', 'x', '1 2 3'):
+		peer.handle_packet(Packet(PacketType.ADOPT, 'evil', '3', data), 7778)
+		peer.handle_packet(Packet(PacketType.REHOME, 'evil', '3', data), 7778)
+		peer.handle_packet(Packet(PacketType.CONNECTION_REQUEST, 'evil', '3', data), 7778)
+	sim.run(until=2.0)
+	assert (peer.number, peer.parent_id) == (4, '1')
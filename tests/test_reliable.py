@@ -0,0 +1,132 @@
+import Reliable
+from Metrics import Metrics
+from Reliable import ReliableChannel, DUP_THRESH, FRAME_HEADER, RTO_MAX, SACK_BLOCK, SACK_COUNT, LINK_MAGIC, KIND_ACK
+
+
+class Clock:
+	''' time that moves only when a test says so, and the timers that wait on it '''
+
+	def __init__(self):
+		self.now = 0.0
+		self.timers = []  # list of (time, callback, args)
+
+	def __call__(self):
+		return self.now
+
+	def call_later(self, delay, callback, *args):
+		self.timers.append((self.now + delay, callback, args))
+
+	def advance(self, seconds):
+		self.now += seconds
+		due = [timer for timer in self.timers if timer[0] <= self.now]
+		self.timers = [timer for timer in self.timers if timer[0] > self.now]
+		for _, callback, args in due:
+			callback(*args)
+
+
+def channel(clock, sent):
+	''' channel whose frames are appended to sent as (frame, port) '''
+	return ReliableChannel(lambda frame, port: sent.append((frame, port)), clock.call_later, clock, metrics=Metrics())
+
+
+def seq_of(frame):
+	return FRAME_HEADER.unpack_from(frame)[3]
+
+
+def ack(sender, cumulative, blocks=()):
+	return b''.join([FRAME_HEADER.pack(LINK_MAGIC, KIND_ACK, sender.epoch, cumulative), SACK_COUNT.pack(len(blocks))] +
+					[SACK_BLOCK.pack(start, end) for start, end in blocks])
+
+
+def test_frames_reach_the_receiver_once_and_are_acked():
+	clock, to_b, to_a = Clock(), [], []
+	a, b = channel(clock, to_b), channel(clock, to_a)
+	for i in range(5):
+		a.send(2000, b'packet %d' % i)
+	received = [b.receive(frame, 1000) for frame, _ in to_b]
+	assert [bytes(data) for data in received] == [b'packet %d' % i for i in range(5)]
+	# a duplicate is acked again but not handed up
+	assert b.receive(to_b[0][0], 1000) is None
+	assert b.metrics.counters[('duplicates', None)] == 1
+
+	for frame, _ in to_a:
+		a.receive(frame, 2000)
+	assert not a.links[2000].in_flight
+
+
+def test_sack_triggers_fast_retransmit_of_the_lost_frame():
+	clock, sent = Clock(), []
+	a = channel(clock, sent)
+	for i in range(DUP_THRESH + 2):
+		clock.now += 0.001
+		a.send(2000, b'x')
+	sent.clear()
+	clock.now += 0.001
+	# frame 0 lost, the ones after it arrived
+	a.receive(ack(a, 0, [(1, DUP_THRESH + 2)]), 2000)
+
+	assert [seq_of(frame) for frame, _ in sent] == [0]
+	assert list(a.links[2000].in_flight) == [0]
+	assert a.metrics.counters[('retransmitted', None)] == 1
+
+
+def test_no_fast_retransmit_below_the_duplicate_threshold():
+	clock, sent = Clock(), []
+	a = channel(clock, sent)
+	for i in range(DUP_THRESH):
+		clock.now += 0.001
+		a.send(2000, b'x')
+	sent.clear()
+	a.receive(ack(a, 0, [(1, DUP_THRESH)]), 2000)
+	assert sent == []
+
+
+def test_sack_blocks_outside_the_window_are_ignored():
+	clock, sent = Clock(), []
+	a = channel(clock, sent)
+	for i in range(3):
+		a.send(2000, b'x')
+	sent.clear()
+	a.receive(ack(a, 0, [(0, 2 ** 32 - 1), (10, 20)]), 2000)
+	# the huge block acked what is in flight and nothing was resent for the made up frames
+	assert not a.links[2000].in_flight
+	assert sent == []
+
+
+def test_timeout_resends_the_oldest_frame_and_backs_off():
+	clock, sent = Clock(), []
+	a = channel(clock, sent)
+	a.send(2000, b'x')
+	link = a.links[2000]
+	rto = link.rto
+	for _ in range(20):
+		sent.clear()
+		clock.advance(link.rto)
+		assert [seq_of(frame) for frame, _ in sent] == [0]
+		assert link.rto == min(rto * 2, RTO_MAX)
+		rto = link.rto
+	assert link.rto == RTO_MAX
+	assert a.metrics.counters[('reliable_timeouts', None)] == 20
+
+
+def test_retransmitted_frames_give_no_rtt_sample():
+	clock, sent = Clock(), []
+	a = channel(clock, sent)
+	a.send(2000, b'x')
+	clock.advance(Reliable.RTO_INITIAL)
+	backed_off = a.links[2000].rto
+	clock.now += 0.5
+	a.receive(ack(a, 1), 2000)
+	# Karn's rule: the ack could be for either send, so the backed off timeout stays
+	assert a.links[2000].srtt is None
+	assert a.links[2000].rto == backed_off
+
+
+def test_window_limits_frames_in_flight():
+	clock, sent = Clock(), []
+	a = ReliableChannel(lambda frame, port: sent.append(frame), clock.call_later, clock, window=4)
+	for i in range(10):
+		a.send(2000, b'x')
+	assert len(sent) == 4
+	a.receive(ack(a, 2), 2000)
+	assert len(sent) == 6